@@ -1,13 +1,16 @@
+import time
 import matplotlib.pyplot as plt
-import pickle
 import numpy as np
+from numpy.lib.recfunctions import structured_to_unstructured
 from scenes_ai import InvestmentScene
-from tensorflow.keras.models import load_model
-import random
+from model_artifact import load_artifact
+from rng_streams import spawn_seeds
+from rebalance import rebalance, target_weights
+from telemetry import DEBUG, TelemetryRecorder
 ROLLING_WINDOW = 6
 
 
-def adjust_portfolio(scene, predicted_prices, portfolio_value):
+def adjust_portfolio(scene, predicted_prices, portfolio_value, verbose=True):
     """
     Adjusts the portfolio based on predicted prices.
 
@@ -15,6 +18,7 @@ def adjust_portfolio(scene, predicted_prices, portfolio_value):
         scene (InvestmentScene): Investment scene object.
         predicted_prices (ndarray): Predicted prices of assets.
         portfolio_value (float): Current portfolio value.
+        verbose (bool): Print the current and predicted weights. Default is True.
     """
     current_prices = [scene.get_stock_price(), scene.get_bond_price()]
     current_weights = scene.get_portfolio_weights()
@@ -29,8 +33,9 @@ def adjust_portfolio(scene, predicted_prices, portfolio_value):
         predicted_weights = [0, 0, 1]  # all weight to cash
     else:
         predicted_weights = np.append(predicted_returns, 0) / sum_returns  # normalize weights
-    print("current weights", current_weights)
-    print("predicted weights", predicted_weights)
+    if verbose:
+        print("current weights", current_weights)
+        print("predicted weights", predicted_weights)
 
     differences = [pw - cw for pw, cw in zip(predicted_weights, current_weights)]
 
@@ -49,6 +54,42 @@ def adjust_portfolio(scene, predicted_prices, portfolio_value):
     scene.handle_events('end_turn', 0)
 
 
+def adjust_portfolios(scenes, predicted_prices, scene_trades=False):
+    """
+    Rebalances many portfolios at once to the target weights of their predicted prices.
+
+    The weights follow adjust_portfolio, but the final holdings are computed for all scenes
+    together (see rebalance.rebalance) instead of through sequential buy and sell events.
+    That rebalance reaches the target weights exactly, while the scene's events trade one
+    asset after the other and skip a trade silently when the cash or holdings fall short,
+    so the portfolios end differently.
+
+    Args:
+        scenes (list): Investment scene objects.
+        predicted_prices (ndarray): Predicted stock and bond prices of shape (len(scenes), 2).
+        scene_trades (bool): Trade through the scene's events with adjust_portfolio instead,
+            as run_multiple_games does. Default is False.
+
+    Returns:
+        tuple: The prices of the trades, (len(scenes), 2), and the target weights, (len(scenes), 3).
+    """
+    prices = np.array([[scene.get_stock_price(), scene.get_bond_price()] for scene in scenes])
+    weights = target_weights(predicted_prices, prices)
+    if scene_trades:
+        for scene, scene_predicted_prices in zip(scenes, predicted_prices):
+            adjust_portfolio(scene, scene_predicted_prices, scene.get_portfolio_value(), verbose=False)
+        return prices, weights
+
+    money = np.array([scene.money for scene in scenes])
+    stock_shares = np.array([scene.stock_share for scene in scenes])
+    bond_shares = np.array([scene.bond_share for scene in scenes])
+    holdings = rebalance(money, stock_shares, bond_shares, prices, weights)
+    for scene, scene_holdings in zip(scenes, zip(*holdings)):
+        scene.set_holdings(*scene_holdings)
+        scene.handle_events('end_turn', 0)
+    return prices, weights
+
+
 def preprocess_state_values(state, state_order, scaler):
     """
     Preprocesses state values.
@@ -69,43 +110,49 @@ def preprocess_state_values(state, state_order, scaler):
     return state_values
 
 
-def run_multiple_games(num_games, model, scaler):
+def run_multiple_games(num_games, session, seed=None, library=None, telemetry=None):
     """
     Runs multiple games and returns the results.
 
     Args:
         num_games (int): Number of games to run.
-        model: Trained model for prediction.
-        scaler: Scaler object for state transformation.
+        session (ModelArtifact): Trained model and scaler used for prediction, or an InferenceSession.
+        seed (int): Seed of the simulated markets, game i uses child i of the seed.
+        library (MarketPathLibrary): Stored markets, game i replays path i instead of a simulated market.
+        telemetry (TelemetryRecorder): Recorder of the periods, default records silently in memory.
 
     Returns:
         tuple: Final portfolio values and the fraction of winning scenarios.
     """
+    telemetry = TelemetryRecorder() if telemetry is None else telemetry
+    telemetry.new_run()
     game_results = []
     scene = InvestmentScene()
     num_win = 0
     state_order = ['Stock_Price', 'Bond_Price', 'Fed_Rate', 'Inflation']
     pred_prices = []
     curr_prices = []
-    for _ in range(num_games):
-        print("Game number", _)
-        scene.reset_game()
-        recent_periods = scene.get_state()[-ROLLING_WINDOW:]  # Initial periods
+    for _, game_seed in enumerate(spawn_seeds(seed, num_games)):
+        telemetry.log(f"Game number {_}", DEBUG)
+        scene.seed(game_seed)  # Same market as InvestmentScene(game_seed) in run_multiple_games_batched
+        if library is not None:
+            library.replay(scene, _)
+        else:
+            scene.reset_game()
+        recorded = telemetry.sample()
 
         for per in range(scene.MAX_PERIODS):  # Starting from the first period
-            state_values = np.array([state[key] for state in recent_periods for key in state_order]).reshape(1, -1)
-            state_values = scaler.transform(state_values)
-            state_values = state_values.reshape(1, ROLLING_WINDOW, -1)
-            predicted_prices = model.predict(state_values)
-            adjust_portfolio(scene, predicted_prices[0], scene.get_portfolio_value())
-            print("Predicted Prices:", predicted_prices)
-            print("Current Weights:", scene.get_portfolio_weights())
-            print("Portfolio Value:", scene.get_portfolio_value())
-            print("Current Bond Prices;", scene.get_bond_price())
-            print("Current Stock Prices;", scene.get_stock_price())
-            recent_periods.pop(0)  # Remove the oldest period
-            recent_periods.append(scene.get_last_state())  # Append the most recent period
-            print("Recent var", recent_periods)
+            recent_periods = scene.get_state()[-ROLLING_WINDOW:]  # View on the most recent periods
+            state_values = structured_to_unstructured(recent_periods[state_order])
+            prices = np.array([[scene.get_stock_price(), scene.get_bond_price()]])
+            portfolio_value = scene.get_portfolio_value()
+            start = time.perf_counter()
+            predicted_prices = session.predict(state_values[np.newaxis])
+            latency = time.perf_counter() - start
+            adjust_portfolio(scene, predicted_prices[0], portfolio_value, verbose=telemetry.enabled(DEBUG))
+            if recorded:
+                telemetry.record(_, per, predicted_prices, prices, target_weights(predicted_prices, prices),
+                                 portfolio_value, latency)
             # Move to the next period
             if per < scene.MAX_PERIODS -1:
                 pred_prices.append(predicted_prices)
@@ -118,27 +165,137 @@ def run_multiple_games(num_games, model, scaler):
     percent_win = num_win / num_games
     return game_results, percent_win, pred_prices,curr_prices
 
-def random_games(num_games):
+
+def run_multiple_games_batched(num_games, session, seed=None, library=None, telemetry=None, scene_trades=False):
+    """
+    Runs multiple games in lockstep with one batched model call per period.
+
+    All games advance together: every period the last ROLLING_WINDOW states of all games are
+    stacked into a (num_games, ROLLING_WINDOW, 4) batch and predicted at once, then all
+    portfolios are rebalanced together by adjust_portfolios. The games play the same markets
+    as run_multiple_games, but the frictionless rebalance ends with other portfolio values
+    (a few percent apart on some games): the results are only comparable with
+    run_multiple_games with scene_trades, which trades through the same scene events. The games
+    are then identical for identical predictions; batched and single-window predictions can
+    still differ in their last float32 digits.
+
+    Args:
+        num_games (int): Number of games to run.
+        session (ModelArtifact): Trained model and scaler used for prediction, or an InferenceSession.
+        seed (int): Seed of the simulated markets, game i uses child i of the seed.
+        library (MarketPathLibrary): Stored markets, game i replays path i instead of a simulated market.
+        telemetry (TelemetryRecorder): Recorder of the periods, default records silently in memory.
+        scene_trades (bool): Trade through the scene's buy and sell events, see adjust_portfolios. Default is False.
+
+    Returns:
+        tuple: Final portfolio values, the fraction of winning scenarios, the predicted prices
+            (num_games * (MAX_PERIODS - 1), 1, 2) and the following current prices
+            (num_games * (MAX_PERIODS - 1), 2), ordered by game then period as in run_multiple_games.
+    """
+    telemetry = TelemetryRecorder() if telemetry is None else telemetry
+    telemetry.new_run()
+    scenes = [InvestmentScene(child) for child in spawn_seeds(seed, num_games)]
+    if library is not None:
+        for game, scene in enumerate(scenes):
+            library.replay(scene, game)
+    recorded = np.flatnonzero(telemetry.sample(num_games))
+    max_periods = scenes[0].MAX_PERIODS
+    state_order = ['Stock_Price', 'Bond_Price', 'Fed_Rate', 'Inflation']
+    pred_prices = np.empty((num_games, max_periods, 2))
+    curr_prices = np.empty((num_games, max_periods, 2))
+
+    for per in range(max_periods):
+        recent_periods = np.stack([scene.get_state()[-ROLLING_WINDOW:] for scene in scenes])
+        values = np.array([scene.get_portfolio_value() for scene in scenes])
+        start = time.perf_counter()
+        pred_prices[:, per] = session.predict(structured_to_unstructured(recent_periods[state_order]))
+        latency = (time.perf_counter() - start) / num_games
+        prices, weights = adjust_portfolios(scenes, pred_prices[:, per], scene_trades)
+        telemetry.record(recorded, per, pred_prices[recorded, per], prices[recorded], weights[recorded],
+                         values[recorded], latency)
+        curr_prices[:, per] = [[scene.get_stock_price(), scene.get_bond_price()] for scene in scenes]
+
+    game_results = [scene.get_portfolio_value() for scene in scenes]
+    percent_win = np.mean(np.array(game_results) > 500000)
+    return (game_results, percent_win, pred_prices[:, :-1].reshape(-1, 1, 2),
+            curr_prices[:, 1:].reshape(-1, 2))
+
+
+def run_multiple_games_stateful(num_games, session, seed=None, telemetry=None):
+    """
+    Runs multiple games with a stateful model, feeding one new period per game and per period.
+
+    Games are played in lockstep batches of session.batch_size. The session is reset with the
+    games, fed the burn-in states, then only the newest state of every period.
+
+    Args:
+        num_games (int): Number of games to run, a multiple of session.batch_size.
+        session (StatefulSession): Stateful model and scaler used for prediction.
+        seed (int): Seed of the simulated markets, game i uses child i of the seed.
+        telemetry (TelemetryRecorder): Recorder of the periods, default records silently in memory.
+
+    Returns:
+        tuple: Final portfolio values and the fraction of winning scenarios.
+    """
+    telemetry = TelemetryRecorder() if telemetry is None else telemetry
+    telemetry.new_run()
+    if num_games % session.batch_size:
+        raise ValueError(f'num_games ({num_games}) must be a multiple of the batch size ({session.batch_size})')
+
+    state_order = ['Stock_Price', 'Bond_Price', 'Fed_Rate', 'Inflation']
+    game_results = []
+    for start in range(0, num_games, session.batch_size):
+        scenes = [InvestmentScene(child) for child in spawn_seeds(seed, session.batch_size, start)]
+        session.reset()
+        recorded = np.flatnonzero(telemetry.sample(session.batch_size))
+
+        new_states = np.stack([scene.get_state() for scene in scenes])  # Burn-in periods
+        for per in range(scenes[0].MAX_PERIODS):
+            values = np.array([scene.get_portfolio_value() for scene in scenes])
+            time_start = time.perf_counter()
+            predicted_prices = session.predict(structured_to_unstructured(new_states[state_order]))
+            latency = (time.perf_counter() - time_start) / session.batch_size
+            prices, weights = adjust_portfolios(scenes, predicted_prices)
+            telemetry.record(start + recorded, per, predicted_prices[recorded], prices[recorded], weights[recorded],
+                             values[recorded], latency)
+            new_states = np.stack([scene.get_state()[-1:] for scene in scenes])
+
+        game_results.extend(scene.get_portfolio_value() for scene in scenes)
+
+    percent_win = np.mean(np.array(game_results) > 500000)
+    return game_results, percent_win
+
+def random_games(num_games, seed=None, library=None, telemetry=None):
     """
     Runs multiple random games and returns the results.
 
     Args:
         num_games (int): Number of games to run.
+        seed (int): Seed of the simulated markets and decisions, game i uses child i of the seed,
+            so the markets are the same as in run_multiple_games and run_multiple_games_batched.
+        library (MarketPathLibrary): Stored markets, game i replays path i instead of a simulated market.
+        telemetry (TelemetryRecorder): Recorder whose level controls the progress messages.
 
     Returns:
         tuple: Final portfolio values and the fraction of winning scenarios.
     """
+    telemetry = TelemetryRecorder() if telemetry is None else telemetry
     game_results_random = []
     scene = InvestmentScene()
     num_win = 0
 
-    for _ in range(num_games):
-        print("Game number", _)
-        scene.reset_game()
+    for _, game_seed in enumerate(spawn_seeds(seed, num_games)):
+        telemetry.log(f"Game number {_}", DEBUG)
+        scene.seed(game_seed)
+        rng = np.random.default_rng(game_seed.spawn(1)[0])  # Decisions stream, independent of the market stream
+        if library is not None:
+            library.replay(scene, _)
+        else:
+            scene.reset_game()
 
         for per in range(scene.MAX_PERIODS):
-            decision = random.choice(['buy_stock', 'buy_bond', 'increase_cash'])
-            change_amount = random.uniform(0.1, 0.4) * scene.get_portfolio_value()
+            decision = rng.choice(['buy_stock', 'buy_bond', 'increase_cash'])
+            change_amount = rng.uniform(0.1, 0.4) * scene.get_portfolio_value()
 
             scene.handle_events(decision, change_amount)
             scene.handle_events("end_turn", 0)
@@ -151,78 +308,76 @@ def random_games(num_games):
     return game_results_random, percent_win
 
 
-# Load the trained model
-model = load_model('../DATA/model/model1')
-
-# Load the scaler
-scaler_file = '../DATA/model/scaler.pkl'
-with open(scaler_file, 'rb') as f:
-    scaler = pickle.load(f)
-
-final_portfolio_values, percent_win, pred_list, curr_list = run_multiple_games(100, model, scaler)  # Pass the model to run_multiple_games
-random_port, random_percent_win = random_games(100)
-print("pred P",pred_list)
-print("CURR P",curr_list)
-print("LEN pred P",len(pred_list))
-print("LEN CURR P",len(curr_list))
-percent_win *= 100.00
-random_percent_win *= 100
-mean_portfolio_value = np.mean(final_portfolio_values)  # Calculate the mean final portfolio value
-mean_random_portfolio = np.mean(random_port)
-print(f"On average the portfolio value is {mean_portfolio_value} ")
-print(f"On the 100 simulated games, {percent_win}% were winning scenarios")
-print(f"On average the random portfolio value is {mean_random_portfolio} ")
-print(f"On the 100 simulated games of the random model, {random_percent_win}% were winning scenarios")
-
-fig, ax = plt.subplots()
-ax.plot(final_portfolio_values, label='Final portfolio value')
-ax.axhline(mean_portfolio_value, color='r', linestyle='--', label='Mean value')  # Add a horizontal line for the mean value
-ax.axhline(mean_random_portfolio, color='b', linestyle='--', label='Mean random value')
-ax.set_xlabel('Game number')
-ax.set_ylabel('Final portfolio value')
-ax.legend()
-plt.tight_layout()
-
-# Save the figure
-plt.savefig('pngfiles/portfolio_values.png', dpi=300)
-
-# Show the plot
-plt.show()
-
-pred_stock_prices = np.array([price[0][0] for price in pred_list])
-pred_bond_prices = np.array([price[0][1] for price in pred_list])
-curr_stock_prices = np.array([price[0] for price in curr_list])
-curr_bond_prices = np.array([price[1] for price in curr_list])
-
-periods_pred = np.arange(1, pred_stock_prices.shape[0] + 1)
-periods_curr = np.arange(1, curr_stock_prices.shape[0] + 1)
-
-fig1, ax1 = plt.subplots()
-ax1.plot(periods_curr, curr_bond_prices, label='Actual bond prices')
-ax1.plot(periods_pred, pred_bond_prices, label='Predicted bond prices')
-ax1.set_xlabel('Periods')
-ax1.set_ylabel('Price')
-ax1.legend()
-plt.savefig('pngfiles/actual_predicted_bond_prices.png', dpi=300)
-
-fig4, ax4 = plt.subplots()
-ax4.plot(periods_curr, curr_stock_prices, label='Actual stock prices')
-ax4.plot(periods_pred, pred_stock_prices, label='Predicted stock prices')
-ax4.set_xlabel('Periods')
-ax4.set_ylabel('Price')
-ax4.legend()
-plt.savefig('pngfiles/actual_predicted_stock_prices.png', dpi=300)
-
-fig2, ax2 = plt.subplots()
-ax2.plot(periods_pred, np.abs(pred_bond_prices - curr_bond_prices), label='Absolute difference (bond)')
-ax2.set_xlabel('Periods')
-ax2.set_ylabel('Absolute Difference In Bond Prices')
-plt.savefig('pngfiles/absolute_difference_bond_prices.png', dpi=300)
-
-fig3, ax3 = plt.subplots()
-ax3.plot(periods_curr, np.abs(pred_stock_prices - curr_stock_prices), label='Absolute difference (stock)')
-ax3.set_xlabel('Periods')
-ax3.set_ylabel('Absolute Difference In Stock Prices')
-plt.savefig('pngfiles/absolute_difference_stock_prices.png', dpi=300)
-
-plt.show()
+if __name__ == '__main__':
+    # Load the trained model and scaler once, from the artifact without TensorFlow
+    session = load_artifact()
+
+    telemetry = TelemetryRecorder()
+    seed = np.random.SeedSequence()  # The model and the random strategy play the same markets
+    final_portfolio_values, percent_win, pred_list, curr_list = run_multiple_games_batched(100, session, seed, telemetry=telemetry)  # One batched model call per period
+    random_port, random_percent_win = random_games(100, seed)
+    summary = telemetry.summary()
+    print(f"Prediction latency per game: {summary['latency_p50']:.4f} ms (p50), {summary['latency_p99']:.4f} ms (p99)")
+    for per, stats in summary['periods'].items():
+        print(f"Period {per}: {stats}")
+    percent_win *= 100.00
+    random_percent_win *= 100
+    mean_portfolio_value = np.mean(final_portfolio_values)  # Calculate the mean final portfolio value
+    mean_random_portfolio = np.mean(random_port)
+    print(f"On average the portfolio value is {mean_portfolio_value} ")
+    print(f"On the 100 simulated games, {percent_win}% were winning scenarios")
+    print(f"On average the random portfolio value is {mean_random_portfolio} ")
+    print(f"On the 100 simulated games of the random model, {random_percent_win}% were winning scenarios")
+
+    fig, ax = plt.subplots()
+    ax.plot(final_portfolio_values, label='Final portfolio value')
+    ax.axhline(mean_portfolio_value, color='r', linestyle='--', label='Mean value')  # Add a horizontal line for the mean value
+    ax.axhline(mean_random_portfolio, color='b', linestyle='--', label='Mean random value')
+    ax.set_xlabel('Game number')
+    ax.set_ylabel('Final portfolio value')
+    ax.legend()
+    plt.tight_layout()
+
+    # Save the figure
+    plt.savefig('pngfiles/portfolio_values.png', dpi=300)
+
+    # Show the plot
+    plt.show()
+
+    pred_stock_prices = np.array([price[0][0] for price in pred_list])
+    pred_bond_prices = np.array([price[0][1] for price in pred_list])
+    curr_stock_prices = np.array([price[0] for price in curr_list])
+    curr_bond_prices = np.array([price[1] for price in curr_list])
+
+    periods_pred = np.arange(1, pred_stock_prices.shape[0] + 1)
+    periods_curr = np.arange(1, curr_stock_prices.shape[0] + 1)
+
+    fig1, ax1 = plt.subplots()
+    ax1.plot(periods_curr, curr_bond_prices, label='Actual bond prices')
+    ax1.plot(periods_pred, pred_bond_prices, label='Predicted bond prices')
+    ax1.set_xlabel('Periods')
+    ax1.set_ylabel('Price')
+    ax1.legend()
+    plt.savefig('pngfiles/actual_predicted_bond_prices.png', dpi=300)
+
+    fig4, ax4 = plt.subplots()
+    ax4.plot(periods_curr, curr_stock_prices, label='Actual stock prices')
+    ax4.plot(periods_pred, pred_stock_prices, label='Predicted stock prices')
+    ax4.set_xlabel('Periods')
+    ax4.set_ylabel('Price')
+    ax4.legend()
+    plt.savefig('pngfiles/actual_predicted_stock_prices.png', dpi=300)
+
+    fig2, ax2 = plt.subplots()
+    ax2.plot(periods_pred, np.abs(pred_bond_prices - curr_bond_prices), label='Absolute difference (bond)')
+    ax2.set_xlabel('Periods')
+    ax2.set_ylabel('Absolute Difference In Bond Prices')
+    plt.savefig('pngfiles/absolute_difference_bond_prices.png', dpi=300)
+
+    fig3, ax3 = plt.subplots()
+    ax3.plot(periods_curr, np.abs(pred_stock_prices - curr_stock_prices), label='Absolute difference (stock)')
+    ax3.set_xlabel('Periods')
+    ax3.set_ylabel('Absolute Difference In Stock Prices')
+    plt.savefig('pngfiles/absolute_difference_stock_prices.png', dpi=300)
+
+    plt.show()
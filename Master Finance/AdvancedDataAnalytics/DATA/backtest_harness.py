@@ -0,0 +1,235 @@
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import os
+import numpy as np
+from batch_simulator import BatchMarketSimulator
+from market_paths import (MarketPathLibrary, WIN_THRESHOLD, backtest, constant_weights, model_strategy,
+                          random_trade_strategy)
+from rng_streams import spawn_generators
+from scenes_ai import InvestmentScene
+
+'''Model used by the 'model' strategy, an artifact (see model_artifact.py) keeps TensorFlow out of the workers.'''
+MODEL_PATH = '../DATA/model/model1_artifact'
+
+'''Quantiles of the final portfolio value reported for every strategy.'''
+QUANTILES = (0.05, 0.25, 0.5, 0.75, 0.95)
+
+
+def model(session, rng):
+    '''Strategy factory of the trained model, see market_paths.model_strategy.'''
+    return model_strategy(session)
+
+
+def cash(session, rng):
+    '''Strategy factory keeping the whole portfolio in cash.'''
+    return constant_weights([0, 0, 1])
+
+
+def random_trades(session, rng):
+    '''Strategy factory of the random baseline of ML.random_games, see market_paths.random_trade_strategy.'''
+    return random_trade_strategy(rng)
+
+
+def random_weights(session, rng):
+    '''Strategy factory drawing uniformly random weights for every portfolio and period.'''
+    return lambda history, holdings: rng.dirichlet(np.ones(3), size=len(history))
+
+
+'''Strategies run by default, name -> factory(session, rng) returning a market_paths.backtest strategy.'''
+STRATEGIES = {'model': model, 'random': random_trades, 'cash': cash}
+
+# Per-process state, set once by _init_worker
+_worker = {}
+
+
+def load_session(model_path):
+    '''Load a predictor of raw windows: a ModelArtifact, a NumpyModel for .npz exports or an InferenceSession.'''
+    if os.path.exists(os.path.join(model_path, 'manifest.json')):
+        from model_artifact import load_artifact
+        return load_artifact(model_path)
+    if model_path.endswith('.npz'):
+        from numpy_model import NumpyModel
+        return NumpyModel.load(model_path)
+    from inference import InferenceSession
+    return InferenceSession(model_path, scaler_path=None)  # A SavedModel taking raw inputs
+
+
+def _init_worker(model_path, library_dir):
+    '''Process-pool initializer: load the model, the simulator and the market library once per worker.'''
+    _worker['session'] = load_session(model_path)
+    _worker['simulator'] = BatchMarketSimulator(InvestmentScene())
+    _worker['library'] = MarketPathLibrary(library_dir) if library_dir is not None else None
+
+
+def _run_batch(batch, batch_size, seed, strategies):
+    '''Run every strategy on the same market paths of one batch of games.
+
+    Batch i simulates its paths from child i of the seed, or reads games
+    i * batch_size to (i + 1) * batch_size of the library.
+
+    Returns:
+        dict: Final portfolio values of the batch per strategy name.
+    '''
+    market_rng, strategy_rng = spawn_generators(seed, 2, start=2 * batch)
+    if _worker['library'] is not None:
+        paths = np.asarray(_worker['library'].paths[batch * batch_size:(batch + 1) * batch_size])
+    else:
+        paths = _worker['simulator'].simulate(batch_size, market_rng, offset=batch * batch_size)
+
+    results = {}
+    for name, factory in strategies.items():
+        strategy = factory(_worker['session'], strategy_rng)
+        results[name] = backtest(paths, strategy, batch_size=batch_size)
+    return results
+
+
+def bootstrap_ci(values, statistic, n_boot=1000, confidence=0.95, rng=None, chunk=100):
+    '''Percentile bootstrap confidence interval of a statistic.
+
+    Args:
+        values (ndarray): Sample of shape (n,).
+        statistic (callable): statistic(samples) computing one value per row of a (replicas, n) array.
+        n_boot (int): Number of bootstrap replicas. Default is 1000.
+        confidence (float): Confidence level. Default is 0.95.
+        rng (numpy.random.Generator): Random generator of the resampling.
+        chunk (int): Number of replicas resampled at a time, bounding the memory use. Default is 100.
+
+    Returns:
+        tuple: Lower and upper bound of the interval.
+    '''
+    rng = np.random.default_rng() if rng is None else rng
+    replicas = []
+    for start in range(0, n_boot, chunk):
+        resamples = values[rng.integers(0, len(values), (min(chunk, n_boot - start), len(values)))]
+        replicas.append(statistic(resamples))
+    replicas = np.concatenate(replicas)
+    alpha = (1 - confidence) / 2
+    low, high = np.quantile(replicas, [alpha, 1 - alpha])
+    return float(low), float(high)
+
+
+def summarize(values, threshold=WIN_THRESHOLD, quantiles=QUANTILES, n_boot=1000, confidence=0.95, seed=None):
+    '''Summarize the final portfolio values of one strategy with bootstrap confidence intervals.
+
+    Args:
+        values (ndarray): Final portfolio values.
+        threshold (float): Final value of a winning game. Default is WIN_THRESHOLD.
+        quantiles (tuple): Reported quantiles of the final value. Default is QUANTILES.
+        n_boot (int): Number of bootstrap replicas. Default is 1000.
+        confidence (float): Confidence level of the intervals. Default is 0.95.
+        seed (int): Seed of the resampling.
+
+    Returns:
+        dict: Number of games, and for the win rate, the mean and every quantile a (value, (low, high)) pair.
+    '''
+    values = np.asarray(values)
+    rng = np.random.default_rng(seed)
+    ci = lambda statistic: bootstrap_ci(values, statistic, n_boot, confidence, rng)
+    summary = {'games': len(values),
+               'win_rate': (float(np.mean(values > threshold)), ci(lambda s: np.mean(s > threshold, axis=1))),
+               'mean': (float(values.mean()), ci(lambda s: s.mean(axis=1)))}
+    for q in quantiles:
+        summary[f'q{q:g}'] = (float(np.quantile(values, q)), ci(lambda s: np.quantile(s, q, axis=1)))
+    return summary
+
+
+def _precise_enough(summaries, win_rate_width, mean_width):
+    '''Return True once the win rate and mean intervals of every strategy are narrower than the targets.'''
+    for summary in summaries.values():
+        (_, (low, high)), (_, (mean_low, mean_high)) = summary['win_rate'], summary['mean']
+        if high - low > win_rate_width or mean_high - mean_low > mean_width:
+            return False
+    return True
+
+
+def run_backtest(strategies=None, seed=None, batch_size=1000, min_games=2000, max_games=100000, n_workers=1,
+                 win_rate_width=0.02, mean_width=2000, model_path=MODEL_PATH, library_dir=None,
+                 n_boot=1000, confidence=0.95, check_growth=1.5, verbose=True):
+    '''Backtest strategies on common market paths until the confidence intervals are narrow enough.
+
+    Batches of games are run in a process pool (each worker loads the model once), every
+    strategy of a batch plays the same markets. Results are consumed in batch order, so the
+    outcome only depends on the seed, not on the number of workers. The stopping rule is
+    checked after min_games, then every time the number of games has grown by check_growth:
+    the run stops as soon as the win rate and mean intervals of all strategies are narrower
+    than win_rate_width and mean_width, or at max_games. Each check bootstraps all games so
+    far, the geometric schedule keeps their total cost proportional to the final number of games.
+
+    Args:
+        strategies (dict): Name -> module-level factory(session, rng), see STRATEGIES (the default).
+        seed (int): Seed of the markets and of the random strategies.
+        batch_size (int): Number of games per task. Default is 1000.
+        min_games (int): Games played before the stopping rule is checked. Default is 2000.
+        max_games (int): Largest number of games. Default is 100000.
+        n_workers (int): Number of worker processes, 1 runs in this process. Default is 1.
+        win_rate_width (float): Target width of the win rate intervals. Default is 0.02.
+        mean_width (float): Target width of the mean final value intervals. Default is 2000.
+        model_path (str): Model of the 'model' strategy, see load_session. Default is MODEL_PATH.
+        library_dir (str): Stored market paths to replay (see market_paths.py), None simulates new ones.
+        n_boot (int): Number of bootstrap replicas. Default is 1000.
+        confidence (float): Confidence level of the intervals. Default is 0.95.
+        check_growth (float): Growth factor of the number of games between two checks. Default is 1.5.
+        verbose (bool): Print the progress. Default is True.
+
+    Returns:
+        dict: Summary per strategy name, see summarize.
+    '''
+    strategies = STRATEGIES if strategies is None else strategies
+    if library_dir is not None:
+        max_games = min(max_games, len(MarketPathLibrary(library_dir)))
+    n_batches = -(-max_games // batch_size)
+    values = {name: [] for name in strategies}
+    next_check = min_games
+
+    def consume(results):
+        '''Add the results of the next batch, return True once the intervals are narrow enough.'''
+        nonlocal next_check
+        for name, batch_values in results.items():
+            values[name].append(batch_values)
+        n_games = sum(len(batch_values) for batch_values in values[next(iter(strategies))])
+        if n_games < next_check:
+            return False
+        next_check = n_games * check_growth
+        # Quantile intervals are only computed for the final report
+        summaries = {name: summarize(np.concatenate(strategy_values), quantiles=(), n_boot=n_boot,
+                                     confidence=confidence, seed=seed)
+                     for name, strategy_values in values.items()}
+        if verbose:
+            print(f'{n_games} games: ' + ', '.join(f'{name} win rate {summary["win_rate"][0]:.3f}'
+                                                   for name, summary in summaries.items()))
+        return _precise_enough(summaries, win_rate_width, mean_width)
+
+    if n_workers <= 1:
+        _init_worker(model_path, library_dir)
+        for batch in range(n_batches):
+            if consume(_run_batch(batch, batch_size, seed, strategies)):
+                break
+    else:
+        with ProcessPoolExecutor(n_workers, initializer=_init_worker, initargs=(model_path, library_dir)) as pool:
+            pending = {}
+            finished = {}
+            next_batch = next_result = 0
+            stop = False
+            while not stop and next_result < n_batches:
+                # Keep every worker busy, then consume the finished batches in order
+                while next_batch < n_batches and len(pending) < 2 * n_workers:
+                    pending[pool.submit(_run_batch, next_batch, batch_size, seed, strategies)] = next_batch
+                    next_batch += 1
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    finished[pending.pop(future)] = future.result()
+                while not stop and next_result in finished:
+                    stop = consume(finished.pop(next_result))
+                    next_result += 1
+            for future in pending:
+                future.cancel()
+
+    return {name: summarize(np.concatenate(strategy_values), n_boot=n_boot, confidence=confidence, seed=seed)
+            for name, strategy_values in values.items()}
+
+
+if __name__ == '__main__':
+    report = run_backtest(seed=42, n_workers=4)
+    for name, summary in report.items():
+        print(f'{name}: {summary["games"]} games')
+        for statistic, (value, (low, high)) in list(summary.items())[1:]:
+            print(f'    {statistic}: {value:.4f} [{low:.4f}, {high:.4f}]')
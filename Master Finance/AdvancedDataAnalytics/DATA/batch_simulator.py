@@ -0,0 +1,132 @@
+import numpy as np
+from shocks import IIDShocks
+
+# Column order of the simulated market paths, matching the model inputs
+MARKET_COLUMNS = ['Stock_Price', 'Bond_Price', 'Fed_Rate', 'Inflation']
+
+# generate_initial_data records the initial state plus 11 'end_turn' calls
+BURN_IN_PERIODS = 12
+
+
+class BatchMarketSimulator:
+    '''Vectorized market simulator running many games in lockstep.
+
+    The simulator reproduces the ARMA(1,1) dynamics of InvestmentScene.generate_next_data
+    (inflation, Fed rate, stock and bond prices) and the burn-in of generate_initial_data,
+    but advances N games at once with NumPy arrays instead of one game with Python floats.
+    Prices are exogenous in the game (trades never move them), so the market paths can be
+    simulated independently of the portfolio decisions.
+
+    Attributes:
+        n_periods (int): Number of playable periods after the burn-in.
+        n_states (int): Total number of recorded states per game (burn-in included).
+        shocks (object): Shock source drawing the random inputs, see the shocks module.
+    '''
+
+    def __init__(self, scene, n_periods=None, shocks=None):
+        '''Copy the market parameters from the given scene.
+
+        Args:
+            scene (InvestmentScene): Scene whose parameters define the market dynamics.
+            n_periods (int): Number of playable periods. Default is scene.MAX_PERIODS.
+            shocks (object): Shock source, e.g. AntitheticShocks or SobolShocks for variance
+                reduction. Default is IIDShocks.
+        '''
+        self.n_periods = scene.MAX_PERIODS if n_periods is None else n_periods
+        self.n_states = BURN_IN_PERIODS + self.n_periods
+        self.shocks = IIDShocks() if shocks is None else shocks
+
+        for name in ('inflation', 'fed_rate', 'stock', 'bond'):
+            for param in ('mean', 'sigma', 'ar_coef', 'ma_coef'):
+                setattr(self, f'{name}_{param}', getattr(scene, f'{name}_{param}'))
+        for name in ('stock', 'bond'):
+            for param in ('inflation_coef', 'fed_rate_coef'):
+                setattr(self, f'{name}_{param}', getattr(scene, f'{name}_{param}'))
+
+    def draw_shocks(self, num_games, rng, offset=0):
+        '''Draw the standardized random inputs of num_games games from the shock source.
+
+        Row 0 holds the draws of the initial state, row t the draws of period t.
+        Columns 0 and 1 (inflation, Fed rate) are uniform on [0, 1), columns 2 and 3
+        (stock, bond) are standard normal.
+
+        Args:
+            num_games (int): Number of games.
+            rng (numpy.random.Generator): Random generator to draw from.
+            offset (int): Index of the first game in the whole run, for sources that split a run into chunks.
+
+        Returns:
+            numpy.ndarray: Shocks of shape (num_games, n_states, 4).
+        '''
+        return self.shocks.draw(num_games, self.n_states, rng, offset)
+
+    def simulate(self, num_games, rng=None, offset=0):
+        '''Simulate num_games market paths.
+
+        Args:
+            num_games (int): Number of games to simulate.
+            rng (numpy.random.Generator): Random generator. Default is a freshly seeded one.
+            offset (int): Index of the first game in the whole run. Default is 0.
+
+        Returns:
+            numpy.ndarray: Paths of shape (num_games, n_states, 4), columns as in MARKET_COLUMNS.
+        '''
+        if rng is None:
+            rng = np.random.default_rng()
+        return self.run(self.draw_shocks(num_games, rng, offset))
+
+    def run(self, shocks):
+        '''Propagate the market dynamics for the given standardized shocks.
+
+        Args:
+            shocks (numpy.ndarray): Shocks of shape (num_games, n_states, 4), see draw_shocks.
+
+        Returns:
+            numpy.ndarray: Paths of shape (num_games, n_states, 4), columns as in MARKET_COLUMNS.
+        '''
+        num_games = shocks.shape[0]
+        paths = np.empty((num_games, self.n_states, 4))
+        stock, bond, fed_rate, inflation = (paths[:, :, i] for i in range(4))
+
+        # Initial state, same distributions as generate_initial_data
+        inflation[:, 0] = 0.02 + 0.03 * shocks[:, 0, 0]
+        fed_rate[:, 0] = 0.1 * shocks[:, 0, 1]
+        stock[:, 0] = self._lognormal(self.stock_mean, self.stock_sigma, shocks[:, 0, 2])
+        bond[:, 0] = self._lognormal(self.bond_mean, self.bond_sigma, shocks[:, 0, 3])
+
+        for t in range(1, self.n_states):
+            inflation_change = inflation[:, t - 1] - self.inflation_mean
+            fed_rate_change = fed_rate[:, t - 1] - self.fed_rate_mean
+
+            # Inflation
+            mean = self.inflation_ar_coef * inflation[:, t - 1] + (1 - self.inflation_ar_coef) * self.inflation_mean
+            error = -0.01 * fed_rate[:, t - 1] + (0.2 * shocks[:, t, 0] - 0.1) \
+                - self.stock_fed_rate_coef * fed_rate_change - self.stock_inflation_coef * inflation_change
+            inflation[:, t] = inflation[:, t - 1] * self.inflation_ma_coef * error + mean + error
+
+            # Federal Reserve Rate, variation limited to 2.5% per year
+            mean = self.fed_rate_ar_coef * fed_rate[:, t - 1] + (1 - self.fed_rate_ar_coef) * self.fed_rate_mean \
+                + np.clip(0.25 * inflation_change, -0.025, 0.025)
+            error = 0.2 * shocks[:, t, 1] - 0.1
+            fed_rate[:, t] = np.clip(fed_rate[:, t - 1] * self.fed_rate_ma_coef * error + mean + error, 0, 0.1)
+
+            # Stock Prices
+            mean = self.stock_ar_coef * stock[:, t - 1] + (1 - self.stock_ar_coef) * self.stock_mean \
+                + self.stock_inflation_coef * inflation_change + self.stock_fed_rate_coef * fed_rate_change
+            error = self.stock_sigma * shocks[:, t, 2]
+            stock[:, t] = stock[:, t - 1] * self.stock_ma_coef * error + mean + error
+
+            # Bond Prices
+            mean = self.bond_ar_coef * bond[:, t - 1] + (1 - self.bond_ar_coef) * self.bond_mean \
+                + self.bond_inflation_coef * inflation_change + self.bond_fed_rate_coef * fed_rate_change
+            error = self.bond_sigma * shocks[:, t, 3]
+            bond[:, t] = bond[:, t - 1] * self.bond_ma_coef * error + mean + error
+
+        return paths
+
+    @staticmethod
+    def _lognormal(mean, sigma, z):
+        '''Log-normal draw with the given mean and standard deviation from standard normal z.'''
+        mu = np.log(mean ** 2 / np.sqrt(sigma ** 2 + mean ** 2))
+        s = np.sqrt(np.log(sigma ** 2 / mean ** 2 + 1))
+        return np.exp(mu + s * z)
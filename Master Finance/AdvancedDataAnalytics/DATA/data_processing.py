@@ -1,8 +1,63 @@
-import random
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
 import numpy as np
-import pandas as pd
+from numpy.lib.recfunctions import structured_to_unstructured
+from numpy.lib.stride_tricks import sliding_window_view
 from sklearn.model_selection import train_test_split
 from sklearn.preprocessing import MinMaxScaler
+from batch_simulator import BatchMarketSimulator, MARKET_COLUMNS, BURN_IN_PERIODS
+from rng_streams import as_seed_sequence, spawn_seeds
+from dataset_cache import DatasetCache
+from telemetry import DEBUG, TelemetryRecorder
+
+
+def _play_games(data, scene, n_periods, seed_sequence, start, stop, first_game=0):
+    '''Play games start to stop with random decisions and write their states into data.
+
+    Args:
+        data (numpy.ndarray): Structured output array of shape (num_games, states).
+        scene (InvestmentScene): Scene used to play the games.
+        n_periods (int): Number of periods played per game.
+        seed_sequence (SeedSequence): Root seed, game i uses its child i.
+        start (int): Index of the first game.
+        stop (int): Index after the last game.
+        first_game (int): Index of the game in the first row of data. Default is 0.
+    '''
+    for i, game_seed in enumerate(spawn_seeds(seed_sequence, stop - start, start), start):
+        # Separate streams for the market and the decisions, so the market only depends on the seed
+        market_seed, decision_seed = game_seed.spawn(2)
+        rng = np.random.default_rng(decision_seed)
+        scene.seed(market_seed)
+        scene.reset_game()
+
+        for _ in range(n_periods):
+            decision = rng.choice(['buy_stock', 'buy_bond', 'increase_cash'])
+            total_value = scene.get_portfolio_value()
+            change = rng.uniform(0.1, 0.4)
+            change_amount = total_value * change
+
+            scene.handle_events(decision, change_amount)
+            scene.handle_events("end_turn", 0)
+
+        data[i - first_game] = scene.get_state()
+
+
+def _simulate_games(data, simulator, seed, start, stop, first_game=0):
+    '''Simulate the market paths of games start to stop from one random stream and write them into data.
+
+    first_game is the index of the game in the first row of data.
+    '''
+    data[start - first_game:stop - first_game] = simulator.simulate(stop - start, np.random.default_rng(seed),
+                                                                    offset=start)
+
+
+def _fill_shared(shm_name, shape, dtype, fill, *args):
+    '''Process-pool task: attach the shared-memory output array and let fill write its shard.'''
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        fill(np.ndarray(shape, dtype=dtype, buffer=shm.buf), *args)
+    finally:
+        shm.close()
 
 
 class DataProcessing:
@@ -15,87 +70,408 @@ class DataProcessing:
         scene (object): An instance of the game scene.
         n_periods (int): Maximum number of periods in the game.
         scaler_X (MinMaxScaler): Scaler used to normalize input data.
+        scaler_sequence (MinMaxScaler): Per-feature scaler of the whole-game sequences, see get_sequence_split.
+        simulator (BatchMarketSimulator): Vectorized simulator of the scene's market.
+        seed_sequence (SeedSequence): Root seed, every game or chunk of games gets its own child stream.
+        chunk_size (int): Number of games per shard, and per random stream in generate_market_data.
+        n_workers (int): Number of worker processes, 1 generates the data in this process.
+        input_columns (list): State columns of the input windows.
+        target_columns (list): State columns predicted for the period following a window.
+        cache (DatasetCache): Cache of generated datasets, None disables caching.
+        telemetry (TelemetryRecorder): Recorder whose level controls the progress messages.
     '''
 
-    def __init__(self, scene,rolling_window):
-        '''Initialize the data processing class with the given scene and rolling window.'''
+    def __init__(self, scene,rolling_window, seed=None, chunk_size=1000, n_workers=1, shocks=None,
+                 input_columns=MARKET_COLUMNS, target_columns=('Stock_Price', 'Bond_Price'), cache_dir=None,
+                 telemetry=None):
+        '''Initialize the data processing class with the given scene and rolling window.
+
+        The same seed (and chunk_size) always generates the same dataset, None generates a new one.
+        The number of workers does not change the generated data. shocks is the shock source of
+        the batch simulator (see the shocks module), default is independent draws.
+        Columns outside MARKET_COLUMNS (e.g. 'Cash') make window_shards play the games
+        through the scene instead of the batch simulator. With a cache_dir and a seed, generated
+        datasets are stored there and reused by later runs with the same inputs. Progress messages
+        go through telemetry, the per-chunk ones are only printed at DEBUG.
+        '''
         self.scene = scene
         self.n_periods = self.scene.MAX_PERIODS
         self.scaler_X = MinMaxScaler()
+        self.scaler_sequence = MinMaxScaler()
         self.rolling_window = rolling_window
+        self.simulator = BatchMarketSimulator(self.scene, self.n_periods, shocks)
+        self.seed = seed
+        self.seed_sequence = as_seed_sequence(seed)
+        self.chunk_size = chunk_size
+        self.n_workers = n_workers
+        self.input_columns = list(input_columns)
+        self.target_columns = list(target_columns)
+        # Without a seed every run generates new data, caching it would never pay off
+        self.cache = DatasetCache(cache_dir) if cache_dir is not None and seed is not None else None
+        self.telemetry = TelemetryRecorder() if telemetry is None else telemetry
+
+    def _generate_sharded(self, shape, dtype, fill, tasks):
+        '''Run fill over the shards in tasks and return the assembled output array.
+
+        With several workers the shards run in a process pool and write straight into
+        a shared-memory array, so no game data is pickled back to this process.
+
+        Args:
+            shape (tuple): Shape of the output array.
+            dtype (numpy.dtype): Data type of the output array.
+            fill (callable): Module-level function fill(data, *task) writing one shard into data.
+            tasks (list): Argument tuples of the shards.
+
+        Returns:
+            numpy.ndarray: The output array.
+        '''
+        if self.n_workers <= 1:
+            data = np.empty(shape, dtype=dtype)
+            for done, task in enumerate(tasks, 1):
+                fill(data, *task)
+                self.telemetry.log(f'Chunk {done}/{len(tasks)}', DEBUG, end='\r')
+            return data
+
+        shm = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1))
+        try:
+            with ProcessPoolExecutor(self.n_workers) as pool:
+                futures = [pool.submit(_fill_shared, shm.name, shape, dtype, fill, *task) for task in tasks]
+                for done, future in enumerate(as_completed(futures), 1):
+                    future.result()
+                    self.telemetry.log(f'Chunk {done}/{len(tasks)}', DEBUG, end='\r')
+            return np.ndarray(shape, dtype=dtype, buffer=shm.buf).copy()
+        finally:
+            shm.close()
+            shm.unlink()
 
-    def generate_data(self, num_games=20000):
+    def _chunks(self, num_games, first_game=0):
+        '''Return the (start, stop) game indices of every chunk from first_game on.'''
+        if first_game % self.chunk_size:
+            raise ValueError(f'first_game ({first_game}) must be a multiple of chunk_size ({self.chunk_size})')
+        return [(start, min(start + self.chunk_size, num_games))
+                for start in range(first_game, num_games, self.chunk_size)]
+
+    def generate_data(self, num_games=20000, first_game=0):
         '''Generate data by simulating a number of games (Monte Carlo simulation).
 
         Args:
             num_games (int): The number of games to simulate.
+            first_game (int): Only generate the games from first_game on, a multiple of chunk_size.
+                They are the same as in the full dataset. Default is 0.
+
+        Returns:
+            numpy.ndarray: Structured array of shape (num_games - first_game, periods), row i holding
+                the states of game first_game + i.
+        '''
+        shape = (num_games - first_game, BURN_IN_PERIODS + self.n_periods)
+        tasks = [(self.scene, self.n_periods, self.seed_sequence, start, stop, first_game)
+                 for start, stop in self._chunks(num_games, first_game)]
+        return self._generate_sharded(shape, self.scene.get_state().dtype, _play_games, tasks)
+
+    def generate_market_data(self, num_games=20000, first_game=0):
+        '''Simulate the market paths of a number of games at once (Monte Carlo simulation).
+
+        Unlike generate_data, no portfolio decisions are played: prices do not depend on
+        them, so all games are simulated in lockstep by the batch simulator.
+
+        Args:
+            num_games (int): The number of games to simulate.
+            first_game (int): Only simulate the games from first_game on, a multiple of chunk_size.
+                They are the same as in the full dataset. Default is 0.
+
+        Returns:
+            numpy.ndarray: Market paths of shape (num_games - first_game, periods, 4), with the
+                columns Stock_Price, Bond_Price, Fed_Rate and Inflation.
+        '''
+        shape = (num_games - first_game, self.simulator.n_states, len(MARKET_COLUMNS))
+        chunks = self._chunks(num_games, first_game)
+        seeds = spawn_seeds(self.seed_sequence, len(chunks), first_game // self.chunk_size)
+        tasks = [(self.simulator, seed, start, stop, first_game) for seed, (start, stop) in zip(seeds, chunks)]
+        return self._generate_sharded(shape, np.float64, _simulate_games, tasks)
+
+    def build_windows(self, games_data, columns=MARKET_COLUMNS):
+        '''Turn whole games into rolling-window training examples.
+
+        For every game and every period j from rolling_window on, the input is the window of
+        periods j - rolling_window to j - 1 and the target is period j. The windows are strided
+        views on games_data, the only copy is the final write into X.
+
+        Args:
+            games_data (numpy.ndarray): Games of shape (num_games, periods, features), or a
+                structured array of shape (num_games, periods) as returned by generate_data.
+            columns (list): Names of the features, ignored for structured arrays. Default is MARKET_COLUMNS.
+
+        Returns:
+            tuple: X of shape (samples, rolling_window, inputs) and y of shape (samples, targets).
+        '''
+        if games_data.dtype.names is not None:
+            columns = list(dict.fromkeys(self.input_columns + self.target_columns))
+            games_data = structured_to_unstructured(games_data[columns])
+        columns = list(columns)
+        input_index = [columns.index(column) for column in self.input_columns]
+        target_index = [columns.index(column) for column in self.target_columns]
+
+        # (num_games, windows, features, rolling_window) view, no data is copied
+        windows = sliding_window_view(games_data[:, :-1], self.rolling_window, axis=1)
+        num_games, n_windows = windows.shape[:2]
+
+        X = np.empty((num_games, n_windows, self.rolling_window, len(input_index)), dtype=games_data.dtype)
+        for k, column in enumerate(input_index):
+            X[..., k] = windows[:, :, column]
+        y = games_data[:, self.rolling_window:, target_index]
+
+        return X.reshape(-1, self.rolling_window, len(input_index)), y.reshape(-1, len(target_index))
+
+    def build_sequences(self, games_data, columns=MARKET_COLUMNS):
+        '''Turn whole games into sequence training examples for the stateful model.
+
+        The input of a game is every state but the last, the target after every state is the
+        following period, so a sequence model learns one-step predictions from the whole history.
+
+        Args:
+            games_data (numpy.ndarray): Games of shape (num_games, periods, features), or a
+                structured array of shape (num_games, periods) as returned by generate_data.
+            columns (list): Names of the features, ignored for structured arrays. Default is MARKET_COLUMNS.
+
+        Returns:
+            tuple: X of shape (num_games, periods - 1, inputs) and y of shape (num_games, periods - 1, targets).
+        '''
+        if games_data.dtype.names is not None:
+            columns = list(dict.fromkeys(self.input_columns + self.target_columns))
+            games_data = structured_to_unstructured(games_data[columns])
+        columns = list(columns)
+        input_index = [columns.index(column) for column in self.input_columns]
+        target_index = [columns.index(column) for column in self.target_columns]
+
+        return games_data[:, :-1, input_index], games_data[:, 1:, target_index]
+
+    def _uses_market_data(self):
+        '''Return True if all configured columns can be simulated without playing the games.'''
+        return set(self.input_columns + self.target_columns) <= set(MARKET_COLUMNS)
+
+    def dataset_inputs(self, num_games):
+        '''Return everything the (X, y) dataset of num_games games depends on, the cache key inputs.'''
+        inputs = {'num_games': num_games, 'seed': self.seed_sequence, 'chunk_size': self.chunk_size,
+                  'rolling_window': self.rolling_window, 'input_columns': self.input_columns,
+                  'target_columns': self.target_columns, 'simulator': self.simulator}
+        if not self._uses_market_data():
+            # Played games also depend on the scene's portfolio settings
+            inputs['scene'] = {key: value for key, value in vars(self.scene).items() if key.startswith('starting_')}
+        return inputs
+
+    def window_shards(self, num_games=20000):
+        '''Generate the training examples of num_games games as shards, or load them from the cache.
+
+        Every shard holds the windows of chunk_size games, game after game. The games are
+        generated n_workers chunks at a time and windowed right away, and with a cache the
+        shards are written to disk one at a time and returned as memory maps, so neither the
+        games nor the examples ever need to fit in memory at once.
+
+        Args:
+            num_games (int): The number of games to simulate.
+
+        Returns:
+            list: (X, y) shard pairs, X of shape (samples, rolling_window, inputs) and y of shape (samples, targets).
+        '''
+        key = None
+        if self.cache is not None:
+            key = self.cache.key(self.dataset_inputs(num_games))
+            shards = self.cache.load(key)
+            if shards is not None:
+                self.telemetry.log(f'Loading cached data {key[:12]}')
+                return shards
+
+        self.telemetry.log('Generating data')
+        generate = self.generate_market_data if self._uses_market_data() else self.generate_data
+        step = self.chunk_size * max(self.n_workers, 1)
+
+        def generate_shards():
+            for first_game in range(0, num_games, step):
+                games_data = generate(min(first_game + step, num_games), first_game)
+                for start, stop in self._chunks(len(games_data)):
+                    yield self.build_windows(games_data[start:stop])
+
+        shards = generate_shards()
+        if key is not None:
+            return self.cache.save(key, shards, self.dataset_inputs(num_games))
+        return list(shards)
+
+    def generate_windows(self, num_games=20000):
+        '''Generate the training examples of num_games games, or load them from the cache.
+
+        Args:
+            num_games (int): The number of games to simulate.
+
+        Returns:
+            tuple: Numpy arrays X of shape (samples, rolling_window, inputs) and y of shape (samples, targets).
+        '''
+        return self.load_shards(self.window_shards(num_games), scale=False)
+
+    def split_shards(self, shards, test_size=0.2):
+        '''Split every shard by game into a train part and a test part.
+
+        The last games of every shard go to the test part. The games are independent draws,
+        so they are as random a sample as any, and the windows of one game never end up on
+        both sides. The parts are views of the shards, memory-mapped shards stay on disk.
+
+        Args:
+            shards (list): (X, y) shard pairs, see window_shards.
+            test_size (float): Proportion of the games of every shard in the test part.
 
         Returns:
-            list: A list of game data, each element representing a game.
+            tuple: Lists of (X, y) pairs of the train parts and of the test parts.
         '''
-        data_list = []
+        windows_per_game = self.simulator.n_states - self.rolling_window
+        train_shards, test_shards = [], []
+        for X, y in shards:
+            n_games = len(X) // windows_per_game
+            split = (n_games - int(round(n_games * test_size))) * windows_per_game
+            train_shards.append((X[:split], y[:split]))
+            test_shards.append((X[split:], y[split:]))
+        return train_shards, test_shards
 
-        for i in range(num_games):
-            self.scene.reset_game()
-            game_data = []
-            print(f'Game {i + 1}/{num_games}', end='\r')
+    def load_shards(self, shards, scale=True, rows=None):
+        '''Copy shards into one pair of in-memory arrays.
 
-            for _ in range(self.n_periods):
-                decision = random.choice(['buy_stock', 'buy_bond', 'increase_cash'])
-                total_value = self.scene.get_portfolio_value()
-                np.array(self.scene.get_portfolio_weights()).reshape(1, -1)
-                change = random.uniform(0.1, 0.4)
-                change_amount = total_value * change
+        Args:
+            shards (list): (X, y) shard pairs, see window_shards.
+            scale (bool): Apply the fitted scaler_X to the inputs. Default is True.
+            rows (list): Boolean mask of the rows copied from every shard. Default is all rows.
 
-                self.scene.handle_events(decision, change_amount)
-                self.scene.handle_events("end_turn", 0)
+        Returns:
+            tuple: Numpy arrays X of shape (samples, rolling_window, inputs) and y of shape (samples, targets).
+        '''
+        X_first, y_first = shards[0]
+        n_samples = sum(len(X) for X, _ in shards) if rows is None else sum(int(mask.sum()) for mask in rows)
+        X_all = np.empty((n_samples,) + X_first.shape[1:], dtype=X_first.dtype)
+        y_all = np.empty((n_samples,) + y_first.shape[1:], dtype=y_first.dtype)
+        position = 0
+        for k, (X, y) in enumerate(shards):
+            if rows is not None:
+                # One shard is gathered at a time
+                X, y = X[rows[k]], y[rows[k]]
+            X_all[position:position + len(X)] = X
+            y_all[position:position + len(X)] = y
+            position += len(X)
+        if scale:
+            self.scale_in_place(X_all)
+        return X_all, y_all
 
-            game_states = self.scene.get_state()
+    def fit_scaler(self, X, batch_size=100000):
+        '''Fit scaler_X incrementally, batch by batch, on the flattened windows.
 
-            if isinstance(game_states, list):
-                game_data.extend(game_states)
-            elif isinstance(game_states, dict):
-                game_data.append(game_states)
-            else:
-                raise ValueError('Unexpected type for game_states')
+        The MinMax statistics are updated with partial_fit, so X can be a memory map or a
+        list of shards larger than the available memory.
 
-            data_list.append(game_data)
+        Args:
+            X (numpy.ndarray or list): Inputs of shape (samples, rolling_window, inputs), or a list of such shards.
+            batch_size (int): Number of examples loaded at a time. Default is 100000.
 
-        return data_list
+        Returns:
+            MinMaxScaler: The fitted scaler_X.
+        '''
+        self.scaler_X = MinMaxScaler(feature_range=self.scaler_X.feature_range)
+        for shard in (X if isinstance(X, list) else [X]):
+            for start in range(0, len(shard), batch_size):
+                batch = np.asarray(shard[start:start + batch_size])
+                self.scaler_X.partial_fit(batch.reshape(batch.shape[0], -1))
+        return self.scaler_X
 
-    def get_train_test_split(self, test_size=0.2, random_state=42):
+    def scale_in_place(self, X, batch_size=100000):
+        '''Apply the fitted scaler_X to X in place, batch by batch, without a transformed copy.
+
+        Args:
+            X (numpy.ndarray): Writable float inputs of shape (samples, rolling_window, inputs).
+            batch_size (int): Number of examples scaled at a time. Default is 100000.
+
+        Returns:
+            numpy.ndarray: X, now scaled.
+        '''
+        # Same operations as MinMaxScaler.transform
+        scale = self.scaler_X.scale_.reshape(X.shape[1:])
+        offset = self.scaler_X.min_.reshape(X.shape[1:])
+        for start in range(0, len(X), batch_size):
+            batch = X[start:start + batch_size]
+            batch *= scale
+            batch += offset
+        return X
+
+    def get_shard_split(self, test_size=0.2, num_games=20000):
+        '''Generate train and test shards from the game data and fit scaler_X on the train shards.
+
+        Nothing is loaded in memory: the shards are scaled when they are read, see
+        streaming.make_shard_dataset and load_shards.
+
+        Args:
+            test_size (float): Proportion of the games to include in the test split.
+            num_games (int): The number of games to simulate.
+
+        Returns:
+            tuple: Lists of (X, y) pairs of the train shards and of the test shards, see split_shards.
+        '''
+        train_shards, test_shards = self.split_shards(self.window_shards(num_games), test_size)
+        # We fit first to make sure there is no difference in the scaling
+        self.fit_scaler([X for X, _ in train_shards])
+        return train_shards, test_shards
+
+    def get_train_test_split(self, test_size=0.2, random_state=42, num_games=20000):
         '''Generate train and test splits from the game data.
 
+        Games are split, not windows, so the overlapping windows of one game never end up on
+        both sides: random_state draws the test games of every shard. Each split is copied
+        once from the shards, one shard at a time.
+
         Args:
-            test_size (float): Proportion of the dataset to include in the test split.
+            test_size (float): Proportion of the games to include in the test split.
             random_state (int): Random seed for train-test split.
+            num_games (int): The number of games to simulate.
 
         Returns:
             tuple: Numpy arrays for X_train, X_test, y_train, y_test.
         '''
-        print('Generating data')
-        games_data = self.generate_data()
-        print('Done generating data')
-        print('Generating training examples')
+        shards = self.window_shards(num_games)
+        windows_per_game = self.simulator.n_states - self.rolling_window
+        rng = np.random.default_rng(random_state)
+        test_rows = []
+        for X, _ in shards:
+            n_games = len(X) // windows_per_game
+            test_games = np.zeros(n_games, dtype=bool)
+            test_games[rng.choice(n_games, int(round(n_games * test_size)), replace=False)] = True
+            test_rows.append(np.repeat(test_games, windows_per_game))
+        X_train, y_train = self.load_shards(shards, scale=False, rows=[~rows for rows in test_rows])
+        X_test, y_test = self.load_shards(shards, scale=False, rows=test_rows)
 
-        X = []
-        y = []
+        # We fit first to make sure there is no difference in the scaling
+        self.fit_scaler(X_train)
+        self.scale_in_place(X_train)
+        self.scale_in_place(X_test)
 
-        nb_games = len(games_data)
-        for i, game_data in enumerate(games_data):
-            game_data_df = pd.DataFrame(game_data)
-            print(f'Game {i + 1}/{nb_games}', end='\r')
-            for j in range(self.rolling_window, len(game_data_df)):
-                X.append(game_data_df.iloc[j - self.rolling_window:j][['Stock_Price', 'Bond_Price', 'Fed_Rate', 'Inflation']].values)
-                y.append(game_data_df.iloc[j][['Stock_Price','Bond_Price']].values)
+        return X_train, X_test, y_train, y_test
+
+    def get_sequence_split(self, test_size=0.2, random_state=42, num_games=20000):
+        '''Generate train and test splits of whole-game sequences, for nn_model.create_sequence_model.
 
-        X = np.array(X)
-        y = np.array(y)
+        Games are split, not periods, and the inputs are scaled per feature with scaler_sequence,
+        so one new observation can be scaled on its own at prediction time.
 
+        Args:
+            test_size (float): Proportion of the games to include in the test split.
+            random_state (int): Random seed for train-test split.
+            num_games (int): The number of games to simulate.
+
+        Returns:
+            tuple: Numpy arrays for X_train, X_test, y_train, y_test, of shape (games, periods - 1, features).
+        '''
+        if self._uses_market_data():
+            games_data = self.generate_market_data(num_games)
+        else:
+            games_data = self.generate_data(num_games)
+        X, y = self.build_sequences(games_data)
         X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=test_size, random_state=random_state)
-        # We fit first to make sure there is no difference in the scaling
-        X_train = self.scaler_X.fit_transform(X_train.reshape(X_train.shape[0], -1)).reshape(X_train.shape)
-        X_test = self.scaler_X.transform(X_test.reshape(X_test.shape[0], -1)).reshape(X_test.shape)
 
+        n_features = X.shape[-1]
+        self.scaler_sequence = MinMaxScaler(feature_range=self.scaler_sequence.feature_range)
+        X_train = self.scaler_sequence.fit_transform(X_train.reshape(-1, n_features)).reshape(X_train.shape)
+        X_test = self.scaler_sequence.transform(X_test.reshape(-1, n_features)).reshape(X_test.shape)
 
         return X_train, X_test, y_train, y_test
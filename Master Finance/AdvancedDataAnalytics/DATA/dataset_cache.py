@@ -0,0 +1,128 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+
+# Bump when the data generation code changes, so older cached datasets are not reused
+CACHE_VERSION = 1
+
+
+def fingerprint(obj):
+    '''Return a JSON-serializable description of obj that identifies its content.
+
+    Arrays are replaced by the hash of their data, objects by their class name and attributes.
+    Private attributes (leading underscore) are caches, not content, and are left out.
+
+    Args:
+        obj: Value, array, sequence, dict or object to describe.
+
+    Returns:
+        A structure of dicts, lists, strings and numbers.
+    '''
+    if isinstance(obj, np.ndarray):
+        return {'shape': list(obj.shape), 'dtype': str(obj.dtype),
+                'sha256': hashlib.sha256(np.ascontiguousarray(obj).tobytes()).hexdigest()}
+    if isinstance(obj, np.random.SeedSequence):
+        return {'entropy': str(obj.entropy), 'spawn_key': list(obj.spawn_key)}
+    if isinstance(obj, dict):
+        return {str(key): fingerprint(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [fingerprint(value) for value in obj]
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if obj is None or isinstance(obj, (bool, int, float, str)):
+        return obj
+    return {'type': type(obj).__name__,
+            'attributes': fingerprint({key: value for key, value in vars(obj).items() if not key.startswith('_')})}
+
+
+class DatasetCache:
+    '''On-disk cache of generated (X, y) datasets, addressed by the hash of their generation inputs.
+
+    Every dataset lives in <cache_dir>/<key>/ as X_<i>.npy and y_<i>.npy shards, plus a
+    manifest.json recording the inputs. Shards are written one at a time and loaded as
+    read-only memory maps, so neither side needs the whole dataset in memory.
+
+    Attributes:
+        cache_dir (str): Root directory of the cache.
+    '''
+
+    def __init__(self, cache_dir):
+        '''Initialize the cache in cache_dir, created on the first save.'''
+        self.cache_dir = cache_dir
+
+    @staticmethod
+    def key(inputs):
+        '''Return the cache key (hex SHA-256) of the generation inputs.
+
+        Args:
+            inputs (dict): Everything the dataset depends on, see fingerprint.
+
+        Returns:
+            str: The key.
+        '''
+        description = json.dumps({'version': CACHE_VERSION, 'inputs': fingerprint(inputs)}, sort_keys=True)
+        return hashlib.sha256(description.encode()).hexdigest()
+
+    def path(self, key):
+        '''Return the directory of the dataset with the given key.'''
+        return os.path.join(self.cache_dir, key)
+
+    def load(self, key):
+        '''Load the shards of a cached dataset.
+
+        Args:
+            key (str): Cache key.
+
+        Returns:
+            list: (X, y) memory-mapped shard pairs in order, or None if the key is not cached.
+        '''
+        path = self.path(key)
+        manifest_file = os.path.join(path, 'manifest.json')
+        if not os.path.exists(manifest_file):
+            return None
+
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+        return [(np.load(os.path.join(path, f'X_{i:05d}.npy'), mmap_mode='r'),
+                 np.load(os.path.join(path, f'y_{i:05d}.npy'), mmap_mode='r'))
+                for i in range(manifest['n_shards'])]
+
+    def save(self, key, shards, inputs=None):
+        '''Store a dataset under the given key.
+
+        The shards are written to a temporary directory which is then renamed, so an
+        interrupted save never leaves a partial dataset behind.
+
+        Args:
+            key (str): Cache key.
+            shards (iterable): (X, y) array pairs, consumed one at a time.
+            inputs (dict): Generation inputs recorded in the manifest.
+
+        Returns:
+            list: The stored (X, y) shards as memory maps, see load.
+        '''
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = tempfile.mkdtemp(dir=self.cache_dir, prefix='.tmp_')
+        try:
+            n_shards = n_examples = 0
+            for X, y in shards:
+                np.save(os.path.join(tmp_path, f'X_{n_shards:05d}.npy'), X)
+                np.save(os.path.join(tmp_path, f'y_{n_shards:05d}.npy'), y)
+                n_shards += 1
+                n_examples += len(X)
+
+            manifest = {'version': CACHE_VERSION, 'n_shards': n_shards, 'n_examples': n_examples,
+                        'inputs': fingerprint(inputs)}
+            with open(os.path.join(tmp_path, 'manifest.json'), 'w') as f:
+                json.dump(manifest, f, indent=2)
+
+            os.replace(tmp_path, self.path(key))
+        except OSError:
+            # Another process stored the same key in the meantime, its copy is identical
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            if not os.path.exists(self.path(key)):
+                raise
+        return self.load(key)
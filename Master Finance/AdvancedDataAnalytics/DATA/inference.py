@@ -0,0 +1,164 @@
+import pickle
+import time
+import numpy as np
+import tensorflow as tf
+from nn_model import add_scaling, create_stateful_model
+
+# The trained model takes scaled inputs, its scaler is fused in on load (see nn_model.add_scaling)
+MODEL_PATH = '../DATA/model/model1'
+SCALER_PATH = '../DATA/model/scaler.pkl'
+# Model with the MinMax scaling fused in
+SEQUENCE_MODEL_PATH = '../DATA/model/sequence_model'
+
+
+def load_fused_model(model_path, scaler_path=None):
+    '''Load a model taking raw inputs.
+
+    Args:
+        model_path (str): The path of a model with fused scaling, or of a model taking scaled inputs.
+        scaler_path (str): The pickled scaler of a model without fused scaling, fused on load. Default is None.
+
+    Returns:
+        tf.keras.Model: The model with a MinMaxScaling input layer.
+    '''
+    model = tf.keras.models.load_model(model_path)
+    if scaler_path is not None:
+        with open(scaler_path, 'rb') as f:
+            model = add_scaling(model, pickle.load(f))
+    return model
+
+
+class InferenceSession:
+    '''Trained model loaded once, with a compiled prediction path.
+
+    model.predict builds a data adapter and runs callbacks on every call, which dominates the
+    latency of a single prediction. The session instead traces one tf.function with a fixed
+    input signature (any batch size, ROLLING_WINDOW x features) and calls the model directly.
+    The model takes raw windows, its MinMax scaling is part of the graph.
+
+    Attributes:
+        model (tf.keras.Model): The loaded model, with fused scaling.
+        rolling_window (int): Number of periods per window.
+        n_features (int): Number of features per period.
+    '''
+
+    def __init__(self, model_path=MODEL_PATH, scaler_path=SCALER_PATH):
+        '''Load the model and build the compiled prediction function.
+
+        Args:
+            model_path (str): The path from where the model should be loaded.
+            scaler_path (str): The pickled scaler of a model saved without fused scaling, None for a
+                model with fused scaling. Default is SCALER_PATH, the scaler of MODEL_PATH.
+        '''
+        self.model = load_fused_model(model_path, scaler_path)
+        self.rolling_window, self.n_features = self.model.input_shape[1:]
+        self._predict = tf.function(
+            self._forward,
+            input_signature=[tf.TensorSpec(shape=(None, self.rolling_window, self.n_features), dtype=tf.float32)])
+
+    def _forward(self, windows):
+        '''Run the model in inference mode.'''
+        return self.model(windows, training=False)
+
+    def predict(self, windows):
+        '''Predict the next stock and bond prices.
+
+        Args:
+            windows (ndarray): Unscaled window of shape (rolling_window, n_features), or a batch
+                of shape (batch, rolling_window, n_features).
+
+        Returns:
+            ndarray: Predicted prices of shape (2,) for one window, (batch, 2) for a batch.
+        '''
+        windows = np.asarray(windows, dtype=np.float32)
+        if windows.ndim == 2:
+            return self._predict(tf.constant(windows[np.newaxis])).numpy()[0]
+        return self._predict(tf.constant(windows)).numpy()
+
+    def warmup(self, n_calls=10, batch_size=1):
+        '''Trace the prediction function and run it a few times before timing-sensitive use.
+
+        Args:
+            n_calls (int): Number of warm-up calls. Default is 10.
+            batch_size (int): Batch size of the warm-up calls. Default is 1.
+        '''
+        windows = np.zeros((batch_size, self.rolling_window, self.n_features), dtype=np.float32)
+        for _ in range(n_calls):
+            self.predict(windows)
+
+    def benchmark(self, n_calls=1000, batch_size=1, seed=None):
+        '''Measure the latency of predict on random windows within the range of the fused scaler.
+
+        Args:
+            n_calls (int): Number of timed calls. Default is 1000.
+            batch_size (int): Number of windows per call. Default is 1.
+            seed (int): Seed of the random windows.
+
+        Returns:
+            dict: Latency per call in milliseconds ('p50', 'p99', 'mean') and the predictions per second.
+        '''
+        shape = (batch_size, self.rolling_window, self.n_features)
+        # Inputs mapped to 0 and 1 by the scaling layer
+        scaling = self.model.get_layer('MinMax_Scaling')
+        low = -scaling.offset / scaling.scale
+        high = (1 - scaling.offset) / scaling.scale
+        windows = np.random.default_rng(seed).uniform(low, high, size=shape).astype(np.float32)
+
+        self.warmup(batch_size=batch_size)
+        latencies = np.empty(n_calls)
+        for i in range(n_calls):
+            start = time.perf_counter()
+            self.predict(windows)
+            latencies[i] = time.perf_counter() - start
+
+        latencies *= 1000
+        return {'p50': float(np.percentile(latencies, 50)), 'p99': float(np.percentile(latencies, 99)),
+                'mean': float(latencies.mean()), 'predictions_per_sec': float(batch_size * 1000 / latencies.mean())}
+
+
+class StatefulSession:
+    '''Stateful copy of a trained sequence model, fed one new period per call.
+
+    The LSTM states carry the history of the games between calls, so every period costs one
+    LSTM step instead of a whole window. Call reset whenever the games are reset.
+
+    Attributes:
+        model (tf.keras.Model): The stateful model with fused scaling, see nn_model.create_stateful_model.
+        batch_size (int): Number of games predicted together.
+    '''
+
+    def __init__(self, model_path=SEQUENCE_MODEL_PATH, scaler_path=None, batch_size=1):
+        '''Load the sequence model and build the stateful model.
+
+        Args:
+            model_path (str): The path of the model trained with nn_model.create_sequence_model.
+            scaler_path (str): The pickled per-feature scaler of a model saved without fused scaling.
+                Default is None.
+            batch_size (int): Number of games predicted together. Default is 1.
+        '''
+        self.model = create_stateful_model(load_fused_model(model_path, scaler_path), batch_size)
+        self.batch_size = batch_size
+
+        n_features = self.model.input_shape[-1]
+        self._predict = tf.function(
+            self._forward, input_signature=[tf.TensorSpec(shape=(batch_size, None, n_features), dtype=tf.float32)])
+
+    def _forward(self, states):
+        '''Advance the LSTM states with the new states and return the last prediction.'''
+        return self.model(states, training=False)[:, -1]
+
+    def reset(self):
+        '''Clear the LSTM states, at the start of new games.'''
+        self.model.reset_states()
+
+    def predict(self, states):
+        '''Feed the states recorded since the last call and predict the next stock and bond prices.
+
+        Args:
+            states (ndarray): Unscaled new states of shape (batch_size, new_periods, features),
+                the whole burn-in after a reset, then one period per call.
+
+        Returns:
+            ndarray: Predicted prices of shape (batch_size, 2).
+        '''
+        return self._predict(tf.constant(np.asarray(states, dtype=np.float32))).numpy()
@@ -1,11 +1,13 @@
 # Importing necessary libraries
 import tensorflow as tf
-import pickle
 from data_processing import DataProcessing
-from nn_model import create_model
-from train_model import train_model, test_model
+from model_artifact import load_artifact, save_artifact
+from nn_model import add_scaling, create_model, create_sequence_model
+from train_model import configure_threads, train_model, train_model_fast, train_model_resumable, test_model
 from scenes_ai import InvestmentScene
-import keras_tuner as kt
+from streaming import (VALIDATION_STREAM, fit_scaler, make_shard_dataset, make_streaming_dataset, simulate_test_set,
+                       stream_seed)
+from tuning import build_model, search
 
 OPTIMIZER = 'adam'
 LOSS = 'mean_squared_error'
@@ -16,146 +18,202 @@ LAYERS = [64,32]
 '''Each node is given a 20% chance of being turned off at each training step.'''
 DROPOUT = 0.20
 
+'''Train on freshly simulated games streamed through tf.data instead of a fixed in-memory dataset.'''
+STREAMING = False
 
+'''Number of batches per epoch in streaming mode, about the size of one eager epoch.'''
+STEPS_PER_EPOCH = 12000
 
-# Function to save the model and scaler
-def save_model_and_scaler(model, scaler, model_path, scaler_path):
-    '''Save the model and scaler.
+'''Train with the tf.data pipeline, large batches and a scaled learning rate (see train_model.train_model_fast).'''
+FAST_TRAINING = False
+
+'''Batch size of the fast training mode, the learning rate is scaled from the batch size of 32.'''
+FAST_BATCH_SIZE = 256
+
+'''Directory of the training checkpoints, an interrupted training resumes from there. None keeps it in memory.'''
+CHECKPOINT_DIR = None
+
+'''Seed of the simulated games: a fixed seed lets repeated runs load the dataset from the cache.'''
+SEED = 42
+
+'''Directory of the cached datasets, see dataset_cache.py.'''
+CACHE_DIR = '../DATA/cache'
+
+
+# Function to save the model with its scaler
+def save_model_and_scaler(model, scaler, model_path, metadata=None):
+    '''Save the model, its fitted scaler and training metadata as one artifact (see model_artifact.py).
+
+    The artifact predicts raw (unscaled) inputs, so it is the only file set to ship.
 
     Args:
         model (Model): The model to save.
-        scaler (Scaler): The scaler to save.
-        model_path (str): The path where the model should be saved.
-        scaler_path (str): The path where the scaler should be saved.
+        scaler (Scaler): The fitted scaler of the model inputs.
+        model_path (str): The directory where the artifact should be saved.
+        metadata (dict): Hyperparameters, data and metrics recorded with the model. Default is None.
     '''
-    model.save(model_path)
-
-    with open(scaler_path, 'wb') as f:
-        pickle.dump(scaler, f)
+    save_artifact(model, model_path, scaler, metadata)
 
 
-# Function to load the model and scaler
-def load_model_and_scaler(model_path, scaler_path):
-    '''Load the model and scaler.
+# Function to load the model
+def load_model(model_path):
+    '''Load a model saved by save_model_and_scaler, without TensorFlow.
 
     Args:
-        model_path (str): The path from where the model should be loaded.
-        scaler_path (str): The path from where the scaler should be loaded.
+        model_path (str): The directory from where the artifact should be loaded.
 
     Returns:
-        tuple: The loaded model and scaler.
+        ModelArtifact: The loaded model, predicting raw inputs.
     '''
-    model = tf.keras.models.load_model(model_path)
-
-    with open(scaler_path, 'rb') as f:
-        scaler = pickle.load(f)
-
-    return model, scaler
-
-
-# Create the investment scene
-print('Create scene')
-scene = InvestmentScene()
-
-# Start data processing
-print('Start data processing')
-data_processing = DataProcessing(scene, rolling_window=6)
-
-# From here on the version you can use to test that our code runs correctly
-# The Hyper-tuning Method we used to train the model can be found bellow, and is commented out
-# Also to avoid overriding the actual trained model, we commented out the saving part
-# We have hardcoded the optimal param we found for our model when doing the tuning method
-
-# Get the training and testing data
-X_train, X_test, y_train, y_test = data_processing.get_train_test_split()
-print('Ending data processing...')
-
-# Get the shape of the input data
-input_shape = (X_train.shape[1], X_train.shape[2])
-print('End data processing')
-
-# Create the model
-print('Create model')
-model = create_model(input_shape, LAYERS, DROPOUT, OPTIMIZER, LOSS)
-
-early_stopping = tf.keras.callbacks.EarlyStopping(
-    monitor='val_loss',
-    patience=3,  # number of epochs with no improvement after which training will be stopped
-    restore_best_weights=True
-)
-# Train the model
-print('Train model')
-train_model(model, X_train, y_train, epochs=100, callbacks=[early_stopping])
-
-# Test the model
-print('Test model')
-test_model(model, X_test, y_test)
-
-# Here the Saving part that has been commented out to avoid overriding the saved model when testing our code
-# # Save the model and scaler
-# print('Save model')
-# save_model_and_scaler(model, data_processing.scaler_X, '../DATA/model/model1', '../DATA/model/scaler.pkl')
-# print('Model saved')
-#
-# # Load the saved model and scaler
-# model, scaler = load_model_and_scaler('../DATA/model/model1', '../DATA/model/scaler.pkl')
-
-
-# This is the Version with Hyper-tuning of the Parameters, we trained the model using this code part
-# You can find th output of the console as a .pdf in the .tar folder
-# X_train, X_test, y_train, y_test = data_processing.get_train_test_split()
-# print('Ending data processing...')
-#
-# # Get the shape of the input data
-# input_shape = (X_train.shape[1], X_train.shape[2])
-# print('End data processing')
-#
-# def model_builder(hp):
-#     layers = []
-#     for i in range(hp.Int('num_layers', 1, 3)):
-#         layers.append(hp.Choice(f'layer_{i+1}_units', values=[16, 32, 64, 128]))
-#     dropout = hp.Float('dropout', 0, 0.5, step=0.1)
-#     model = create_model(input_shape, layers, dropout, OPTIMIZER, LOSS)
-#     return model
-#
-# # Keras Tuner's RandomSearch
-# tuner = kt.RandomSearch(
-#     model_builder,
-#     objective='val_loss',
-#     max_trials=32,  # Number of models to test
-# )
-#
-# # Define early stopping
-# early_stopping = tf.keras.callbacks.EarlyStopping(
-#     monitor='val_loss',
-#     patience=3,  # number of epochs with no improvement after which training will be stopped
-#     restore_best_weights=True
-# )
-#
-# # Start the hyperparameter tuning
-# tuner.search(X_train, y_train, epochs=100, validation_data=(X_test, y_test), callbacks=[early_stopping])
-#
-# # Get the best hyperparameters
-# best_hps = tuner.get_best_hyperparameters()[0]
-#
-# print('The hyperparameters of the best model are:')
-# print(best_hps.values)
-#
-# # Rebuild the model with the best hyperparameters
-# model = tuner.hypermodel.build(best_hps)
-#
-# # Train the model
-# print('Train model')
-# history = train_model(model, X_train, y_train, epochs=100, callbacks=[early_stopping])
-#
-# # Test the model
-# print('Test model')
-# test_model(model, X_test, y_test)
-#
-# # Save the model and scaler
-# print('Save model')
-# save_model_and_scaler(model, data_processing.scaler_X, '../DATA/model/model1', '../DATA/model/scaler.pkl')
-# print('Model saved')
-#
-# # Load the saved model and scaler
-# model, scaler = load_model_and_scaler('../DATA/model/model1', '../DATA/model/scaler.pkl')
+    return load_artifact(model_path)
+
+
+if __name__ == '__main__':
+    if FAST_TRAINING:
+        # The thread pools can only be set before TensorFlow runs anything
+        configure_threads()
+
+    # Create the investment scene
+    print('Create scene')
+    scene = InvestmentScene()
+
+    # Start data processing
+    print('Start data processing')
+    data_processing = DataProcessing(scene, rolling_window=6, seed=SEED, cache_dir=CACHE_DIR)
+
+    # From here on the version you can use to test that our code runs correctly
+    # The Hyper-tuning Method we used to train the model can be found bellow, and is commented out
+    # Also to avoid overriding the actual trained model, we commented out the saving part
+    # We have hardcoded the optimal param we found for our model when doing the tuning method
+
+    if STREAMING:
+        # Fit the scaler on a sample of games, then stream new games with bounded memory
+        # The scaler sample, validation and test games come from their own streams of SEED
+        fit_scaler(data_processing, seed=SEED)
+        train_dataset = make_streaming_dataset(data_processing, seed=SEED)
+        validation_dataset = make_streaming_dataset(data_processing, num_chunks=4,
+                                                    seed=stream_seed(SEED, VALIDATION_STREAM)).cache()
+        X_test, y_test = simulate_test_set(data_processing, seed=SEED)
+        input_shape = (data_processing.rolling_window, len(data_processing.input_columns))
+    elif CHECKPOINT_DIR is not None or FAST_TRAINING:
+        # These training modes shuffle in-memory arrays
+        X_train, X_test, y_train, y_test = data_processing.get_train_test_split()
+        print('Ending data processing...')
+
+        # Get the shape of the input data
+        input_shape = (X_train.shape[1], X_train.shape[2])
+    else:
+        # Get the training and testing data, the training examples stay in the (memory-mapped) shards of the cache
+        train_shards, test_shards = data_processing.get_shard_split()
+        train_shards, validation_shards = data_processing.split_shards(train_shards)
+        train_dataset = make_shard_dataset(data_processing, train_shards)
+        validation_dataset = make_shard_dataset(data_processing, validation_shards)
+        X_test, y_test = data_processing.load_shards(test_shards)
+        print('Ending data processing...')
+
+        # Get the shape of the input data
+        input_shape = (X_test.shape[1], X_test.shape[2])
+    print('End data processing')
+
+    # Create the model
+    print('Create model')
+    model = create_model(input_shape, LAYERS, DROPOUT, OPTIMIZER, LOSS)
+
+    early_stopping = tf.keras.callbacks.EarlyStopping(
+        monitor='val_loss',
+        patience=3,  # number of epochs with no improvement after which training will be stopped
+        restore_best_weights=True
+    )
+    # Train the model
+    print('Train model')
+    if STREAMING:
+        train_model(model, train_dataset, None, epochs=100, callbacks=[early_stopping],
+                    validation_data=validation_dataset, steps_per_epoch=STEPS_PER_EPOCH)
+    elif CHECKPOINT_DIR is not None:
+        train_model_resumable(model, X_train, y_train, CHECKPOINT_DIR, epochs=100, seed=SEED)
+    elif FAST_TRAINING:
+        train_model_fast(model, X_train, y_train, epochs=100, batch_size=FAST_BATCH_SIZE, callbacks=[early_stopping],
+                         seed=SEED)
+    else:
+        train_model(model, train_dataset, None, epochs=100, callbacks=[early_stopping], validation_data=validation_dataset)
+
+    # Test the model
+    print('Test model')
+    metrics = test_model(model, X_test, y_test)
+
+    # Here the Saving part that has been commented out to avoid overriding the saved model when testing our code
+    # # Save the model and scaler
+    # print('Save model')
+    # save_model_and_scaler(model, data_processing.scaler_X, '../DATA/model/model1_artifact',
+    #                       metadata={'layers': LAYERS, 'dropout': DROPOUT, 'optimizer': OPTIMIZER, 'loss': LOSS,
+    #                                 'seed': SEED, 'test_metrics': {key: value.tolist() for key, value in metrics.items()}})
+    # print('Model saved')
+    #
+    # # Load the saved model and scaler
+    # model = load_model('../DATA/model/model1_artifact')
+
+
+    # This is the Version with the stateful model, predicting one period at a time (see ML.run_multiple_games_stateful)
+    # The sequence model is trained on whole games, inference.StatefulSession copies it into a stateful model
+    # X_train, X_test, y_train, y_test = data_processing.get_sequence_split()
+    # model = create_sequence_model(X_train.shape[2], LAYERS, DROPOUT, OPTIMIZER, LOSS)
+    # train_model(model, X_train, y_train, epochs=100, callbacks=[early_stopping])
+    # print('Test loss:', model.evaluate(X_test, y_test))
+    # # inference.StatefulSession loads a SavedModel
+    # add_scaling(model, data_processing.scaler_sequence).save('../DATA/model/sequence_model')
+
+
+    # This is the Version with Hyper-tuning of the Parameters, we trained the model using this code part
+    # The search runs its trials in spawned worker processes, which import this module without running it
+    # You can find th output of the console as a .pdf in the .tar folder
+    # X_train, X_test, y_train, y_test = data_processing.get_train_test_split()
+    # print('Ending data processing...')
+    #
+    # # Get the shape of the input data
+    # input_shape = (X_train.shape[1], X_train.shape[2])
+    # print('End data processing')
+    #
+    # # Successive halving over the search space of the model_builder below, trials are trained in 4 processes
+    # # and the worst two thirds are pruned after 3, 9, 27 and 81 epochs (see tuning.py)
+    # # The model_builder we used with Keras Tuner's RandomSearch, 32 trials trained one after the other:
+    # # def model_builder(hp):
+    # #     layers = []
+    # #     for i in range(hp.Int('num_layers', 1, 3)):
+    # #         layers.append(hp.Choice(f'layer_{i+1}_units', values=[16, 32, 64, 128]))
+    # #     dropout = hp.Float('dropout', 0, 0.5, step=0.1)
+    # #     model = create_model(input_shape, layers, dropout, OPTIMIZER, LOSS)
+    # #     return model
+    # # The Keras Tuner trials of HyperTunning_Trials have no data fingerprint, reuse_untagged tags them with the one
+    # # of this data on the first search, so their configurations are skipped and their checkpoints warm-start
+    # trials = search(X_train, y_train, X_test, y_test, n_trials=27, n_workers=4, seed=SEED, reuse_untagged=True)
+    #
+    # # Define early stopping
+    # early_stopping = tf.keras.callbacks.EarlyStopping(
+    #     monitor='val_loss',
+    #     patience=3,  # number of epochs with no improvement after which training will be stopped
+    #     restore_best_weights=True
+    # )
+    #
+    # print('The hyperparameters of the best model are:')
+    # print(trials[0]['values'])
+    #
+    # # Rebuild the model with the best hyperparameters
+    # model = build_model(trials[0]['values'], input_shape)
+    #
+    # # Train the model
+    # print('Train model')
+    # history = train_model(model, X_train, y_train, epochs=100, callbacks=[early_stopping])
+    #
+    # # Test the model
+    # print('Test model')
+    # metrics = test_model(model, X_test, y_test)
+    #
+    # # Save the model and scaler
+    # print('Save model')
+    # save_model_and_scaler(model, data_processing.scaler_X, '../DATA/model/model1_artifact',
+    #                       metadata={'layers': LAYERS, 'dropout': DROPOUT, 'optimizer': OPTIMIZER, 'loss': LOSS,
+    #                                 'seed': SEED, 'test_metrics': {key: value.tolist() for key, value in metrics.items()}})
+    # print('Model saved')
+    #
+    # # Load the saved model and scaler
+    # model = load_model('../DATA/model/model1_artifact')
@@ -0,0 +1,191 @@
+import json
+import os
+import numpy as np
+from batch_simulator import BatchMarketSimulator, MARKET_COLUMNS, BURN_IN_PERIODS
+from dataset_cache import fingerprint
+from rebalance import portfolio_values, rebalance, target_weights
+from rng_streams import as_seed_sequence, spawn_generators
+
+WIN_THRESHOLD = 500000
+
+
+class MarketPathLibrary:
+    '''Stored market paths, replayed identically into any strategy.
+
+    Prices are exogenous in the game, trades never move them, so a market path can be
+    simulated once and reused: every strategy evaluated on the same library sees the same
+    markets and their results can be compared game by game. The paths live in
+    <directory>/paths.npy, opened as a read-only memory map, with a metadata.json recording
+    how they were generated.
+
+    Attributes:
+        directory (str): Directory of the library.
+        paths (numpy.memmap): Paths of shape (num_games, n_states, 4), columns as in MARKET_COLUMNS.
+        metadata (dict): Generation inputs, number of games and periods.
+    '''
+
+    def __init__(self, directory):
+        '''Open an existing library, see create.'''
+        self.directory = directory
+        with open(os.path.join(directory, 'metadata.json')) as f:
+            self.metadata = json.load(f)
+        self.paths = np.load(os.path.join(directory, 'paths.npy'), mmap_mode='r')
+
+    @classmethod
+    def create(cls, directory, num_games, scene, seed=None, shocks=None, chunk_size=10000):
+        '''Simulate num_games market paths and store them in directory.
+
+        The paths are simulated and written chunk by chunk into the memory map, chunk i uses
+        child i of the seed, so the library never needs to fit in memory.
+
+        Args:
+            directory (str): Directory of the library, created if needed.
+            num_games (int): Number of paths.
+            scene (InvestmentScene): Scene whose parameters define the market dynamics.
+            seed (int): Seed of the paths.
+            shocks (object): Shock source of the simulator, see the shocks module. Default is IIDShocks.
+            chunk_size (int): Number of paths simulated at a time. Default is 10000.
+
+        Returns:
+            MarketPathLibrary: The opened library.
+        '''
+        os.makedirs(directory, exist_ok=True)
+        simulator = BatchMarketSimulator(scene, shocks=shocks)
+        seed_sequence = as_seed_sequence(seed)
+
+        paths = np.lib.format.open_memmap(os.path.join(directory, 'paths.npy'), mode='w+',
+                                          shape=(num_games, simulator.n_states, len(MARKET_COLUMNS)))
+        for chunk, start in enumerate(range(0, num_games, chunk_size)):
+            stop = min(start + chunk_size, num_games)
+            rng, = spawn_generators(seed_sequence, 1, start=chunk)
+            paths[start:stop] = simulator.simulate(stop - start, rng, offset=start)
+        paths.flush()
+        del paths
+
+        metadata = {'num_games': num_games, 'n_periods': simulator.n_periods, 'n_states': simulator.n_states,
+                    'columns': MARKET_COLUMNS, 'chunk_size': chunk_size,
+                    'seed': fingerprint(seed_sequence), 'simulator': fingerprint(simulator)}
+        with open(os.path.join(directory, 'metadata.json'), 'w') as f:
+            json.dump(metadata, f, indent=2)
+        return cls(directory)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def replay(self, scene, game):
+        '''Restart the scene on the stored path of the given game, see InvestmentScene.replay_market.'''
+        scene.replay_market(self.paths[game])
+
+
+def backtest(paths, strategy, starting_money=500000, batch_size=10000):
+    '''Run a target-weight strategy over stored market paths, all games of a batch at once.
+
+    Every period from the end of the burn-in, the strategy sets the target weights of all
+    portfolios, which are rebalanced at the current prices (see rebalance.rebalance) before
+    the market moves to the next state, as in one turn of the game.
+
+    Args:
+        paths (ndarray): Paths of shape (num_games, n_states, 4), e.g. MarketPathLibrary.paths.
+        strategy (callable): strategy(history, holdings) returning weights of shape (games, 3),
+            with history the paths up to the current state (games, t + 1, 4) and holdings the
+            (money, stock_shares, bond_shares) arrays.
+        starting_money (float): Cash at the start of the game, no shares are held. Default is 500000.
+        batch_size (int): Number of games loaded and run at a time. Default is 10000.
+
+    Returns:
+        ndarray: Final portfolio values of shape (num_games,).
+    '''
+    final_values = np.empty(len(paths))
+    for start in range(0, len(paths), batch_size):
+        batch = np.asarray(paths[start:start + batch_size])
+        holdings = (np.full(len(batch), float(starting_money)), np.zeros(len(batch)), np.zeros(len(batch)))
+        for t in range(BURN_IN_PERIODS - 1, batch.shape[1] - 1):
+            weights = strategy(batch[:, :t + 1], holdings)
+            holdings = rebalance(*holdings, batch[:, t, :2], weights)
+        final_values[start:start + len(batch)] = portfolio_values(*holdings, batch[:, -1, :2])
+    return final_values
+
+
+def model_strategy(session, rolling_window=6):
+    '''Strategy of ML.adjust_portfolios: weights from the predicted prices of the last rolling_window states.
+
+    Args:
+        session (object): Predictor of raw windows, e.g. inference.InferenceSession.
+        rolling_window (int): Number of states per window. Default is 6.
+
+    Returns:
+        callable: The strategy, see backtest.
+    '''
+    def strategy(history, holdings):
+        predicted_prices = session.predict(history[:, -rolling_window:])
+        return target_weights(predicted_prices, history[:, -1, :2])
+    return strategy
+
+
+def constant_weights(weights):
+    '''Strategy rebalancing every period to the same stock, bond and cash weights, e.g. [0, 0, 1] for cash.'''
+    weights = np.asarray(weights, dtype=float)
+    return lambda history, holdings: np.broadcast_to(weights, (len(history), 3))
+
+
+def random_trade_strategy(rng):
+    '''Strategy of ML.random_games: one random trade per portfolio and period, as played by the scene.
+
+    Every period each portfolio buys stocks, buys bonds or increases its cash (chosen uniformly)
+    for 10% to 40% of its value, with the rules of InvestmentScene.handle_events: a purchase is
+    paid with cash, then by selling the other asset, and does not happen if both fall short;
+    increasing the cash sells half of the amount of each asset, the other asset covering what
+    one lacks.
+
+    Args:
+        rng (numpy.random.Generator): Random generator of the decisions and amounts.
+
+    Returns:
+        callable: The strategy, see backtest.
+    '''
+    def strategy(history, holdings):
+        money, stock_shares, bond_shares = holdings
+        prices = history[:, -1, :2]
+        cash, stocks, bonds = money, stock_shares * prices[:, 0], bond_shares * prices[:, 1]
+        values = cash + stocks + bonds
+        decisions = rng.integers(0, 3, len(values))  # buy_stock, buy_bond, increase_cash
+        amounts = rng.uniform(0.1, 0.4, len(values)) * values
+
+        # Purchases: the shortfall of cash is sold from the other asset, if it covers it
+        shortfall = np.maximum(amounts - cash, 0)
+        buy_stock = (decisions == 0) & (shortfall <= bonds)
+        buy_bond = (decisions == 1) & (shortfall <= stocks)
+        # Increasing the cash: half from each asset, the other one covering what one lacks
+        half = amounts / 2
+        stock_sold = np.where(decisions == 2, np.minimum(stocks, np.maximum(half, amounts - bonds)), 0)
+        bond_sold = np.where(decisions == 2, np.minimum(bonds, np.maximum(half, amounts - stocks)), 0)
+
+        stocks = stocks + np.where(buy_stock, amounts, 0) - np.where(buy_bond, shortfall, 0) - stock_sold
+        bonds = bonds + np.where(buy_bond, amounts, 0) - np.where(buy_stock, shortfall, 0) - bond_sold
+        cash = values - stocks - bonds
+        return np.maximum(np.stack([stocks, bonds, cash], axis=1), 0) / values[:, np.newaxis]
+    return strategy
+
+
+def paired_comparison(values_a, values_b, threshold=WIN_THRESHOLD):
+    '''Compare two strategies evaluated on the same market paths, game by game.
+
+    The markets are common to both strategies, so the standard errors of the differences
+    are much smaller than those of two independent evaluations.
+
+    Args:
+        values_a (ndarray): Final portfolio values of strategy a, one per path.
+        values_b (ndarray): Final portfolio values of strategy b on the same paths.
+        threshold (float): Final value of a winning game. Default is WIN_THRESHOLD.
+
+    Returns:
+        dict: Mean difference of the final values and of the win rates (a - b) and their standard errors.
+    '''
+    values_a, values_b = np.asarray(values_a), np.asarray(values_b)
+    n = len(values_a)
+    difference = values_a - values_b
+    win_difference = (values_a > threshold).astype(float) - (values_b > threshold)
+    return {'mean_difference': float(difference.mean()),
+            'mean_difference_se': float(difference.std(ddof=1) / np.sqrt(n)),
+            'win_rate_difference': float(win_difference.mean()),
+            'win_rate_difference_se': float(win_difference.std(ddof=1) / np.sqrt(n))}
@@ -0,0 +1,162 @@
+import datetime
+import hashlib
+import json
+import os
+import numpy as np
+from numpy_model import NumpyModel
+
+'''Artifact of the trained model, see save_artifact.'''
+ARTIFACT_PATH = '../DATA/model/model1_artifact'
+
+# Bump when the layout of the artifact changes, older loaders refuse newer artifacts
+FORMAT_VERSION = 1
+
+WEIGHTS_FILE = 'weights.npy'
+MANIFEST_FILE = 'manifest.json'
+
+
+def _content_hash(architecture, scaler, layout, weights):
+    '''SHA-256 of the weights and of everything needed to interpret them.'''
+    digest = hashlib.sha256(json.dumps({'architecture': architecture, 'scaler': scaler, 'layout': layout},
+                                       sort_keys=True).encode())
+    digest.update(np.ascontiguousarray(weights).tobytes())
+    return digest.hexdigest()
+
+
+def save_artifact(model, path, scaler=None, metadata=None):
+    '''Save a trained model as one versioned artifact directory.
+
+    The directory holds weights.npy, all weights concatenated in one float32 array that is
+    memory-mapped on load, and manifest.json with the layers (architecture), the MinMax
+    scaling parameters (scaler), where every weight lies in the array (layout), a SHA-256 of
+    the content and the training metadata. No pickle and no TensorFlow are needed to load it.
+
+    Args:
+        model (tf.keras.Model or NumpyModel): The trained model, with fused scaling or not.
+        path (str): Directory of the artifact, created if needed.
+        scaler (MinMaxScaler): The fitted scaler of a model taking scaled inputs. Default is None.
+        metadata (dict): JSON-serializable training metadata (hyperparameters, data, metrics...).
+
+    Returns:
+        str: The content hash of the artifact.
+    '''
+    numpy_model = model if isinstance(model, NumpyModel) else NumpyModel.from_keras(model)
+    architecture, weights, scale, offset = [], [], None, None
+    for layer, layer_weights in zip(numpy_model.layers, numpy_model.weights):
+        if layer['kind'] == 'MinMaxScaling':
+            scale, offset = layer['config']['scale'], layer['config']['offset']
+        else:
+            architecture.append(layer)
+            weights.append(layer_weights)
+    n_features = next(layer_weights[0].shape[0] for layer_weights in weights if layer_weights)
+
+    if scaler is not None:
+        if scale is not None:
+            raise ValueError('The model already has a fused scaling layer')
+        # Window scalers are fitted on flattened windows, per-feature scalers on single steps
+        shape = (-1, n_features) if scaler.scale_.size != n_features else (n_features,)
+        scale, offset = scaler.scale_.reshape(shape).tolist(), scaler.min_.reshape(shape).tolist()
+    scaler_parameters = None if scale is None else {'scale': scale, 'offset': offset}
+    rolling_window = len(scale) if scale is not None and np.ndim(scale) == 2 else None
+
+    layout, arrays, position = [], [], 0
+    for i, layer_weights in enumerate(weights):
+        for j, weight in enumerate(layer_weights):
+            layout.append({'layer': i, 'index': j, 'shape': list(weight.shape), 'offset': position})
+            arrays.append(np.asarray(weight, dtype=np.float32).ravel())
+            position += weight.size
+    flat = np.concatenate(arrays) if arrays else np.empty(0, dtype=np.float32)
+
+    content_hash = _content_hash(architecture, scaler_parameters, layout, flat)
+    metadata = dict(metadata or {})
+    metadata.setdefault('created', datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'))
+    metadata.setdefault('numpy_version', np.__version__)
+    manifest = {'format_version': FORMAT_VERSION, 'input_shape': [rolling_window, n_features],
+                'architecture': architecture, 'scaler': scaler_parameters, 'dtype': 'float32', 'layout': layout,
+                'sha256': content_hash, 'metadata': metadata}
+
+    os.makedirs(path, exist_ok=True)
+    np.save(os.path.join(path, WEIGHTS_FILE), flat)
+    # Written last, an artifact without manifest is incomplete
+    with open(os.path.join(path, MANIFEST_FILE), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return content_hash
+
+
+class ModelArtifact:
+    '''Model loaded from an artifact directory, predicting raw windows with NumPy.
+
+    Loading reads the manifest and maps the weights file, there is no graph to rebuild, so
+    it takes milliseconds. It can replace an inference.InferenceSession (same predict,
+    rolling_window and n_features).
+
+    Attributes:
+        path (str): Directory of the artifact.
+        manifest (dict): Content of manifest.json.
+        metadata (dict): Training metadata of the model.
+        sha256 (str): Content hash of the artifact.
+        model (NumpyModel): The model, its weights are views of the memory-mapped file.
+        rolling_window (int): Number of periods per window, None for a sequence model.
+        n_features (int): Number of features per period.
+    '''
+
+    def __init__(self, path=ARTIFACT_PATH, verify=True):
+        '''
+        Args:
+            path (str): Directory of the artifact. Default is ARTIFACT_PATH.
+            verify (bool): Check the content hash. Default is True.
+        '''
+        self.path = path
+        with open(os.path.join(path, MANIFEST_FILE)) as f:
+            self.manifest = json.load(f)
+        if self.manifest['format_version'] > FORMAT_VERSION:
+            raise ValueError(f'Artifact format {self.manifest["format_version"]} is newer than '
+                             f'the supported format {FORMAT_VERSION}')
+        self.metadata = self.manifest['metadata']
+        self.sha256 = self.manifest['sha256']
+        self.rolling_window, self.n_features = self.manifest['input_shape']
+
+        # np.asarray drops the memmap subclass, the views still read from the mapped file
+        flat = np.asarray(np.load(os.path.join(path, WEIGHTS_FILE), mmap_mode='r'))
+        architecture, scaler, layout = self.manifest['architecture'], self.manifest['scaler'], self.manifest['layout']
+        if verify and _content_hash(architecture, scaler, layout, flat) != self.sha256:
+            raise ValueError(f'The content of the artifact {path} does not match its hash')
+
+        weights = [[] for _ in architecture]
+        for entry in layout:
+            size = int(np.prod(entry['shape']))
+            weights[entry['layer']].append(flat[entry['offset']:entry['offset'] + size].reshape(entry['shape']))
+        layers = list(architecture)
+        if scaler is not None:
+            layers.insert(0, {'kind': 'MinMaxScaling', 'name': 'MinMax_Scaling', 'config': scaler})
+            weights.insert(0, [])
+        self.model = NumpyModel(layers, weights)
+
+    def predict(self, windows):
+        '''Predict the next stock and bond prices.
+
+        Args:
+            windows (ndarray): Unscaled window of shape (rolling_window, n_features), or a batch
+                of shape (batch, rolling_window, n_features).
+
+        Returns:
+            ndarray: Predicted prices of shape (2,) for one window, (batch, 2) for a batch.
+        '''
+        windows = np.asarray(windows, dtype=np.float32)
+        if windows.ndim == 2:
+            return self.model.predict(windows[np.newaxis])[0]
+        return self.model.predict(windows)
+
+
+def load_artifact(path=ARTIFACT_PATH, verify=True):
+    '''Load an artifact saved by save_artifact, see ModelArtifact.'''
+    return ModelArtifact(path, verify)
+
+
+if __name__ == '__main__':
+    from inference import MODEL_PATH, SCALER_PATH, load_fused_model
+
+    # Convert the trained model and its scaler, saved before artifacts existed
+    save_artifact(load_fused_model(MODEL_PATH, SCALER_PATH), ARTIFACT_PATH,
+                  metadata={'source': 'model/model1 and model/scaler.pkl', 'layers': [64, 32], 'dropout': 0.2,
+                            'optimizer': 'adam', 'loss': 'mean_squared_error'})
@@ -1,5 +1,32 @@
+import numpy as np
 import tensorflow as tf
 
+
+@tf.keras.utils.register_keras_serializable(package='nn_model')
+class MinMaxScaling(tf.keras.layers.Layer):
+    '''Fitted MinMaxScaler as a layer, X * scale + offset, so a model can take raw prices and rates.
+
+    The parameters are stored in the layer config and saved with the model.
+    '''
+
+    def __init__(self, scale, offset, **kwargs):
+        '''
+        Args:
+            scale (array_like): MinMaxScaler.scale_, shaped like one input step or window.
+            offset (array_like): MinMaxScaler.min_, same shape as scale.
+        '''
+        super().__init__(**kwargs)
+        self.scale = np.asarray(scale, dtype=np.float32)
+        self.offset = np.asarray(offset, dtype=np.float32)
+
+    def call(self, inputs):
+        return inputs * self.scale + self.offset
+
+    def get_config(self):
+        config = super().get_config()
+        config.update({'scale': self.scale.tolist(), 'offset': self.offset.tolist()})
+        return config
+
 def create_model(input_shape, layers=[128, 64, 32], dropout_rate=0.25, optimizer='adam', loss='mean_squared_error'):
     '''Create a Sequential LSTM model.
 
@@ -37,3 +64,95 @@ def create_model(input_shape, layers=[128, 64, 32], dropout_rate=0.25, optimizer
     model.compile(loss=loss, optimizer=optimizer)
 
     return model
+
+
+def create_sequence_model(n_features, layers=[64, 32], dropout_rate=0.25, optimizer='adam', loss='mean_squared_error',
+                          stateful=False, batch_size=None):
+    '''Create an LSTM model predicting the next prices after every step of a sequence.
+
+    The model is trained on whole games (see DataProcessing.get_sequence_split). Its weights
+    can then be copied into a stateful model with create_stateful_model, which takes one new
+    observation per call and carries the hidden state between periods.
+
+    Args:
+        n_features (int): Number of features per period.
+        layers (list): List of layer sizes for the LSTM layers. Default is [64, 32].
+        dropout_rate (float): The rate for dropout layers to avoid overfitting. Default is 0.25.
+        optimizer (str): The optimizer to use for training the model. Default is 'adam'.
+        loss (str): The loss function to use for training the model. Default is 'mean_squared_error'.
+        stateful (bool): Keep the LSTM states between calls. Default is False.
+        batch_size (int): Fixed batch size, required by stateful models. Default is None.
+
+    Returns:
+        model (tf.keras.Sequential): A compiled Keras model with output shape (batch, timesteps, 2).
+    '''
+    model = tf.keras.models.Sequential(name='LSTM_Stateful_Model' if stateful else 'LSTM_Sequence_Model')
+    # Any number of timesteps: whole games for training, one period per call once stateful
+    model.add(tf.keras.layers.InputLayer(batch_input_shape=(batch_size, None, n_features)))
+
+    for i, layer_size in enumerate(layers[:-1], start=1):
+        model.add(tf.keras.layers.LSTM(layer_size, return_sequences=True, stateful=stateful, name=f'LSTM_{i}'))
+        model.add(tf.keras.layers.Dropout(dropout_rate, name=f'Dropout_{i}'))
+
+    # Every LSTM returns sequences, the Dense layer predicts after every step
+    model.add(tf.keras.layers.LSTM(layers[-1], return_sequences=True, stateful=stateful, name='LSTM_Final'))
+    model.add(tf.keras.layers.Dense(2, activation='linear', name='Dense_Output'))
+
+    model.compile(loss=loss, optimizer=optimizer)
+
+    return model
+
+
+def create_stateful_model(model, batch_size=1):
+    '''Copy a trained sequence model into a stateful model for one-step-at-a-time prediction.
+
+    Call reset_states() when a game is reset, then feed the states of the game as they are
+    recorded: each call costs one LSTM step per new period instead of a whole window.
+
+    Args:
+        model (tf.keras.Sequential): Trained model from create_sequence_model.
+        batch_size (int): Number of games predicted together. Default is 1.
+
+    Returns:
+        model (tf.keras.Sequential): The stateful model with the trained weights.
+    '''
+    layers = [layer.units for layer in model.layers if isinstance(layer, tf.keras.layers.LSTM)]
+    stateful_model = create_sequence_model(model.input_shape[-1], layers, stateful=True, batch_size=batch_size)
+    # The scaling layer has no weights, the LSTM and Dense weights line up
+    stateful_model.set_weights(model.get_weights())
+
+    scaling = [layer for layer in model.layers if isinstance(layer, MinMaxScaling)]
+    if scaling:
+        return _prepend_scaling(stateful_model, scaling[0].scale, scaling[0].offset)
+    return stateful_model
+
+
+def add_scaling(model, scaler):
+    '''Fuse a fitted MinMaxScaler into the model, which then takes raw (unscaled) inputs.
+
+    A window scaler (DataProcessing.scaler_X, fitted on flattened windows) scales every
+    position of the window, a per-feature scaler (DataProcessing.scaler_sequence) every step.
+    The returned model shares the layers, and so the weights, of model.
+
+    Args:
+        model (tf.keras.Sequential): Trained model taking scaled inputs.
+        scaler (MinMaxScaler): The fitted scaler.
+
+    Returns:
+        model (tf.keras.Sequential): The model with a MinMaxScaling input layer.
+    '''
+    shape = model.input_shape[1:]
+    if None in shape:
+        shape = shape[-1:]
+    return _prepend_scaling(model, scaler.scale_.reshape(shape), scaler.min_.reshape(shape))
+
+
+def _prepend_scaling(model, scale, offset):
+    '''Return a Sequential model of a MinMaxScaling layer followed by the layers of model.'''
+    fused = tf.keras.models.Sequential(name=model.name)
+    fused.add(tf.keras.layers.InputLayer(batch_input_shape=model.input_shape))
+    fused.add(MinMaxScaling(scale, offset, name='MinMax_Scaling'))
+    for layer in model.layers:
+        if not isinstance(layer, MinMaxScaling):
+            fused.add(layer)
+    return fused
@@ -0,0 +1,168 @@
+import json
+import numpy as np
+
+ACTIVATIONS = {
+    'linear': lambda x: x,
+    'tanh': np.tanh,
+    'sigmoid': lambda x: 1 / (1 + np.exp(-x)),
+    'relu': lambda x: np.maximum(x, 0),
+}
+
+
+def export_weights(model, path):
+    '''Dump the layers and trained weights of a Keras model to a .npz file.
+
+    Only the layers used by nn_model.create_model are supported: LSTM, Dropout and Dense,
+    plus the MinMaxScaling layer of a model with fused scaling (nn_model.add_scaling).
+
+    Args:
+        model (tf.keras.Model): The trained model.
+        path (str): The path of the .npz file.
+    '''
+    NumpyModel.from_keras(model).save(path)
+
+
+class NumpyModel:
+    '''NumPy forward pass of the LSTM/Dense stack built by nn_model.create_model.
+
+    The predictions match Keras up to float tolerance, without importing TensorFlow. The
+    LSTM follows the Keras equations: the kernels hold the gates in the order input, forget,
+    cell, output, with the configured activation (tanh) and recurrent activation (sigmoid).
+    Dropout layers are skipped, as in inference mode. A fused MinMaxScaling layer is applied
+    from its config, so such a model takes raw inputs.
+
+    Attributes:
+        layers (list): Layer descriptions (kind, name and config), in order.
+        weights (list): Weight arrays of each layer, in order.
+    '''
+
+    # Config entries used by the forward pass of every supported layer type
+    LAYERS = {
+        'LSTM': ('units', 'activation', 'recurrent_activation', 'return_sequences', 'use_bias', 'go_backwards'),
+        'Dropout': ('rate',),
+        'Dense': ('units', 'activation', 'use_bias'),
+        'MinMaxScaling': ('scale', 'offset'),
+    }
+
+    def __init__(self, layers, weights):
+        '''
+        Args:
+            layers (list): Layer descriptions, see export_weights.
+            weights (list): Weight arrays of each layer, as returned by layer.get_weights().
+        '''
+        self.layers = layers
+        self.weights = weights
+
+    @classmethod
+    def load(cls, path):
+        '''Load a model dumped by export_weights.
+
+        Args:
+            path (str): The path of the .npz file.
+
+        Returns:
+            NumpyModel: The loaded model.
+        '''
+        with np.load(path) as data:
+            layers = json.loads(str(data['architecture']))
+            weights = []
+            for i in range(len(layers)):
+                j = 0
+                layer_weights = []
+                while f'layer_{i}_{j}' in data:
+                    layer_weights.append(data[f'layer_{i}_{j}'])
+                    j += 1
+                weights.append(layer_weights)
+        return cls(layers, weights)
+
+    @classmethod
+    def from_keras(cls, model):
+        '''Build the NumPy model from the layers of a loaded Keras model.
+
+        Args:
+            model (tf.keras.Model): The trained model.
+
+        Returns:
+            NumpyModel: The model with a copy of the trained weights.
+        '''
+        layers = []
+        for layer in model.layers:
+            kind = type(layer).__name__
+            if kind not in cls.LAYERS:
+                raise ValueError(f'Layer {layer.name} of type {kind} is not supported')
+            config = layer.get_config()
+            layers.append({'kind': kind, 'name': layer.name,
+                           'config': {key: config[key] for key in cls.LAYERS[kind] if key in config}})
+        return cls(layers, [layer.get_weights() for layer in model.layers])
+
+    def save(self, path):
+        '''Save the layers and weights to a .npz file, see load.'''
+        weights = {f'layer_{i}_{j}': weight
+                   for i, layer_weights in enumerate(self.weights) for j, weight in enumerate(layer_weights)}
+        np.savez(path, architecture=json.dumps(self.layers), **weights)
+
+    def predict(self, x):
+        '''Run the forward pass.
+
+        Args:
+            x (ndarray): Input of shape (batch, timesteps, features), raw if the scaling is fused, scaled otherwise.
+
+        Returns:
+            ndarray: Output of the last layer, (batch, units).
+        '''
+        x = np.asarray(x, dtype=np.float32)
+        for layer, weights in zip(self.layers, self.weights):
+            if layer['kind'] == 'MinMaxScaling':
+                x = x * np.asarray(layer['config']['scale'], dtype=np.float32) \
+                    + np.asarray(layer['config']['offset'], dtype=np.float32)
+            elif layer['kind'] == 'LSTM':
+                x = self._lstm(x, layer['config'], weights)
+            elif layer['kind'] == 'Dense':
+                x = self._dense(x, layer['config'], weights)
+        return x
+
+    @staticmethod
+    def _lstm(x, config, weights):
+        '''LSTM over the timesteps of x, returning the last or all hidden states.'''
+        kernel, recurrent_kernel = weights[:2]
+        units = config['units']
+        activation = ACTIVATIONS[config.get('activation', 'tanh')]
+        recurrent_activation = ACTIVATIONS[config.get('recurrent_activation', 'sigmoid')]
+        if config.get('go_backwards', False):
+            x = x[:, ::-1]
+
+        # Input projection of every timestep in one product
+        z_x = x @ kernel
+        if config.get('use_bias', True):
+            z_x += weights[2]
+
+        batch, timesteps = x.shape[:2]
+        h = np.zeros((batch, units), dtype=x.dtype)
+        c = np.zeros((batch, units), dtype=x.dtype)
+        outputs = np.empty((batch, timesteps, units), dtype=x.dtype) if config.get('return_sequences') else None
+        for t in range(timesteps):
+            z = z_x[:, t] + h @ recurrent_kernel
+            i = recurrent_activation(z[:, :units])
+            f = recurrent_activation(z[:, units:2 * units])
+            c = f * c + i * activation(z[:, 2 * units:3 * units])
+            o = recurrent_activation(z[:, 3 * units:])
+            h = o * activation(c)
+            if outputs is not None:
+                outputs[:, t] = h
+        return h if outputs is None else outputs
+
+    @staticmethod
+    def _dense(x, config, weights):
+        '''Fully connected layer.'''
+        x = x @ weights[0]
+        if config.get('use_bias', True):
+            x = x + weights[1]
+        return ACTIVATIONS[config.get('activation', 'linear')](x)
+
+
+if __name__ == '__main__':
+    from inference import MODEL_PATH, SCALER_PATH, load_fused_model
+
+    # Export the trained model to .npz when needed (e.g. for backtest_harness.load_session), the shipped
+    # model is model/model1_artifact, see model_artifact.py
+    export_weights(load_fused_model(MODEL_PATH, SCALER_PATH), '../DATA/model/model1.npz')
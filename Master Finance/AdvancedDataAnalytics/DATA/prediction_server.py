@@ -0,0 +1,280 @@
+import json
+import os
+import queue
+import socket
+import socketserver
+import stat
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+import numpy as np
+
+'''Address of the server, a (host, port) pair for TCP on localhost or a path for a Unix socket.'''
+ADDRESS = ('127.0.0.1', 8765)
+
+'''Longest time the first request of a micro-batch waits for others, in seconds.'''
+MAX_DELAY = 0.002
+
+'''Largest number of windows predicted in one model call.'''
+MAX_BATCH = 1024
+
+
+class MicroBatcher:
+    '''Coalesce concurrent prediction requests into micro-batches run by one worker thread.
+
+    The worker takes the oldest request, then keeps collecting requests until max_batch
+    windows are queued or max_delay has passed, and runs them through the session in a
+    single call.
+
+    Attributes:
+        session (object): Predictor with a predict(windows) method on (batch, rolling_window, features) arrays
+            and rolling_window and n_features attributes, e.g. inference.InferenceSession.
+        max_delay (float): Longest wait for more requests, in seconds.
+        max_batch (int): Largest number of windows per model call.
+    '''
+
+    def __init__(self, session, max_delay=MAX_DELAY, max_batch=MAX_BATCH, n_latencies=10000):
+        '''
+        Args:
+            session (object): Predictor, see the class attributes.
+            max_delay (float): Longest wait for more requests, in seconds. Default is MAX_DELAY.
+            max_batch (int): Largest number of windows per model call. Default is MAX_BATCH.
+            n_latencies (int): Number of recent request latencies kept for the metrics. Default is 10000.
+        '''
+        self.session = session
+        self.max_delay = max_delay
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        self._latencies = deque(maxlen=n_latencies)
+        self._batch_sizes = deque(maxlen=n_latencies)
+        self._n_requests = 0
+        self._lock = threading.Lock()
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def submit(self, windows):
+        '''Queue raw windows for prediction.
+
+        Args:
+            windows (ndarray): Unscaled windows of shape (batch, rolling_window, features).
+
+        Returns:
+            Future: Resolves to the predicted prices of shape (batch, 2).
+        '''
+        window_shape = (self.session.rolling_window, self.session.n_features)
+        if np.ndim(windows) != 3 or np.shape(windows)[1:] != window_shape:
+            # Checked here, a malformed request must not fail the whole micro-batch
+            raise ValueError(f'Expected windows of shape (batch, {window_shape[0]}, {window_shape[1]}), '
+                             f'got {np.shape(windows)}')
+        future = Future()
+        self._queue.put((np.asarray(windows, dtype=np.float32), future, time.perf_counter()))
+        return future
+
+    def predict(self, windows):
+        '''Predict raw windows through the batcher and wait for the result, see submit.'''
+        return self.submit(windows).result()
+
+    def close(self):
+        '''Stop the worker thread once the queued requests are served.'''
+        self._queue.put(None)
+        self._worker.join()
+
+    def metrics(self):
+        '''Return the queue depth, request counts, batch sizes and latencies (ms) of the recent requests.'''
+        with self._lock:
+            latencies = np.array(self._latencies) * 1000
+            batch_sizes = np.array(self._batch_sizes)
+            n_requests = self._n_requests
+        metrics = {'queue_depth': self._queue.qsize(), 'requests': n_requests, 'batches': len(batch_sizes)}
+        if len(latencies):
+            metrics.update({'mean_batch_size': float(batch_sizes.mean()),
+                            'latency_p50': float(np.percentile(latencies, 50)),
+                            'latency_p99': float(np.percentile(latencies, 99)),
+                            'latency_mean': float(latencies.mean())})
+        return metrics
+
+    def _collect(self, first):
+        '''Gather the queued requests following first, up to max_batch windows or max_delay.'''
+        requests = [first]
+        n_windows = len(first[0])
+        deadline = time.perf_counter() + self.max_delay
+        while n_windows < self.max_batch:
+            timeout = deadline - time.perf_counter()
+            try:
+                request = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if request is None:
+                # Serve what was collected, then stop
+                self._queue.put(None)
+                break
+            requests.append(request)
+            n_windows += len(request[0])
+        return requests
+
+    def _run(self):
+        '''Worker loop: collect a micro-batch, predict it and resolve the futures.'''
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+            requests = self._collect(first)
+            windows = np.concatenate([request[0] for request in requests])
+            try:
+                predictions = self.session.predict(windows)
+            except Exception as error:
+                for _, future, _ in requests:
+                    future.set_exception(error)
+                continue
+
+            done = time.perf_counter()
+            start = 0
+            with self._lock:
+                for request_windows, future, submitted in requests:
+                    future.set_result(predictions[start:start + len(request_windows)])
+                    start += len(request_windows)
+                    self._latencies.append(done - submitted)
+                self._n_requests += len(requests)
+                self._batch_sizes.append(len(windows))
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    '''Serve the JSON lines of one client connection, see PredictionServer.'''
+
+    def handle(self):
+        for line in self.rfile:
+            request = {}
+            try:
+                request = json.loads(line)
+                if request.get('command') == 'metrics':
+                    response = {'metrics': self.server.batcher.metrics()}
+                else:
+                    windows = np.asarray(request['windows'], dtype=np.float32)
+                    single = windows.ndim == 2
+                    predictions = self.server.batcher.predict(windows[np.newaxis] if single else windows)
+                    response = {'predictions': (predictions[0] if single else predictions).tolist()}
+            except Exception as error:
+                response = {'error': f'{type(error).__name__}: {error}'}
+            if isinstance(request, dict) and 'id' in request:
+                response['id'] = request['id']
+            self.wfile.write((json.dumps(response) + '\n').encode())
+
+
+class PredictionServer:
+    '''Long-lived local prediction service holding one model and scaler for many clients.
+
+    Clients connect over TCP on localhost or over a Unix socket and send one JSON object per
+    line: {"windows": ...} with a raw (unscaled) window of shape (rolling_window, features)
+    or a batch of them, the same state windows that ML.preprocess_state_values consumes,
+    or {"command": "metrics"}. An optional "id" is echoed back. Every connection is served
+    by its own thread, and the requests of all connections are coalesced by a MicroBatcher.
+
+    Attributes:
+        batcher (MicroBatcher): The micro-batcher running the model.
+        address: The bound (host, port) pair or Unix socket path.
+    '''
+
+    def __init__(self, session, address=ADDRESS, max_delay=MAX_DELAY, max_batch=MAX_BATCH):
+        '''Bind the server, call serve_forever (or start) to serve requests.
+
+        Args:
+            session (object): Predictor of raw windows, e.g. inference.InferenceSession.
+            address: (host, port) pair, port 0 picks a free port, or a Unix socket path. Default is ADDRESS.
+            max_delay (float): Longest wait for more requests, in seconds. Default is MAX_DELAY.
+            max_batch (int): Largest number of windows per model call. Default is MAX_BATCH.
+        '''
+        self.batcher = MicroBatcher(session, max_delay, max_batch)
+        if isinstance(address, str) and os.path.exists(address) and stat.S_ISSOCK(os.stat(address).st_mode):
+            # Left by a server that did not shut down, binding would fail with 'Address already in use'
+            os.unlink(address)
+        server_class = socketserver.ThreadingUnixStreamServer if isinstance(address, str) \
+            else socketserver.ThreadingTCPServer
+        self._server = server_class(address, _RequestHandler)
+        self._server.daemon_threads = True
+        self._server.batcher = self.batcher
+        self.address = self._server.server_address
+        self._thread = None
+
+    def serve_forever(self):
+        '''Serve requests until shutdown is called from another thread.'''
+        self._server.serve_forever()
+
+    def start(self):
+        '''Serve requests in a background thread.'''
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+
+    def shutdown(self):
+        '''Stop serving, close the socket, remove its file for a Unix socket and close the batcher.'''
+        if self._thread is not None:
+            self._server.shutdown()
+            self._thread.join()
+        self._server.server_close()
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.unlink(self.address)
+        self.batcher.close()
+
+
+class PredictionClient:
+    '''Client of a PredictionServer, one connection per client.'''
+
+    def __init__(self, address=ADDRESS):
+        '''
+        Args:
+            address: (host, port) pair or Unix socket path of the server. Default is ADDRESS.
+        '''
+        family = socket.AF_UNIX if isinstance(address, str) else socket.AF_INET
+        self._socket = socket.socket(family, socket.SOCK_STREAM)
+        self._socket.connect(address)
+        if family == socket.AF_INET:
+            self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._file = self._socket.makefile('rwb')
+
+    def _request(self, request):
+        '''Send one request and return its response, raising RuntimeError on a server error.'''
+        self._file.write((json.dumps(request) + '\n').encode())
+        self._file.flush()
+        response = json.loads(self._file.readline())
+        if 'error' in response:
+            raise RuntimeError(response['error'])
+        return response
+
+    def predict(self, windows):
+        '''Predict the next stock and bond prices of raw windows.
+
+        Args:
+            windows (ndarray): Unscaled window of shape (rolling_window, features), or a batch of them.
+
+        Returns:
+            ndarray: Predicted prices of shape (2,) for one window, (batch, 2) for a batch.
+        '''
+        return np.array(self._request({'windows': np.asarray(windows).tolist()})['predictions'])
+
+    def metrics(self):
+        '''Return the metrics of the server, see MicroBatcher.metrics.'''
+        return self._request({'command': 'metrics'})['metrics']
+
+    def close(self):
+        '''Close the connection.'''
+        self._file.close()
+        self._socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+if __name__ == '__main__':
+    from inference import InferenceSession
+
+    session = InferenceSession()
+    session.warmup()
+    server = PredictionServer(session)
+    print(f'Serving predictions on {server.address}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
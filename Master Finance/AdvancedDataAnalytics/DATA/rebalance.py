@@ -0,0 +1,55 @@
+import numpy as np
+
+
+def target_weights(predicted_prices, current_prices):
+    '''Turn predicted prices into target weights, as ML.adjust_portfolio does for one game.
+
+    Assets with a positive predicted return get a weight proportional to it, cash gets the
+    whole portfolio when no asset is expected to rise.
+
+    Args:
+        predicted_prices (ndarray): Predicted stock and bond prices of shape (N, 2).
+        current_prices (ndarray): Current stock and bond prices of shape (N, 2).
+
+    Returns:
+        ndarray: Stock, bond and cash weights of shape (N, 3).
+    '''
+    predicted_returns = (predicted_prices - current_prices) / current_prices
+    predicted_returns = np.where(predicted_returns > 0, predicted_returns, 0)
+    sum_returns = predicted_returns.sum(axis=1, keepdims=True)
+
+    weights = np.zeros((len(predicted_returns), 3))
+    invested = sum_returns[:, 0] > 0
+    weights[invested, :2] = predicted_returns[invested] / sum_returns[invested]
+    weights[~invested, 2] = 1
+    return weights
+
+
+def portfolio_values(money, stock_shares, bond_shares, prices):
+    '''Return the value of N portfolios, cash plus stocks and bonds at the given (N, 2) prices.'''
+    return money + stock_shares * prices[:, 0] + bond_shares * prices[:, 1]
+
+
+def rebalance(money, stock_shares, bond_shares, prices, weights):
+    '''Compute the holdings of N portfolios after trading to the target weights.
+
+    Trades are executed at the current prices without costs, so the portfolio value does not
+    change. As in the scene, cash and holdings never go negative: weights must be
+    non-negative and sum to 1 (no short selling and no borrowing).
+
+    Args:
+        money (ndarray): Cash of shape (N,).
+        stock_shares (ndarray): Stock shares of shape (N,).
+        bond_shares (ndarray): Bond shares of shape (N,).
+        prices (ndarray): Current stock and bond prices of shape (N, 2).
+        weights (ndarray): Target stock, bond and cash weights of shape (N, 3).
+
+    Returns:
+        tuple: Cash, stock shares and bond shares after the trades, each of shape (N,).
+    '''
+    weights = np.asarray(weights, dtype=float)
+    if np.any(weights < 0) or not np.allclose(weights.sum(axis=1), 1):
+        raise ValueError('Target weights must be non-negative and sum to 1')
+
+    values = portfolio_values(money, stock_shares, bond_shares, prices)
+    return weights[:, 2] * values, weights[:, 0] * values / prices[:, 0], weights[:, 1] * values / prices[:, 1]
@@ -0,0 +1,48 @@
+import numpy as np
+
+
+def as_seed_sequence(seed):
+    '''Return seed as a numpy SeedSequence.
+
+    Args:
+        seed (int, SeedSequence or None): Root seed, None draws fresh entropy from the OS.
+
+    Returns:
+        numpy.random.SeedSequence: The root seed sequence.
+    '''
+    if isinstance(seed, np.random.SeedSequence):
+        return seed
+    return np.random.SeedSequence(seed)
+
+
+def spawn_seeds(seed, n, start=0):
+    '''Derive independent child seed sequences from a root seed.
+
+    Child i only depends on the root seed and on i, not on how many children were
+    spawned before, so every worker can rebuild the streams of its own shard and the
+    generated data does not depend on the number of workers.
+
+    Args:
+        seed (int, SeedSequence or None): Root seed.
+        n (int): Number of children to derive.
+        start (int): Index of the first child. Default is 0.
+
+    Returns:
+        list: The n child numpy.random.SeedSequence objects, with indices start to start + n - 1.
+    '''
+    root = as_seed_sequence(seed)
+    return [np.random.SeedSequence(root.entropy, spawn_key=root.spawn_key + (i,)) for i in range(start, start + n)]
+
+
+def spawn_generators(seed, n, start=0):
+    '''Create independent random generators for the children of a root seed.
+
+    Args:
+        seed (int, SeedSequence or None): Root seed.
+        n (int): Number of generators to create.
+        start (int): Index of the first child. Default is 0.
+
+    Returns:
+        list: The n numpy.random.Generator objects.
+    '''
+    return [np.random.default_rng(child) for child in spawn_seeds(seed, n, start)]
@@ -1,9 +1,25 @@
+import copy
+from collections import namedtuple
 import numpy as np
-import random
+from rng_streams import as_seed_sequence
+
+# Fields of a recorded game state, in storage order
+STATE_FIELDS = ['Period', 'Stock_Price', 'Bond_Price', 'Fed_Rate', 'Inflation', 'Cash', 'Stock_Value', 'Bond_Value',
+                'Portfolio_Value', 'Stock_Weight', 'Bond_Weight', 'Cash_Weight']
+STATE_DTYPE = np.dtype([(field, np.float64) for field in STATE_FIELDS])
+
+# Saved mid-game state of a scene, see InvestmentScene.snapshot
+SceneSnapshot = namedtuple('SceneSnapshot', ['current_period', 'money', 'stock_share', 'bond_share', 'histories',
+                                             'game_states', 'n_states', 'rng_state'])
+
+# Histories saved in a snapshot, all append-only within a game
+HISTORIES = ['stock_price_history', 'bond_price_history', 'inflation_price_history', 'fed_rate_history',
+             'time_history']
 
 class InvestmentScene(object):
-    def __init__(self):
+    def __init__(self, seed=None):
         super(InvestmentScene, self).__init__() # Constructor of object class
+        self.seed(seed)  # Random stream owned by this scene
         self.WAIT_TIME = 200000  # 20 seconds in milliseconds
         self.MAX_PERIODS = 18
         self.current_period = 0
@@ -17,7 +33,9 @@ class InvestmentScene(object):
         self.inflation_price_history = []
         self.fed_rate_history = []
         self.time_history = []
-        self.game_states = []
+        # Preallocated state store: the initial state plus at most MAX_PERIODS + 12 turns
+        self.game_states = np.zeros(self.MAX_PERIODS + 13, dtype=STATE_DTYPE)
+        self.n_states = 0
         self.starting_stock_share = 0
         self.starting_bond_share = 0
         self.starting_money = 500000
@@ -46,25 +64,33 @@ class InvestmentScene(object):
         self.bond_inflation_coef = -2.5
         self.bond_fed_rate_coef = -2.5
 
+        self.market_path = None  # Stored market replayed instead of simulated, see replay_market
         self.generate_initial_data()
 
 
     def generate_initial_data(self):
-        # Generate initial data using log-normal distribution
-        self.inflation_price_history.append(random.uniform(0.02, 0.05))
-        self.fed_rate_history.append(random.uniform(0, 0.1))
-        self.stock_price_history.append(
-            np.random.lognormal(np.log(self.stock_mean ** 2 / np.sqrt(self.stock_sigma ** 2 + self.stock_mean ** 2)),
-                                np.sqrt(np.log(self.stock_sigma ** 2 / self.stock_mean ** 2 + 1))))
-        self.bond_price_history.append(
-            np.random.lognormal(np.log(self.bond_mean ** 2 / np.sqrt(self.bond_sigma ** 2 + self.bond_mean ** 2)),
-                                np.sqrt(np.log(self.bond_sigma ** 2 / self.bond_mean ** 2 + 1))))
+        if self.market_path is not None:
+            self.append_market_path_state()
+        else:
+            # Generate initial data using log-normal distribution
+            self.inflation_price_history.append(self.rng.uniform(0.02, 0.05))
+            self.fed_rate_history.append(self.rng.uniform(0, 0.1))
+            self.stock_price_history.append(
+                self.rng.lognormal(np.log(self.stock_mean ** 2 / np.sqrt(self.stock_sigma ** 2 + self.stock_mean ** 2)),
+                                    np.sqrt(np.log(self.stock_sigma ** 2 / self.stock_mean ** 2 + 1))))
+            self.bond_price_history.append(
+                self.rng.lognormal(np.log(self.bond_mean ** 2 / np.sqrt(self.bond_sigma ** 2 + self.bond_mean ** 2)),
+                                    np.sqrt(np.log(self.bond_sigma ** 2 / self.bond_mean ** 2 + 1))))
         self.time_history.append(0)
         self.update_game_state()
 
         for _ in range(11):
             self.handle_events('end_turn', 0)
     def generate_next_data(self):
+        if self.market_path is not None:
+            self.append_market_path_state()
+            return
+
         # Generate next data using ARMA(1,1)
         # Inflation
         mean = self.inflation_ar_coef * self.inflation_price_history[-1] + (
@@ -73,8 +99,8 @@ class InvestmentScene(object):
         fed_rate_change = self.fed_rate_history[-1] - self.fed_rate_mean
         stock_price_change = self.stock_price_history[-1] - self.stock_mean
         bond_price_change = self.bond_price_history[-1] - self.bond_mean
-        error = -0.01 * self.fed_rate_history[-1] + np.random.uniform(-0.1,
-                                                                      0.1) - self.stock_fed_rate_coef * fed_rate_change - self.stock_inflation_coef * inflation_change  # Impact of Fed rate and Inflation on stock prices
+        error = -0.01 * self.fed_rate_history[-1] + self.rng.uniform(-0.1,
+                                                                        0.1) - self.stock_fed_rate_coef * fed_rate_change - self.stock_inflation_coef * inflation_change  # Impact of Fed rate and Inflation on stock prices
         ma_term = self.inflation_ma_coef * error
         self.inflation_price_history.append(self.inflation_price_history[-1] * ma_term + mean + error)
 
@@ -82,7 +108,7 @@ class InvestmentScene(object):
         mean = self.fed_rate_ar_coef * self.fed_rate_history[-1] + (
                 1 - self.fed_rate_ar_coef) * self.fed_rate_mean + max(-0.025, min(0.025,
                                                                                   0.25 * inflation_change))  # Limit Fed rate variation to 2.5% per year
-        error = np.random.uniform(-0.1, 0.1)
+        error = self.rng.uniform(-0.1, 0.1)
         ma_term = self.fed_rate_ma_coef * error
         self.fed_rate_history.append(max(0, min(self.fed_rate_history[-1] * ma_term + mean + error, 0.1)))
 
@@ -91,7 +117,7 @@ class InvestmentScene(object):
                self.stock_inflation_coef * inflation_change + \
                self.stock_fed_rate_coef * fed_rate_change
 
-        error = np.random.normal(0, self.stock_sigma)
+        error = self.rng.normal(0, self.stock_sigma)
         ma_term = self.stock_ma_coef * error
         self.stock_price_history.append(self.stock_price_history[-1] * ma_term + mean + error)
 
@@ -100,11 +126,30 @@ class InvestmentScene(object):
                self.bond_inflation_coef * inflation_change + \
                self.bond_fed_rate_coef * fed_rate_change
 
-        error = np.random.normal(0, self.bond_sigma)
+        error = self.rng.normal(0, self.bond_sigma)
         ma_term = self.bond_ma_coef * error
         self.bond_price_history.append(self.bond_price_history[-1] * ma_term + mean + error)
         # self.update_game_state()
 
+    def append_market_path_state(self):
+        """
+        Append the next state of the replayed market path to the histories.
+        """
+        stock_price, bond_price, fed_rate, inflation = self.market_path[len(self.stock_price_history)]
+        self.stock_price_history.append(float(stock_price))
+        self.bond_price_history.append(float(bond_price))
+        self.fed_rate_history.append(float(fed_rate))
+        self.inflation_price_history.append(float(inflation))
+
+    def replay_market(self, market_path):
+        """
+        Restart the game on a stored market path of shape (states, 4), columns Stock_Price, Bond_Price,
+        Fed_Rate and Inflation (see market_paths.MarketPathLibrary). Prices are exogenous, so any
+        strategy sees exactly the same market. None goes back to simulating with the random stream.
+        """
+        self.market_path = market_path
+        self.reset_game()
+
     def render(self, screen):
         pass
     def update(self, screen):
@@ -152,10 +197,17 @@ class InvestmentScene(object):
         return self.portfolio_weights()
 
     def get_state(self):
-        return self.game_states
+        """
+        Return the recorded states as a structured array view (one record per period).
+        The view is overwritten by reset_game, copy it to keep the data.
+        """
+        return self.game_states[:self.n_states]
 
     def get_last_state(self):
-        return self.game_states[-1]
+        """
+        Return the most recent state as a record view, fields are accessed like a dict.
+        """
+        return self.game_states[self.n_states - 1]
 
 
     def get_portfolio_value(self):
@@ -164,13 +216,66 @@ class InvestmentScene(object):
         portfolio_value = self.money + stock_value + bond_value
         return portfolio_value
 
+    def seed(self, seed):
+        """
+        Replace the scene's random stream, the next reset_game then replays the same market for the same seed.
+        """
+        self.seed_sequence = as_seed_sequence(seed)
+        self.rng = np.random.default_rng(self.seed_sequence)
+
+    def snapshot(self):
+        """
+        Capture the current state of the game, including the position of the random stream.
+        The game has a fixed maximum length, so this is a small bounded copy (a few kilobytes).
+        """
+        return SceneSnapshot(self.current_period, self.money, self.stock_share, self.bond_share,
+                             tuple(getattr(self, name)[:] for name in HISTORIES),
+                             self.game_states[:self.n_states].copy(), self.n_states,
+                             self.rng.bit_generator.state)
+
+    def restore(self, snapshot):
+        """
+        Return the game to a snapshot, the following turns then replay the same market.
+        The snapshot is not consumed and can be restored again. Views from get_state are detached.
+        """
+        self.current_period = snapshot.current_period
+        self.money = snapshot.money
+        self.stock_share = snapshot.stock_share
+        self.bond_share = snapshot.bond_share
+        for name, history in zip(HISTORIES, snapshot.histories):
+            setattr(self, name, history[:])
+        self.game_states = np.zeros_like(self.game_states)
+        self.game_states[:snapshot.n_states] = snapshot.game_states
+        self.n_states = snapshot.n_states
+        self.rng.bit_generator.state = snapshot.rng_state
+
+    def fork(self, same_market=False):
+        """
+        Return an independent copy of the scene at its current state, e.g. to explore other decisions.
+
+        By default the fork continues with its own random stream, spawned from the scene's seed,
+        so every fork sees a different future market and the scene's own market is unchanged.
+        With same_market=True the fork replays exactly the market the scene will see.
+        """
+        child = copy.copy(self)  # Scalars and parameters, the mutable game state is copied below
+        for name in HISTORIES:
+            setattr(child, name, getattr(self, name)[:])
+        child.game_states = self.game_states.copy()
+        if same_market:
+            bit_generator = type(self.rng.bit_generator)(0)
+            bit_generator.state = self.rng.bit_generator.state
+            child.rng = np.random.Generator(bit_generator)
+        else:
+            child.seed(self.seed_sequence.spawn(1)[0])
+        return child
+
     def reset_game(self):
         self.inflation_price_history = []
         self.fed_rate_history = []
         self.stock_price_history = []
         self.bond_price_history = []
         self.time_history = []
-        self.game_states = []
+        self.n_states = 0
         self.current_period = 0
         self.money = self.starting_money
         self.stock_share = self.starting_stock_share
@@ -191,21 +296,12 @@ class InvestmentScene(object):
         bond_value = self.bond_share * self.bond_price_history[-1]
         portfolio_value = self.money + stock_value + bond_value
         stock_weight, bond_weight, cash_weight = self.portfolio_weights()
-        # Append the updated state
-        self.game_states.append({
-            'Period': self.current_period,
-            'Stock_Price': self.stock_price_history[-1],
-            'Bond_Price': self.bond_price_history[-1],
-            'Fed_Rate': self.fed_rate_history[-1],
-            'Inflation': self.inflation_price_history[-1],
-            'Cash': self.money,
-            'Stock_Value': stock_value,
-            'Bond_Value': bond_value,
-            'Portfolio_Value': portfolio_value,
-            'Stock_Weight': stock_weight,
-            'Bond_Weight': bond_weight,
-            'Cash_Weight': cash_weight
-        })
+        # Write the updated state into the next preallocated record
+        self.game_states[self.n_states] = (self.current_period, self.stock_price_history[-1],
+                                           self.bond_price_history[-1], self.fed_rate_history[-1],
+                                           self.inflation_price_history[-1], self.money, stock_value, bond_value,
+                                           portfolio_value, stock_weight, bond_weight, cash_weight)
+        self.n_states += 1
     def stock_value(self):
         """
         Calculate and return the value of the stocks in the portfolio.
@@ -281,6 +377,16 @@ class InvestmentScene(object):
             pass
             #print("Not enough bonds to sell.")
 
+    def set_holdings(self, money, stock_share, bond_share):
+        """
+        Set the cash and holdings directly, e.g. to the result of rebalance.rebalance.
+        """
+        if money < 0 or stock_share < 0 or bond_share < 0:
+            raise ValueError("Cash and holdings cannot be negative.")
+        self.money = money
+        self.stock_share = stock_share
+        self.bond_share = bond_share
+
     def increase_cash(self,change_amount):
         if self.stock_value() >= change_amount/2 and self.bond_value() >= change_amount/2:
             self.sell_stock(change_amount/2)
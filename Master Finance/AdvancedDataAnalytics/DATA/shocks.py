@@ -0,0 +1,135 @@
+'''Shock sources for BatchMarketSimulator.
+
+A shock source draws the standardized random inputs of a batch of games as an array of
+shape (num_games, n_states, 4): row 0 holds the draws of the initial state, row t the draws
+of period t. Columns 0 and 1 (inflation, Fed rate) are uniform on [0, 1), columns 2 and 3
+(stock, bond) are standard normal. The simulator maps them to the scene's distributions.
+'''
+
+import warnings
+import numpy as np
+
+
+class IIDShocks:
+    '''Independent draws, the plain Monte Carlo estimator.'''
+
+    def draw(self, num_games, n_states, rng, offset=0):
+        '''Draw the shocks of num_games games.
+
+        Args:
+            num_games (int): Number of games.
+            n_states (int): Number of states per game.
+            rng (numpy.random.Generator): Random generator to draw from.
+            offset (int): Index of the first game in the whole run, unused.
+
+        Returns:
+            numpy.ndarray: Shocks of shape (num_games, n_states, 4).
+        '''
+        shocks = np.empty((num_games, n_states, 4))
+        shocks[:, :, :2] = rng.random((num_games, n_states, 2))
+        shocks[:, :, 2:] = rng.standard_normal((num_games, n_states, 2))
+        return shocks
+
+
+class AntitheticShocks:
+    '''Antithetic pairs: every odd game mirrors the shocks of the game before it.
+
+    The mirror of a uniform u is 1 - u and the mirror of a normal z is -z, so both games
+    of a pair have the same distribution but negatively correlated outcomes. Game g of the
+    run belongs to pair g // 2, a pair is never split between chunks: chunks must start at
+    an even offset, so every chunk size but the last one must be even.
+    '''
+
+    def __init__(self, base=None):
+        '''
+        Args:
+            base (object): Shock source of the first game of every pair. Default is IIDShocks.
+        '''
+        self.base = IIDShocks() if base is None else base
+
+    def draw(self, num_games, n_states, rng, offset=0):
+        '''Draw the shocks of num_games games as antithetic pairs, see IIDShocks.draw.'''
+        if offset % 2:
+            # Both games of a pair must come from the same draw
+            raise ValueError(f'Antithetic chunks must start at an even game, got offset {offset}')
+        half = self.base.draw((num_games + 1) // 2, n_states, rng, offset // 2)
+        shocks = np.empty((2 * half.shape[0], n_states, 4))
+        shocks[0::2] = half
+        shocks[1::2, :, :2] = 1 - half[:, :, :2]
+        shocks[1::2, :, 2:] = -half[:, :, 2:]
+        return shocks[:num_games]
+
+
+class SobolShocks:
+    '''Randomized quasi-Monte Carlo shocks from a scrambled Sobol sequence (requires scipy).
+
+    All games of a run are consecutive points of the same sequence, chunks use offset to
+    skip ahead, so splitting the run into chunks keeps the low-discrepancy property.
+    The scrambling only depends on the seed, so every chunk, worker and run with the same
+    seed draws from the same sequence. The points are only balanced in blocks of a power of 2,
+    so the chunk size (DataProcessing's chunk_size, e.g. 1024 rather than the default 1000) and
+    the number of games should be powers of 2; other sizes draw with a warning, given once.
+    '''
+
+    def __init__(self, seed):
+        '''
+        Args:
+            seed (int): Seed of the scrambling, the same seed gives the same sequence.
+        '''
+        if seed is None:
+            raise ValueError('SobolShocks needs a seed, every chunk must use the same scrambled sequence')
+        self.seed = seed
+        # Scrambled samplers per dimension, built once (a cache, left out of the dataset fingerprint)
+        self._samplers = {}
+        self._warned = False
+
+    def draw(self, num_games, n_states, rng, offset=0):
+        '''Draw the shocks of games offset to offset + num_games of the sequence, see IIDShocks.draw.
+
+        The rng argument is unused, the sequence only depends on the scrambling seed.
+        '''
+        from scipy.stats import qmc
+        from scipy.special import ndtri
+
+        if n_states not in self._samplers:
+            self._samplers[n_states] = qmc.Sobol(d=n_states * 4, scramble=True, seed=self.seed)
+        sampler = self._samplers[n_states]
+        sampler.reset()
+        if offset:
+            sampler.fast_forward(offset)
+        # Balanced when the games are a power of 2 block of the sequence
+        balanced = num_games & (num_games - 1) == 0 and offset % num_games == 0
+        if not balanced and not self._warned:
+            warnings.warn(f'SobolShocks drew {num_games} games from game {offset}: the Sobol points are only '
+                          f'balanced in blocks of a power of 2 games, use a power of 2 chunk size and number '
+                          f'of games (e.g. chunk_size=1024)', UserWarning, stacklevel=2)
+            self._warned = True
+        with warnings.catch_warnings():
+            # Reported once above rather than by scipy for every chunk
+            warnings.filterwarnings('ignore', message='The balance properties of Sobol', category=UserWarning)
+            shocks = sampler.random(num_games).reshape(num_games, n_states, 4)
+
+        # Inverse normal CDF for the stock and bond columns, away from the infinite tails
+        eps = np.finfo(float).eps
+        shocks[:, :, 2:] = ndtri(np.clip(shocks[:, :, 2:], eps, 1 - eps))
+        return shocks
+
+
+class ReplayShocks:
+    '''Replay of pre-drawn shocks, e.g. to compare parameters or strategies on common random numbers.'''
+
+    def __init__(self, shocks):
+        '''
+        Args:
+            shocks (numpy.ndarray): Shocks of shape (total_games, n_states, 4), see IIDShocks.draw.
+        '''
+        self.shocks = np.asarray(shocks, dtype=np.float64)
+
+    def draw(self, num_games, n_states, rng, offset=0):
+        '''Return the stored shocks of games offset to offset + num_games, see IIDShocks.draw.'''
+        if self.shocks.shape[1:] != (n_states, 4):
+            raise ValueError(f'Stored shocks have shape {self.shocks.shape[1:]}, expected {(n_states, 4)}')
+        if offset + num_games > self.shocks.shape[0]:
+            raise ValueError(f'Only {self.shocks.shape[0]} games of shocks stored, '
+                             f'{offset + num_games} requested')
+        return self.shocks[offset:offset + num_games].copy()
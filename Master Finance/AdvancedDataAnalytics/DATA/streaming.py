@@ -0,0 +1,154 @@
+import numpy as np
+import tensorflow as tf
+from rng_streams import as_seed_sequence, spawn_generators, spawn_seeds
+
+'''Children of the seed of the shard shuffling, the scaler sample, the validation and the test games, far above
+the indices of the chunks of training games, so none of them shares random draws with the training data. Shock
+sources that ignore the generator (SobolShocks, ReplayShocks) draw the same games in every stream.'''
+SHUFFLE_STREAM = 2 ** 31
+SCALER_STREAM = 2 ** 31 + 1
+VALIDATION_STREAM = 2 ** 31 + 2
+TEST_STREAM = 2 ** 31 + 3
+
+
+def stream_seed(seed, stream):
+    '''Return the seed of a separate stream of seed, e.g. stream_seed(seed, VALIDATION_STREAM).'''
+    return spawn_seeds(seed, 1, start=stream)[0]
+
+
+def fit_scaler(data_processing, num_games=2000, seed=None):
+    '''Fit data_processing.scaler_X on the windows of freshly simulated games.
+
+    Args:
+        data_processing (DataProcessing): Data processing object whose simulator and scaler are used.
+        num_games (int): Number of games to fit the scaler on. Default is 2000.
+        seed (int): Seed of the training stream, the games are drawn from its SCALER_STREAM child.
+
+    Returns:
+        MinMaxScaler: The fitted data_processing.scaler_X.
+    '''
+    X, _ = next(simulate_windows(data_processing, num_games, num_chunks=1, seed=stream_seed(seed, SCALER_STREAM)))
+    return data_processing.fit_scaler(X)
+
+
+def simulate_windows(data_processing, games_per_chunk=1000, num_chunks=None, seed=None):
+    '''Generator of unscaled training examples from freshly simulated chunks of games.
+
+    Args:
+        data_processing (DataProcessing): Data processing object providing the simulator and windows.
+        games_per_chunk (int): Number of games simulated at once. Default is 1000.
+        num_chunks (int): Number of chunks to generate, None never stops.
+        seed (int): Seed of the stream, chunk i uses its child i.
+
+    Yields:
+        tuple: float32 arrays X of shape (samples, rolling_window, inputs) and y of shape (samples, targets).
+    '''
+    seed_sequence = as_seed_sequence(seed)
+    chunk = 0
+    while num_chunks is None or chunk < num_chunks:
+        rng, = spawn_generators(seed_sequence, 1, start=chunk)
+        games = data_processing.simulator.simulate(games_per_chunk, rng, offset=chunk * games_per_chunk)
+        X, y = data_processing.build_windows(games)
+        yield X.astype(np.float32), y.astype(np.float32)
+        chunk += 1
+
+
+def make_streaming_dataset(data_processing, batch_size=32, shuffle_buffer=None, games_per_chunk=1000,
+                           num_chunks=None, seed=None):
+    '''Create a tf.data pipeline that feeds freshly simulated games to model.fit.
+
+    Chunks of games are simulated on demand, cut into windows, shuffled through a bounded
+    buffer, batched, scaled with the fitted data_processing.scaler_X and prefetched, so the
+    memory use does not depend on the number of games seen.
+
+    Args:
+        data_processing (DataProcessing): Data processing object with a fitted scaler_X (see fit_scaler).
+        batch_size (int): Batch size. Default is 32.
+        shuffle_buffer (int): Number of examples in the shuffling buffer. Default is the windows of
+            one chunk, smaller buffers only mix the windows of a few consecutive games of the chunk.
+        games_per_chunk (int): Number of games simulated at once. Default is 1000.
+        num_chunks (int): Number of chunks, None for an infinite dataset (set steps_per_epoch in fit).
+        seed (int): Seed of the simulated games, use stream_seed(seed, VALIDATION_STREAM) for validation games.
+
+    Returns:
+        tf.data.Dataset: Dataset of scaled (X, y) batches.
+    '''
+    rolling_window = data_processing.rolling_window
+    n_inputs = len(data_processing.input_columns)
+    n_targets = len(data_processing.target_columns)
+    if shuffle_buffer is None:
+        shuffle_buffer = games_per_chunk * (data_processing.simulator.n_states - rolling_window)
+
+    dataset = tf.data.Dataset.from_generator(
+        lambda: simulate_windows(data_processing, games_per_chunk, num_chunks, seed),
+        output_signature=(tf.TensorSpec(shape=(None, rolling_window, n_inputs), dtype=tf.float32),
+                          tf.TensorSpec(shape=(None, n_targets), dtype=tf.float32)))
+    dataset = dataset.unbatch().shuffle(shuffle_buffer).batch(batch_size)
+    dataset = dataset.map(_scaling(data_processing), num_parallel_calls=tf.data.AUTOTUNE)
+    return dataset.prefetch(tf.data.AUTOTUNE)
+
+
+def make_shard_dataset(data_processing, shards, batch_size=32, shuffle_buffer=None, seed=None):
+    '''Create a tf.data pipeline over stored (e.g. memory-mapped, cached) shards.
+
+    Shards are read one at a time in a random order and scaled lazily per batch with the
+    fitted data_processing.scaler_X (see DataProcessing.fit_scaler), so the dataset only
+    needs to fit on disk. Every iteration (epoch) reads the shards in a new order, drawn from
+    one seeded stream, so a run with the same seed sees the same sequence of examples.
+
+    Args:
+        data_processing (DataProcessing): Data processing object with a fitted scaler_X.
+        shards (list): (X, y) shard pairs, see DataProcessing.window_shards and get_shard_split.
+        batch_size (int): Batch size. Default is 32.
+        shuffle_buffer (int): Number of examples in the shuffling buffer. Default is the size of
+            the largest shard, so the examples of a shard are fully mixed.
+        seed (int): Seed of the shuffling. Default is data_processing.seed_sequence.
+
+    Returns:
+        tf.data.Dataset: Dataset of scaled (X, y) batches, one pass over all shards per iteration.
+    '''
+    rolling_window = data_processing.rolling_window
+    n_inputs = len(data_processing.input_columns)
+    n_targets = len(data_processing.target_columns)
+    if shuffle_buffer is None:
+        shuffle_buffer = max(len(X) for X, _ in shards)
+    # Its own stream, the children 0, 1, ... of the seed are the chunks of games
+    rng, = spawn_generators(data_processing.seed_sequence if seed is None else seed, 1, start=SHUFFLE_STREAM)
+
+    def read_shards():
+        for i in rng.permutation(len(shards)):
+            X, y = shards[i]
+            yield np.asarray(X, dtype=np.float32), np.asarray(y, dtype=np.float32)
+
+    dataset = tf.data.Dataset.from_generator(
+        read_shards,
+        output_signature=(tf.TensorSpec(shape=(None, rolling_window, n_inputs), dtype=tf.float32),
+                          tf.TensorSpec(shape=(None, n_targets), dtype=tf.float32)))
+    dataset = dataset.unbatch().shuffle(shuffle_buffer, seed=int(rng.integers(2 ** 31))).batch(batch_size)
+    dataset = dataset.map(_scaling(data_processing), num_parallel_calls=tf.data.AUTOTUNE)
+    return dataset.prefetch(tf.data.AUTOTUNE)
+
+
+def _scaling(data_processing):
+    '''Return a tf.data map function applying the fitted scaler_X to the window batches.'''
+    shape = (data_processing.rolling_window, len(data_processing.input_columns))
+    # MinMaxScaler.transform of the flattened window, X * scale_ + min_, applied per window
+    scale = tf.constant(data_processing.scaler_X.scale_.reshape(shape), dtype=tf.float32)
+    offset = tf.constant(data_processing.scaler_X.min_.reshape(shape), dtype=tf.float32)
+    return lambda X, y: (X * scale + offset, y)
+
+
+def simulate_test_set(data_processing, num_games=4000, seed=None):
+    '''Simulate a fixed, scaled test set for test_model.
+
+    Args:
+        data_processing (DataProcessing): Data processing object with a fitted scaler_X.
+        num_games (int): Number of games. Default is 4000.
+        seed (int): Seed of the training stream, the games are drawn from its TEST_STREAM child.
+
+    Returns:
+        tuple: Numpy arrays X_test and y_test.
+    '''
+    X, y = next(simulate_windows(data_processing, num_games, num_chunks=1, seed=stream_seed(seed, TEST_STREAM)))
+    X = data_processing.scaler_X.transform(X.reshape(X.shape[0], -1)).reshape(X.shape)
+    return X, y
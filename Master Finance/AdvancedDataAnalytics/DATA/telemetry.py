@@ -0,0 +1,208 @@
+import glob
+import os
+import numpy as np
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+LEVELS = {'DEBUG': DEBUG, 'INFO': INFO, 'WARNING': WARNING}
+
+# One record per run, game and period
+PERIOD_DTYPE = np.dtype([('run', np.int32), ('game', np.int64), ('period', np.int32),
+                         ('stock_prediction', np.float64), ('bond_prediction', np.float64),
+                         ('stock_price', np.float64), ('bond_price', np.float64),
+                         ('stock_weight', np.float64), ('bond_weight', np.float64), ('cash_weight', np.float64),
+                         ('portfolio_value', np.float64), ('latency', np.float64)])
+
+
+class TelemetryRecorder:
+    '''Structured per-period telemetry of the game loops, kept out of the terminal.
+
+    Records (prediction, prices, weights, value and prediction latency per game and period)
+    are written into a preallocated ring buffer. With a path, every full buffer is flushed to
+    a columnar part file (one array per field) in that directory, otherwise the oldest
+    records are overwritten. Messages are only printed at or above the level, and
+    per-period records are also printed at DEBUG, like the former verbose loops. Every game
+    loop starts a new run (see new_run), so the games of two runs with the same numbers are
+    told apart.
+
+    Attributes:
+        level (int): Lowest level of the printed messages (DEBUG, INFO or WARNING).
+        run (int): Number of the current run, stored with its records.
+        sample_rate (float): Fraction of the games whose periods are recorded.
+        path (str): Directory of the columnar part files, None keeps the records in memory only.
+        n_records (int): Number of records written since the start.
+    '''
+
+    def __init__(self, level=INFO, sample_rate=1.0, capacity=100000, path=None, seed=None):
+        '''
+        Args:
+            level (int or str): Lowest level of the printed messages. Default is INFO.
+            sample_rate (float): Fraction of the games whose periods are recorded. Default is 1.
+            capacity (int): Number of records in the ring buffer. Default is 100000.
+            path (str): Directory of the columnar part files. Default is None.
+            seed (int): Seed of the game sampling.
+        '''
+        self.level = LEVELS[level] if isinstance(level, str) else level
+        self.sample_rate = sample_rate
+        self.path = path
+        self.n_records = 0
+        self.run = 0
+        self._buffer = np.zeros(capacity, dtype=PERIOD_DTYPE)
+        self._n_flushed = 0
+        self._n_parts = 0
+        self._rng = np.random.default_rng(seed)
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+
+    def enabled(self, level):
+        '''Return True if messages of the given level are printed.'''
+        return level >= self.level
+
+    def log(self, message, level=INFO, end='\n'):
+        '''Print a message if its level is enabled.'''
+        if level >= self.level:
+            print(message, end=end)
+
+    def new_run(self):
+        '''Start a new run, call it before a game loop numbering its games from 0.
+
+        Returns:
+            int: Number of the new run.
+        '''
+        self.run += 1
+        return self.run
+
+    def sample(self, n_games=None):
+        '''Draw which games are recorded, call it when the games start.
+
+        Args:
+            n_games (int): Number of games drawn at once, None for a single game.
+
+        Returns:
+            bool or ndarray: True for the recorded games.
+        '''
+        if n_games is None:
+            return self.sample_rate >= 1 or self._rng.random() < self.sample_rate
+        return np.ones(n_games, dtype=bool) if self.sample_rate >= 1 else self._rng.random(n_games) < self.sample_rate
+
+    def record(self, game, period, predictions, prices, weights, values, latency=np.nan):
+        '''Write the records of one period of one or many games.
+
+        Args:
+            game (int or ndarray): Game number(s).
+            period (int): Period of the games.
+            predictions (ndarray): Predicted stock and bond prices, (2,) or (N, 2).
+            prices (ndarray): Current stock and bond prices, (2,) or (N, 2).
+            weights (ndarray): Stock, bond and cash weights, (3,) or (N, 3).
+            values (float or ndarray): Portfolio values.
+            latency (float or ndarray): Prediction latency per game, in seconds.
+        '''
+        games = np.atleast_1d(game)
+        records = np.empty(len(games), dtype=PERIOD_DTYPE)
+        records['run'] = self.run
+        records['game'] = games
+        records['period'] = period
+        records['stock_prediction'], records['bond_prediction'] = np.reshape(predictions, (-1, 2)).T
+        records['stock_price'], records['bond_price'] = np.reshape(prices, (-1, 2)).T
+        records['stock_weight'], records['bond_weight'], records['cash_weight'] = np.reshape(weights, (-1, 3)).T
+        records['portfolio_value'] = values
+        records['latency'] = latency
+        if self.level <= DEBUG:
+            for record in records:
+                print(record)
+        self._write(records)
+
+    def _write(self, records):
+        '''Copy records into the ring buffer, flushing it to disk when full if a path is set.'''
+        capacity = len(self._buffer)
+        while len(records):
+            position = self.n_records % capacity
+            n = min(len(records), capacity - position)
+            if self.path is not None:
+                # Never overwrite records that are not flushed yet
+                n = min(n, capacity - (self.n_records - self._n_flushed))
+            self._buffer[position:position + n] = records[:n]
+            self.n_records += n
+            records = records[n:]
+            if self.path is not None and self.n_records - self._n_flushed == capacity:
+                self.flush()
+
+    def records(self):
+        '''Return the records held in memory, oldest first (the records not flushed yet when a path is set).'''
+        capacity = len(self._buffer)
+        start = max(self._n_flushed, self.n_records - capacity)
+        index = np.arange(start, self.n_records) % capacity
+        return self._buffer[index]
+
+    def flush(self):
+        '''Write the records not flushed yet to a new columnar part file in path.'''
+        if self.path is None:
+            return
+        records = self.records()
+        if len(records):
+            np.savez(os.path.join(self.path, f'part_{self._n_parts:05d}.npz'),
+                     **{name: records[name] for name in PERIOD_DTYPE.names})
+            self._n_parts += 1
+        self._n_flushed = self.n_records
+
+    def close(self):
+        '''Flush the remaining records.'''
+        self.flush()
+
+    def summary(self, records=None):
+        '''Aggregate the records per period.
+
+        Args:
+            records (ndarray): Records to summarize. Default is the records in memory, see also load.
+
+        Returns:
+            dict: Number of records, prediction latency percentiles (ms) and, per period, the number of
+                games, mean portfolio value, mean weights and mean absolute prediction errors.
+        '''
+        records = self.records() if records is None else records
+        summary = {'records': len(records)}
+        latency = records['latency'][~np.isnan(records['latency'])] * 1000
+        if len(latency):
+            summary['latency_p50'] = float(np.percentile(latency, 50))
+            summary['latency_p99'] = float(np.percentile(latency, 99))
+
+        periods = {}
+        for period in np.unique(records['period']):
+            current = records[records['period'] == period]
+            following = records[records['period'] == period + 1]
+            stats = {'games': len(current), 'mean_value': float(current['portfolio_value'].mean())}
+            for name in ('stock_weight', 'bond_weight', 'cash_weight'):
+                stats[f'mean_{name}'] = float(current[name].mean())
+            # The prediction of a period is compared to the price of the next period of the same game
+            keys, following_keys = current[['run', 'game']], following[['run', 'game']]
+            if len(np.unique(keys)) < len(keys):
+                raise ValueError(f'Period {period} has several records of the same run and game, '
+                                 f'call new_run before every game loop')
+            common, i, j = np.intersect1d(keys, following_keys, return_indices=True)
+            if len(common):
+                for asset in ('stock', 'bond'):
+                    error = current[f'{asset}_prediction'][i] - following[f'{asset}_price'][j]
+                    stats[f'{asset}_mae'] = float(np.abs(error).mean())
+            periods[int(period)] = stats
+        summary['periods'] = periods
+        return summary
+
+
+def load(path):
+    '''Load all records written to the columnar part files of a recorder path.
+
+    Args:
+        path (str): Directory of the part files.
+
+    Returns:
+        ndarray: The records, with dtype PERIOD_DTYPE.
+    '''
+    parts = []
+    for part_file in sorted(glob.glob(os.path.join(path, 'part_*.npz'))):
+        with np.load(part_file) as columns:
+            part = np.empty(len(columns['game']), dtype=PERIOD_DTYPE)
+            for name in PERIOD_DTYPE.names:
+                part[name] = columns[name]
+            parts.append(part)
+    return np.concatenate(parts) if parts else np.empty(0, dtype=PERIOD_DTYPE)
@@ -1,21 +1,29 @@
 import datetime
+import json
+import os
+import time
 from matplotlib import pyplot as plt
+import numpy as np
 import tensorflow as tf
 from sklearn.metrics import mean_squared_error, mean_absolute_error, r2_score
+from trial_store import data_fingerprint
 
 
-def train_model(model, X_train, y_train, epochs=100, batch_size=32, val_split=0.2,callbacks=None):
+def train_model(model, X_train, y_train, epochs=100, batch_size=32, val_split=0.2,callbacks=None,
+                validation_data=None, steps_per_epoch=None):
     '''Train the model and display a plot of training and validation loss.
 
     Args:
         model (tf.keras.Model): The model to train.
-        X_train (numpy.ndarray): Training data.
-        y_train (numpy.ndarray): Labels for the training data.
+        X_train (numpy.ndarray or tf.data.Dataset): Training data, or a dataset of (X, y) batches.
+        y_train (numpy.ndarray): Labels for the training data, None when X_train is a dataset.
         epochs (int): Number of epochs to train the model. Default is 100.
         batch_size (int): Batch size for training. Default is 32.
         val_split (float): Fraction of the training data to be used as validation data. Default is 0.2.
         # dsadasdasd CALLBACK ATTENTION ENLEVE APRES SI BESOIN!
         callbacks (list): List of callbacks to apply during training.
+        validation_data: Validation data (tuple of arrays or dataset), replaces val_split when given.
+        steps_per_epoch (int): Number of batches per epoch, required for an infinite dataset.
 
     Returns:
         history (History): History object. Its History.history attribute is a record of training loss values 
@@ -25,17 +33,27 @@ def train_model(model, X_train, y_train, epochs=100, batch_size=32, val_split=0.
     # tensorboard for debugging/graph of the NN, this was for our own purpose (also used in create_model)
     # tensorboard_callback = tf.keras.callbacks.TensorBoard(log_dir=log_dir, histogram_freq=1)
 
+    # Datasets are already batched and cannot be split by Keras
+    is_dataset = isinstance(X_train, tf.data.Dataset)
     history = model.fit(
         X_train,
         y_train,
         epochs=epochs,
-        batch_size=batch_size,
+        batch_size=None if is_dataset else batch_size,
         verbose=1,
-        validation_split=val_split,
+        validation_split=0.0 if validation_data is not None or is_dataset else val_split,
+        validation_data=validation_data,
+        steps_per_epoch=steps_per_epoch,
         # callbacks=[tensorboard_callback]
         callbacks=callbacks
     )
 
+    plot_loss(history)
+    return history
+
+
+def plot_loss(history):
+    '''Display and save a plot of the training and validation loss of a History.'''
     plt.figure(figsize=(12, 6))
     plt.plot(history.history['loss'])
     plt.plot(history.history['val_loss'])
@@ -45,6 +63,245 @@ def train_model(model, X_train, y_train, epochs=100, batch_size=32, val_split=0.
     plt.legend(['Train', 'Validation'], loc='upper left')
     plt.show()
     plt.savefig('Loss Function', dpi=300)
+
+
+class ThroughputCallback(tf.keras.callbacks.Callback):
+    '''Measure the training throughput of every epoch, in samples per second.
+
+    The time runs from the start of the epoch to its last training batch, so validation
+    is not counted. The throughput is printed and added to the epoch logs (and the History)
+    as 'samples_per_sec'.
+
+    Attributes:
+        samples_per_epoch (int): Number of training samples per epoch.
+        samples_per_sec (list): Throughput of every epoch.
+    '''
+
+    def __init__(self, samples_per_epoch):
+        super().__init__()
+        self.samples_per_epoch = samples_per_epoch
+        self.samples_per_sec = []
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self._start = self._end = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        self._end = time.perf_counter()
+
+    def on_epoch_end(self, epoch, logs=None):
+        rate = self.samples_per_epoch / max(self._end - self._start, 1e-9)
+        self.samples_per_sec.append(rate)
+        if logs is not None:
+            logs['samples_per_sec'] = rate
+        print(f'Epoch {epoch + 1}: {rate:.0f} samples/sec')
+
+
+def configure_threads(intra_op_threads=None, inter_op_threads=2):
+    '''Set the TensorFlow CPU thread pools, before any model or tensor is created.
+
+    Args:
+        intra_op_threads (int): Threads used inside one op (matrix products). Default is the number of cores.
+        inter_op_threads (int): Ops run concurrently. Default is 2, the LSTM graph is mostly sequential.
+
+    Returns:
+        bool: False if TensorFlow was already initialized and the settings could not be changed.
+    '''
+    try:
+        tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads or os.cpu_count())
+        tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+    except RuntimeError:
+        return False
+    return True
+
+
+def make_array_dataset(X, y, batch_size, shuffle=True, seed=None):
+    '''Create a cached, shuffled and prefetched tf.data pipeline over in-memory arrays.
+
+    Args:
+        X (numpy.ndarray): Inputs of shape (samples, rolling_window, features).
+        y (numpy.ndarray): Labels of shape (samples, targets).
+        batch_size (int): Batch size.
+        shuffle (bool): Reshuffle the samples every epoch. Default is True.
+        seed (int): Seed of the shuffling.
+
+    Returns:
+        tf.data.Dataset: Dataset of float32 (X, y) batches.
+    '''
+    dataset = tf.data.Dataset.from_tensor_slices((np.asarray(X, dtype=np.float32), np.asarray(y, dtype=np.float32)))
+    dataset = dataset.cache()
+    if shuffle:
+        dataset = dataset.shuffle(len(X), seed=seed, reshuffle_each_iteration=True)
+    return dataset.batch(batch_size).prefetch(tf.data.AUTOTUNE)
+
+
+def train_model_fast(model, X_train, y_train, epochs=100, batch_size=256, val_split=0.2, callbacks=None,
+                     base_batch_size=32, jit_compile=False, seed=None, plot=True):
+    '''Train the model on a tf.data pipeline with large batches, faster than train_model on CPU.
+
+    The last val_split of the samples is kept for validation, as in train_model, without copying
+    the arrays through Keras. The learning rate of the compiled optimizer is scaled linearly with
+    batch_size / base_batch_size, so large batches converge in about as many epochs. The rate
+    the optimizer had on the first call is kept as its base_learning_rate and every later call
+    scales that rate again. Call configure_threads first to tune the CPU thread pools.
+
+    Args:
+        model (tf.keras.Model): The compiled model to train, its optimizer learning rate is changed.
+        X_train (numpy.ndarray): Training data.
+        y_train (numpy.ndarray): Labels for the training data.
+        epochs (int): Number of epochs to train the model. Default is 100.
+        batch_size (int): Batch size for training. Default is 256.
+        val_split (float): Fraction of the training data to be used as validation data. Default is 0.2.
+        callbacks (list): List of callbacks to apply during training.
+        base_batch_size (int): Batch size the learning rate was tuned for. Default is 32.
+        jit_compile (bool): Compile the training step with XLA, compare the reported throughputs, XLA
+            handles the LSTM loops poorly and can be much slower on CPU. Default is False.
+        seed (int): Seed of the shuffling.
+        plot (bool): Display the loss plot, as train_model. Default is True.
+
+    Returns:
+        history (History): History object, with the 'samples_per_sec' of every epoch.
+    '''
+    n_train = int(len(X_train) * (1 - val_split))
+    train_dataset = make_array_dataset(X_train[:n_train], y_train[:n_train], batch_size, seed=seed)
+    validation_dataset = make_array_dataset(X_train[n_train:], y_train[n_train:], batch_size, shuffle=False) \
+        if n_train < len(X_train) else None
+
+    # Scale the rate the optimizer was compiled with, so repeated calls do not compound the scaling
+    optimizer = model.optimizer
+    if not hasattr(optimizer, 'base_learning_rate'):
+        optimizer.base_learning_rate = float(tf.keras.backend.get_value(optimizer.learning_rate))
+    tf.keras.backend.set_value(optimizer.learning_rate, optimizer.base_learning_rate * batch_size / base_batch_size)
+    if jit_compile:
+        model.compile(loss=model.loss, optimizer=model.optimizer, jit_compile=True)
+
+    throughput = ThroughputCallback(n_train)
+    history = model.fit(
+        train_dataset,
+        epochs=epochs,
+        verbose=1,
+        validation_data=validation_dataset,
+        callbacks=[throughput] + list(callbacks or [])
+    )
+
+    if plot and validation_dataset is not None:
+        plot_loss(history)
+    return history
+
+
+def _write_json(path, content):
+    '''Write a JSON file atomically, an interruption leaves the previous version.'''
+    with open(path + '.tmp', 'w') as f:
+        json.dump(content, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def train_model_resumable(model, X_train, y_train, checkpoint_dir, epochs=100, batch_size=32, val_split=0.2,
+                          patience=3, restore_best_weights=True, seed=0, save_every_steps=None, plot=True):
+    '''Train the model with checkpoints, resuming automatically where an interrupted run stopped.
+
+    The epochs are run by hand: the samples of epoch e are visited in the order of a permutation
+    drawn from default_rng([seed, e]), so a resumed run sees the data in exactly the same order.
+    After every epoch (and every save_every_steps batches) the weights, optimizer state and
+    epoch counter are saved with a tf.train.CheckpointManager, and the early-stopping state,
+    the losses and the position in the epoch to <checkpoint_dir>/state.json. Calling it again
+    with the same checkpoint_dir and data continues the training, or returns at once if it
+    had finished. The dropout masks are drawn again from a seed of (seed, epoch, batch) at
+    every save, so a resumed run trains exactly as an uninterrupted one.
+
+    Args:
+        model (tf.keras.Model): The compiled model to train.
+        X_train (numpy.ndarray): Training data.
+        y_train (numpy.ndarray): Labels for the training data.
+        checkpoint_dir (str): Directory of the checkpoints and of the training state.
+        epochs (int): Number of epochs to train the model. Default is 100.
+        batch_size (int): Batch size for training. Default is 32.
+        val_split (float): Fraction of the training data to be used as validation data. Default is 0.2.
+        patience (int): Epochs without improvement of the validation loss before stopping. Default is 3.
+        restore_best_weights (bool): End with the weights of the best epoch, as EarlyStopping. Default is True.
+        seed (int): Seed of the data order and of the dropout masks. Default is 0.
+        save_every_steps (int): Also save every that many batches, None saves after every epoch only.
+        plot (bool): Display the loss plot, as train_model. Default is True.
+
+    Returns:
+        history (History): History object with the losses of all epochs, resumed ones included.
+    '''
+    n_train = int(len(X_train) * (1 - val_split))
+    X_val, y_val = X_train[n_train:], y_train[n_train:]
+    n_batches = -(-n_train // batch_size)
+
+    epoch_counter = tf.Variable(0, dtype=tf.int64, trainable=False)
+    checkpoint = tf.train.Checkpoint(model=model, optimizer=model.optimizer, epoch=epoch_counter)
+    manager = tf.train.CheckpointManager(checkpoint, checkpoint_dir, max_to_keep=2)
+    # The weights of the best epoch, restored at the end
+    best_checkpoint = tf.train.Checkpoint(model=model)
+    best_prefix = os.path.join(checkpoint_dir, 'best', 'weights')
+    state_path = os.path.join(checkpoint_dir, 'state.json')
+
+    state = {'epoch': 0, 'step': 0, 'loss_sum': 0.0, 'best': None, 'best_epoch': None, 'wait': 0,
+             'stopped': False, 'seed': seed, 'n_train': n_train, 'batch_size': batch_size,
+             'data': data_fingerprint(X_train, y_train), 'history': {'loss': [], 'val_loss': []}}
+    if manager.latest_checkpoint is not None and os.path.exists(state_path):
+        with open(state_path) as f:
+            saved = json.load(f)
+        if saved.get('data') != state['data']:
+            raise ValueError(f'The checkpoints in {checkpoint_dir} were trained on other data')
+        if (saved['seed'], saved['n_train'], saved['batch_size']) != (seed, n_train, batch_size):
+            raise ValueError(f'The checkpoints in {checkpoint_dir} belong to another training '
+                             f'(seed, samples, batch size {saved["seed"], saved["n_train"], saved["batch_size"]})')
+        # The state names the checkpoint it matches, still kept (max_to_keep=2) if a run stopped between the two saves
+        checkpoint.restore(saved['checkpoint'])
+        state = saved
+        if state['epoch'] < epochs and not state['stopped']:
+            print(f'Resuming from epoch {state["epoch"] + 1}, batch {state["step"]}')
+    else:
+        os.makedirs(checkpoint_dir, exist_ok=True)
+
+    def save():
+        epoch_counter.assign(state['epoch'])
+        state['checkpoint'] = manager.save()
+        _write_json(state_path, state)
+
+    def reseed_dropout(epoch, step):
+        # The dropout ops keep their random state in the traced train function, retracing after
+        # setting the seed restarts them where a resumed run starts too
+        tf.random.set_seed(int(np.random.default_rng([seed, epoch, step]).integers(2 ** 31)))
+        model.make_train_function(force=True)
+
+    while state['epoch'] < epochs and not state['stopped']:
+        epoch = state['epoch']
+        permutation = np.random.default_rng([seed, epoch]).permutation(n_train)
+        reseed_dropout(epoch, state['step'])
+        for step in range(state['step'], n_batches):
+            index = np.sort(permutation[step * batch_size:(step + 1) * batch_size])
+            loss = model.train_on_batch(X_train[index], y_train[index])
+            state['loss_sum'] += float(loss) * len(index)
+            state['step'] = step + 1
+            if save_every_steps and state['step'] % save_every_steps == 0 and state['step'] < n_batches:
+                save()
+                reseed_dropout(epoch, state['step'])
+
+        val_loss = float(model.evaluate(X_val, y_val, batch_size=batch_size, verbose=0))
+        state['history']['loss'].append(state['loss_sum'] / n_train)
+        state['history']['val_loss'].append(val_loss)
+        print(f'Epoch {epoch + 1}/{epochs} - loss: {state["loss_sum"] / n_train:.4f} - val_loss: {val_loss:.4f}')
+
+        if state['best'] is None or val_loss < state['best']:
+            state['best'], state['best_epoch'], state['wait'] = val_loss, epoch, 0
+            best_checkpoint.write(best_prefix)
+        else:
+            state['wait'] += 1
+            state['stopped'] = state['wait'] >= patience
+        state['epoch'], state['step'], state['loss_sum'] = epoch + 1, 0, 0.0
+        save()
+
+    if restore_best_weights and state['best_epoch'] is not None:
+        best_checkpoint.read(best_prefix).expect_partial()
+
+    history = tf.keras.callbacks.History()
+    history.history = state['history']
+    history.epoch = list(range(len(state['history']['loss'])))
+    if plot:
+        plot_loss(history)
     return history
 
 
@@ -0,0 +1,163 @@
+import glob
+import hashlib
+import json
+import os
+from dataset_cache import DatasetCache
+
+'''Index of the data fingerprints of the trials, next to oracle.json (Keras Tuner has no place for them).'''
+INDEX_FILE = 'trial_store.json'
+
+
+def data_fingerprint(*arrays):
+    '''Return the key (hex SHA-256) of the training and validation arrays a trial is scored on.'''
+    return DatasetCache.key(list(arrays))
+
+
+def architecture(values):
+    '''Return the units of the LSTM layers of a configuration, inactive layer_i_units are ignored.'''
+    return [values[f'layer_{i + 1}_units'] for i in range(values['num_layers'])]
+
+
+def config_key(values, data_key=None):
+    '''Return the key of a configuration trained on some data.
+
+    Only the active layers count, and the dropout is rounded, so the configurations sampled by
+    Keras Tuner (with unused layer_i_units and dropouts like 0.30000000000000004) and by
+    tuning.search get the same key when they build the same model.
+
+    Args:
+        values (dict): Hyperparameter values of a trial.json.
+        data_key (str): Data fingerprint, see data_fingerprint.
+
+    Returns:
+        str: The key.
+    '''
+    description = json.dumps({'layers': architecture(values), 'dropout': round(values['dropout'], 6),
+                              'data': data_key}, sort_keys=True)
+    return hashlib.sha256(description.encode()).hexdigest()
+
+
+class TrialStore:
+    '''Index of the trials of a trials directory, to reuse past results and checkpoints.
+
+    Every trial_XX/trial.json of the directory is indexed by the key of its configuration and
+    of the data it was scored on. The data fingerprints are kept in <directory>/trial_store.json;
+    trials without one (e.g. the ones written by Keras Tuner) have an unknown data fingerprint,
+    see tag_untagged.
+
+    Attributes:
+        directory (str): Trials directory, in the Keras Tuner layout.
+        trials (dict): trial_id -> {'trial_id', 'values', 'score', 'status', 'data_key', 'key'}.
+    '''
+
+    def __init__(self, directory):
+        '''Index the trials of directory, which may not exist yet.'''
+        self.directory = directory
+        self.trials = {}
+        index_path = os.path.join(directory, INDEX_FILE)
+        data_keys = {}
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                data_keys = json.load(f)
+
+        for trial_file in sorted(glob.glob(os.path.join(directory, 'trial_*', 'trial.json'))):
+            with open(trial_file) as f:
+                trial = json.load(f)
+            self._index(trial['trial_id'], trial['hyperparameters']['values'], trial['score'], trial['status'],
+                        data_keys.get(trial['trial_id']))
+
+    def _index(self, trial_id, values, score, status, data_key):
+        self.trials[trial_id] = {'trial_id': trial_id, 'values': values, 'score': score, 'status': status,
+                                 'data_key': data_key, 'key': config_key(values, data_key)}
+
+    def add(self, trial_id, values, score, status, data_key):
+        '''Index a new trial and save its data fingerprint.'''
+        self._index(trial_id, values, score, status, data_key)
+        self.save()
+
+    def save(self):
+        '''Write the data fingerprints of the trials to the index file.'''
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, INDEX_FILE), 'w') as f:
+            json.dump({trial_id: trial['data_key'] for trial_id, trial in self.trials.items()
+                       if trial['data_key'] is not None}, f, indent=2)
+
+    def tag_untagged(self, data_key):
+        '''Record that the trials without data fingerprint were scored on the data of data_key.'''
+        for trial in self.trials.values():
+            if trial['data_key'] is None:
+                trial['data_key'] = data_key
+                trial['key'] = config_key(trial['values'], data_key)
+        self.save()
+
+    def find(self, values, data_key):
+        '''Return the completed trial of the same configuration on the same data, or None.'''
+        key = config_key(values, data_key)
+        for trial in self.trials.values():
+            if trial['key'] == key and trial['status'] == 'COMPLETED' and trial['score'] is not None:
+                return trial
+        return None
+
+    def evaluated(self, data_key):
+        '''Return the completed trials scored on the data of data_key, best first.'''
+        trials = [trial for trial in self.trials.values()
+                  if trial['data_key'] == data_key and trial['status'] == 'COMPLETED' and trial['score'] is not None]
+        return sorted(trials, key=lambda trial: trial['score'])
+
+    def checkpoint(self, trial_id):
+        '''Return the checkpoint path of a trial, or None if it has none.'''
+        path = os.path.join(self.directory, f'trial_{trial_id}', 'checkpoint')
+        return path if os.path.exists(path + '.index') else None
+
+    def warm_start_source(self, values, data_key=None, any_data=False):
+        '''Return the checkpoint to initialize a configuration from, or None.
+
+        Trials with the same layers have weights of the same shapes whatever their dropout, the
+        one with the lowest score is used. Weights fitted to other data (e.g. other scaling) can be
+        a worse start than random ones, so only the trials of the same data are used by default.
+
+        Args:
+            values (dict): Hyperparameter values of the new trial.
+            data_key (str): Data fingerprint of the new trial.
+            any_data (bool): Also use trials scored on other data, the same data first. Default is False.
+
+        Returns:
+            str: Checkpoint path, see load_checkpoint_weights.
+        '''
+        layers = architecture(values)
+        candidates = [trial for trial in self.trials.values()
+                      if architecture(trial['values']) == layers and trial['score'] is not None
+                      and (any_data or trial['data_key'] == data_key)
+                      and self.checkpoint(trial['trial_id']) is not None]
+        if not candidates:
+            return None
+        best = min(candidates, key=lambda trial: (trial['data_key'] != data_key, trial['score']))
+        return self.checkpoint(best['trial_id'])
+
+
+def load_checkpoint_weights(model, checkpoint):
+    '''Set the weights of model from a trial checkpoint, without its optimizer state.
+
+    Args:
+        model (tf.keras.Model): Model built with the same layers as the trial.
+        checkpoint (str): Checkpoint path of the trial, see TrialStore.checkpoint.
+
+    Returns:
+        bool: False (and the model unchanged) if the checkpoint weights do not fit the model,
+            e.g. for another number of input features.
+    '''
+    import tensorflow as tf
+
+    reader = tf.train.load_checkpoint(checkpoint)
+    shapes = reader.get_variable_to_shape_map()
+    values = []
+    for i, layer in enumerate(layer for layer in model.layers if layer.weights):
+        # Keras names the variables of the recurrent layers after their cell
+        prefix = f'layer_with_weights-{i}/' + ('cell/' if hasattr(layer, 'cell') else '')
+        for weight in layer.weights:
+            name = prefix + weight.name.split('/')[-1].split(':')[0] + '/.ATTRIBUTES/VARIABLE_VALUE'
+            if shapes.get(name) != list(weight.shape):
+                return False
+            values.append(reader.get_tensor(name))
+    model.set_weights(values)
+    return True
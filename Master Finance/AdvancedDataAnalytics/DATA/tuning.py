@@ -0,0 +1,275 @@
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import json
+import math
+import multiprocessing
+import os
+import shutil
+import tempfile
+import numpy as np
+from trial_store import TrialStore, architecture, config_key, data_fingerprint, load_checkpoint_weights
+
+'''Directory of the trials, in the layout written by Keras Tuner.'''
+TRIALS_DIR = '../DATA/HyperTunning_Trials'
+
+OPTIMIZER = 'adam'
+LOSS = 'mean_squared_error'
+
+'''Search space of the model_builder of main_ml: 1 to 3 LSTM layers of 16 to 128 units and a dropout of 0 to 0.5.'''
+MAX_LAYERS = 3
+UNITS = [16, 32, 64, 128]
+DROPOUT_STEPS = 6  # 0.0, 0.1, ..., 0.5
+
+'''Search space in the Keras Tuner format of trial.json and oracle.json.'''
+SPACE = [
+    {'class_name': 'Int', 'config': {'name': 'num_layers', 'default': None, 'conditions': [], 'min_value': 1,
+                                     'max_value': MAX_LAYERS, 'step': 1, 'sampling': 'linear'}},
+    {'class_name': 'Choice', 'config': {'name': 'layer_1_units', 'default': UNITS[0], 'conditions': [],
+                                        'values': UNITS, 'ordered': True}},
+    {'class_name': 'Float', 'config': {'name': 'dropout', 'default': 0.0, 'conditions': [], 'min_value': 0.0,
+                                       'max_value': 0.5, 'step': 0.1, 'sampling': 'linear'}},
+] + [{'class_name': 'Choice', 'config': {'name': f'layer_{i}_units', 'default': UNITS[0], 'conditions': [],
+                                         'values': UNITS, 'ordered': True}} for i in range(2, MAX_LAYERS + 1)]
+
+'''Draws of a new configuration before the search space is considered exhausted.'''
+MAX_SAMPLING_ATTEMPTS = 1000
+
+# Per-process state, set once by _init_worker
+_worker = {}
+
+
+def sample_hyperparameters(rng):
+    '''Draw one configuration of the search space, as a values dict of trial.json.'''
+    values = {'num_layers': int(rng.integers(1, MAX_LAYERS + 1))}
+    for i in range(values['num_layers']):
+        values[f'layer_{i + 1}_units'] = int(rng.choice(UNITS))
+    # Same floats as Keras Tuner, min_value + index * step
+    values['dropout'] = 0.0 + int(rng.integers(DROPOUT_STEPS)) * 0.1
+    return values
+
+
+def values_hash(values):
+    '''Hash of a values dict, as in the id_to_hash of the Keras Tuner oracle.json.'''
+    text = ''.join(f'{key}={values[key]}' for key in sorted(values))
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()[:32]
+
+
+def build_model(values, input_shape):
+    '''Build and compile the model of a configuration, as the model_builder of main_ml.'''
+    from nn_model import create_model
+    return create_model(input_shape, architecture(values), values['dropout'], OPTIMIZER, LOSS)
+
+
+def _init_worker(data_dir, n_threads, data=None):
+    '''Process-pool initializer: map the training data and set the TensorFlow thread pools once per worker.'''
+    if data_dir is not None:
+        data = tuple(np.load(os.path.join(data_dir, f'{name}.npy'), mmap_mode='r')
+                     for name in ('X_train', 'y_train', 'X_val', 'y_val'))
+    _worker['data'] = data
+    if n_threads is not None:
+        from train_model import configure_threads
+        configure_threads(n_threads)
+
+
+def _train_trial(trial_dir, values, initial_epoch, epochs, batch_size, patience, warm_start=None):
+    '''Train one trial from its checkpoint (if initial_epoch > 0) up to epochs and save it back.
+
+    A new trial starts from the weights of the warm_start checkpoint, if they fit the model.
+
+    Returns:
+        dict: Losses and validation losses of the new epochs, and whether early stopping ended the trial.
+    '''
+    import tensorflow as tf
+    from train_model import make_array_dataset
+
+    X_train, y_train, X_val, y_val = _worker['data']
+    model = build_model(values, X_train.shape[1:])
+    checkpoint = os.path.join(trial_dir, 'checkpoint')
+    if initial_epoch > 0:
+        model.load_weights(checkpoint)
+    elif warm_start is not None:
+        load_checkpoint_weights(model, warm_start)
+
+    early_stopping = tf.keras.callbacks.EarlyStopping(monitor='val_loss', patience=patience)
+    history = model.fit(make_array_dataset(X_train, y_train, batch_size),
+                        validation_data=make_array_dataset(X_val, y_val, batch_size, shuffle=False),
+                        initial_epoch=initial_epoch, epochs=epochs, callbacks=[early_stopping], verbose=0)
+    model.save_weights(checkpoint)
+    return {'loss': history.history['loss'], 'val_loss': history.history['val_loss'],
+            'stopped': model.stop_training}
+
+
+def _write_trial(directory, trial):
+    '''Write the trial.json of a trial, in the Keras Tuner format.'''
+    val_losses = trial['val_loss']
+    best_step = int(np.argmin(val_losses)) if val_losses else 0
+    metrics = {name: {'direction': 'min',
+                      'observations': [{'value': [value], 'step': step} for step, value in enumerate(trial[name])]}
+               for name in ('loss', 'val_loss')}
+    content = {'trial_id': trial['trial_id'],
+               'hyperparameters': {'space': SPACE, 'values': trial['values']},
+               'metrics': {'metrics': metrics},
+               'score': val_losses[best_step] if val_losses else None,
+               'best_step': best_step,
+               'status': trial['status'],
+               'message': trial['message']}
+    with open(os.path.join(directory, f'trial_{trial["trial_id"]}', 'trial.json'), 'w') as f:
+        json.dump(content, f)
+
+
+def load_oracle(directory):
+    '''Load the oracle.json of a trials directory, or an empty oracle if there is none.'''
+    path = os.path.join(directory, 'oracle.json')
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return {'ongoing_trials': {}, 'hyperparameters': {'space': SPACE, 'values': {}}, 'start_order': [],
+            'end_order': [], 'run_times': {}, 'retry_queue': [], 'seed': None, 'seed_state': None,
+            'tried_so_far': [], 'id_to_hash': {}}
+
+
+def _write_oracle(directory, oracle):
+    with open(os.path.join(directory, 'oracle.json'), 'w') as f:
+        json.dump(oracle, f)
+    # Keras Tuner also keeps the (empty) state of the tuner next to the oracle
+    tuner_path = os.path.join(directory, 'tuner0.json')
+    if not os.path.exists(tuner_path):
+        with open(tuner_path, 'w') as f:
+            json.dump({}, f)
+
+
+def successive_halving_rungs(min_epochs, max_epochs, eta):
+    '''Epoch budgets of the rungs: min_epochs, min_epochs * eta, ... up to max_epochs.'''
+    rungs = []
+    epochs = min_epochs
+    while epochs < max_epochs:
+        rungs.append(epochs)
+        epochs *= eta
+    return rungs + [max_epochs]
+
+
+def search(X_train, y_train, X_val, y_val, n_trials=27, min_epochs=3, max_epochs=100, eta=3, n_workers=1,
+           directory=TRIALS_DIR, batch_size=256, patience=3, seed=None, reuse=True, warm_start=True,
+           reuse_untagged=False, verbose=True):
+    '''Search the model_builder space of main_ml with successive halving, trials trained concurrently.
+
+    n_trials random configurations are trained for min_epochs, then only the best 1 / eta of them
+    (lowest validation loss so far) are trained further, eta times longer, and so on up to
+    max_epochs. A trial continues from its checkpoint at every rung, and ends earlier if its
+    validation loss does not improve for patience epochs. The trials of a rung run in a process
+    pool, each worker maps the data once. Workers are spawned, so they start with a clean
+    TensorFlow runtime whatever ran in this process; they import the __main__ module, whose
+    script code must be under an if __name__ == '__main__' guard.
+
+    The trials are written to directory in the Keras Tuner layout (trial_XX/trial.json with a
+    checkpoint of the weights, oracle.json), numbered after the trials already there. The
+    search grows incrementally through a TrialStore of the directory: configurations already
+    scored on the same data are not sampled again, and new trials start from the checkpoint of
+    a past trial with the same layers. Trials without data fingerprint, like the Keras Tuner
+    trials of TRIALS_DIR, only count with reuse_untagged: pass it on the first search over such
+    a directory if its trials were scored on the same simulated data, they are then tagged with
+    the fingerprint of this data for good (see TrialStore.tag_untagged).
+
+    Args:
+        X_train (numpy.ndarray): Training data.
+        y_train (numpy.ndarray): Labels for the training data.
+        X_val (numpy.ndarray): Validation data the trials are scored on.
+        y_val (numpy.ndarray): Labels for the validation data.
+        n_trials (int): Number of configurations. Default is 27.
+        min_epochs (int): Epochs of the first rung. Default is 3.
+        max_epochs (int): Most epochs of a trial. Default is 100.
+        eta (int): Reduction factor between rungs. Default is 3.
+        n_workers (int): Number of worker processes, 1 trains in this process. Default is 1.
+        directory (str): Trials directory. Default is TRIALS_DIR.
+        batch_size (int): Batch size of the training. Default is 256.
+        patience (int): Epochs without improvement before a trial stops. Default is 3.
+        seed (int): Seed of the sampled configurations.
+        reuse (bool): Skip the configurations already scored on the same data. Default is True.
+        warm_start (bool): Initialize new trials from past checkpoints of the same layers. Default is True.
+        reuse_untagged (bool): Consider the trials without data fingerprint scored on this data. Default is False.
+        verbose (bool): Print the progress. Default is True.
+
+    Returns:
+        list: The trials scored on the same data (trial_id, values, score), past ones included, best first.
+    '''
+    rng = np.random.default_rng(seed)
+    os.makedirs(directory, exist_ok=True)
+    oracle = load_oracle(directory)
+    store = TrialStore(directory)
+    data_key = data_fingerprint(X_train, y_train, X_val, y_val)
+    if reuse_untagged:
+        store.tag_untagged(data_key)
+    first_id = max((int(trial_id) for trial_id in list(oracle['id_to_hash']) + list(store.trials)), default=-1) + 1
+
+    trials = []
+    sampled = set()
+    for i in range(n_trials):
+        for _ in range(MAX_SAMPLING_ATTEMPTS):
+            values = sample_hyperparameters(rng)
+            key = config_key(values, data_key)
+            if key not in sampled and not (reuse and store.find(values, data_key)):
+                break
+        else:
+            # Every configuration has been scored already
+            break
+        sampled.add(key)
+        trial = {'trial_id': f'{first_id + i:02d}', 'values': values, 'loss': [], 'val_loss': [],
+                 'stopped': False, 'status': 'RUNNING', 'message': None,
+                 'warm_start': store.warm_start_source(values, data_key) if warm_start else None}
+        os.makedirs(os.path.join(directory, f'trial_{trial["trial_id"]}'), exist_ok=True)
+        oracle['start_order'].append(trial['trial_id'])
+        trials.append(trial)
+
+    data_dir = None
+    n_threads = max(1, (os.cpu_count() or 1) // n_workers) if n_workers > 1 else None
+    if n_workers > 1:
+        # Written once and memory-mapped by every worker instead of pickled per trial
+        data_dir = tempfile.mkdtemp()
+        for name, array in zip(('X_train', 'y_train', 'X_val', 'y_val'), (X_train, y_train, X_val, y_val)):
+            np.save(os.path.join(data_dir, f'{name}.npy'), np.asarray(array, dtype=np.float32))
+    pool = ProcessPoolExecutor(n_workers, mp_context=multiprocessing.get_context('spawn'),
+                               initializer=_init_worker, initargs=(data_dir, n_threads)) if n_workers > 1 else None
+    if pool is None:
+        _init_worker(None, None, (X_train, y_train, X_val, y_val))
+
+    try:
+        active = list(trials)
+        for rung, epochs in enumerate(successive_halving_rungs(min_epochs, max_epochs, eta)):
+            if not active:
+                break
+            tasks = [(os.path.join(directory, f'trial_{trial["trial_id"]}'), trial['values'], len(trial['loss']),
+                      epochs, batch_size, patience, trial['warm_start']) for trial in active if not trial['stopped']]
+            results = pool.map(_train_trial, *zip(*tasks)) if pool is not None and tasks \
+                else (_train_trial(*task) for task in tasks)
+            for trial, result in zip([trial for trial in active if not trial['stopped']], results):
+                trial['loss'] += result['loss']
+                trial['val_loss'] += result['val_loss']
+                trial['stopped'] = result['stopped']
+                _write_trial(directory, trial)
+
+            active.sort(key=lambda trial: min(trial['val_loss']))
+            if verbose:
+                print(f'Rung {rung} ({epochs} epochs): best val_loss {min(active[0]["val_loss"]):.6f}, '
+                      f'{len(active)} trials')
+            survivors = math.ceil(len(active) / eta) if epochs < max_epochs else 0
+            for trial in active[survivors:]:
+                trial['status'] = 'COMPLETED'
+                trial['message'] = None if epochs == max_epochs or trial['stopped'] \
+                    else f'Pruned after {len(trial["val_loss"])} epochs'
+                _write_trial(directory, trial)
+                oracle['end_order'].append(trial['trial_id'])
+            active = active[:survivors]
+    finally:
+        if pool is not None:
+            pool.shutdown()
+            shutil.rmtree(data_dir)
+
+    for trial in trials:
+        oracle['run_times'][trial['trial_id']] = 1
+        oracle['id_to_hash'][trial['trial_id']] = values_hash(trial['values'])
+        oracle['tried_so_far'].append(values_hash(trial['values']))
+        store.add(trial['trial_id'], trial['values'], min(trial['val_loss']), trial['status'], data_key)
+    _write_oracle(directory, oracle)
+
+    return [{'trial_id': trial['trial_id'], 'values': trial['values'], 'score': trial['score']}
+            for trial in store.evaluated(data_key)]
@@ -2,7 +2,6 @@ import os
 from typing import Tuple, List
 import numpy as np
 from utils import *
-import random
 import unittest
 
 WHITE: Tuple[int, int, int] = (255, 255, 255)  # RGB value for white color
@@ -428,15 +427,20 @@ class InvestmentScene(object):
 
             surface.blit(graph_surface, pos)  # Blit the graph surface onto the main surface
 
-    def __init__(self, screen):
+    def __init__(self, screen, seed=None):
         '''
         Initialize the InvestmentScene object.
+
+        Args:
+            screen (pygame.Surface): The surface of the screen.
+            seed (int or numpy.random.SeedSequence): Seed of the scene's market, None for a random market.
         '''
         super(InvestmentScene, self).__init__()  # Constructor of the object class
 
         # Set attributes with their initial values
 
         self.save_state: bool = True
+        self.rng: np.random.Generator = np.random.default_rng(seed)  # Random stream owned by this scene
         
         self.width: int = screen.get_width()  # Get the width of the screen
         self.height: int = screen.get_height()  # Get the height of the screen
@@ -513,21 +517,21 @@ class InvestmentScene(object):
         # Generate initial data using log-normal distribution
 
         # Append an initial random value within the range [0.02, 0.05] to the inflation price history
-        self.inflation_price_history.append(random.uniform(0.02, 0.05))
+        self.inflation_price_history.append(self.rng.uniform(0.02, 0.05))
 
         # Append an initial random value within the range [0, 0.1] to the federal reserve rate history
-        self.fed_rate_history.append(random.uniform(0, 0.1))
+        self.fed_rate_history.append(self.rng.uniform(0, 0.1))
 
         # Generate an initial stock price value using a log-normal distribution
         # The mean and standard deviation of the log-normal distribution are calculated based on the stock_mean and stock_sigma variables
         self.stock_price_history.append(
-            np.random.lognormal(np.log(self.stock_mean ** 2 / np.sqrt(self.stock_sigma ** 2 + self.stock_mean ** 2)),
+            self.rng.lognormal(np.log(self.stock_mean ** 2 / np.sqrt(self.stock_sigma ** 2 + self.stock_mean ** 2)),
                                 np.sqrt(np.log(self.stock_sigma ** 2 / self.stock_mean ** 2 + 1))))
 
         # Generate an initial bond price value using a log-normal distribution
         # The mean and standard deviation of the log-normal distribution are calculated based on the bond_mean and bond_sigma variables
         self.bond_price_history.append(
-            np.random.lognormal(np.log(self.bond_mean ** 2 / np.sqrt(self.bond_sigma ** 2 + self.bond_mean ** 2)),
+            self.rng.lognormal(np.log(self.bond_mean ** 2 / np.sqrt(self.bond_sigma ** 2 + self.bond_mean ** 2)),
                                 np.sqrt(np.log(self.bond_sigma ** 2 / self.bond_mean ** 2 + 1))))
 
         # Append a time value of 0 to the time history
@@ -552,7 +556,7 @@ class InvestmentScene(object):
         fed_rate_change = self.fed_rate_history[-1] - self.fed_rate_mean
 
         # Calculate the error term by considering the impact of the federal reserve rate and inflation on stock prices
-        error = -0.01 * self.fed_rate_history[-1] + np.random.uniform(-0.1, 0.1) - self.stock_fed_rate_coef * fed_rate_change - self.stock_inflation_coef * inflation_change
+        error = -0.01 * self.fed_rate_history[-1] + self.rng.uniform(-0.1, 0.1) - self.stock_fed_rate_coef * fed_rate_change - self.stock_inflation_coef * inflation_change
 
         # Calculate the moving average term for inflation by multiplying the error term by the inflation moving average coefficient
         ma_term = self.inflation_ma_coef * error
@@ -566,7 +570,7 @@ class InvestmentScene(object):
         mean = self.fed_rate_ar_coef * self.fed_rate_history[-1] + (1 - self.fed_rate_ar_coef) * self.fed_rate_mean + max(-0.025, min(0.025, 0.25 * inflation_change))  # Limit Fed rate variation to 2.5% per year
 
         # Generate a random uniform error term
-        error = np.random.uniform(-0.1, 0.1)
+        error = self.rng.uniform(-0.1, 0.1)
 
         # Calculate the moving average term for the federal reserve rate by multiplying the error term by the federal reserve rate moving average coefficient
         ma_term = self.fed_rate_ma_coef * error
@@ -580,7 +584,7 @@ class InvestmentScene(object):
         mean = self.stock_ar_coef * self.stock_price_history[-1] + (1 - self.stock_ar_coef) * self.stock_mean + self.stock_inflation_coef * inflation_change + self.stock_fed_rate_coef * fed_rate_change
 
         # Generate a random normal error term for stock prices
-        error = np.random.normal(0, self.stock_sigma)
+        error = self.rng.normal(0, self.stock_sigma)
 
         # Calculate the moving average term for stock prices by multiplying the error term by the stock moving average coefficient
         ma_term = self.stock_ma_coef * error
@@ -594,7 +598,7 @@ class InvestmentScene(object):
         mean = self.bond_ar_coef * self.bond_price_history[-1] + (1 - self.bond_ar_coef) * self.bond_mean + self.bond_inflation_coef * inflation_change + self.bond_fed_rate_coef * fed_rate_change
 
         # Generate a random normal error term for bond prices
-        error = np.random.normal(0, self.bond_sigma)
+        error = self.rng.normal(0, self.bond_sigma)
 
         # Calculate the moving average term for bond prices by multiplying the error term by the bond moving average coefficient
         ma_term = self.bond_ma_coef * error